@@ -54,6 +54,20 @@ CREATE TABLE `dataset_accesses` (
 ) ENGINE=MyISAM DEFAULT CHARSET=latin1;
 
 
+DROP TABLE IF EXISTS `dataset_accesses_monthly`;
+CREATE TABLE `dataset_accesses_monthly` (
+  `dataset_id` int(10) unsigned NOT NULL,
+  `site_id` int(10) unsigned NOT NULL,
+  `month` date NOT NULL DEFAULT '0000-00-00',
+  `num_accesses` int(11) NOT NULL DEFAULT '0',
+  `cputime` double NOT NULL DEFAULT '0',
+  `last_access` date NOT NULL DEFAULT '0000-00-00',
+  PRIMARY KEY (`dataset_id`,`site_id`,`month`),
+  KEY `sites` (`site_id`),
+  KEY `months` (`month`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
+
+
 DROP TABLE IF EXISTS `dataset_replicas`;
 CREATE TABLE `dataset_replicas` (
   `dataset_id` int(11) unsigned NOT NULL,
@@ -82,6 +96,16 @@ CREATE TABLE `dataset_requests` (
 ) ENGINE=MyISAM DEFAULT CHARSET=latin1;
 
 
+DROP TABLE IF EXISTS `dataset_request_weights`;
+CREATE TABLE `dataset_request_weights` (
+  `dataset_id` int(10) unsigned NOT NULL,
+  `halflife` double NOT NULL DEFAULT '0',
+  `weight` double NOT NULL DEFAULT '0',
+  `timestamp` datetime NOT NULL DEFAULT '0000-00-00 00:00:00',
+  PRIMARY KEY (`dataset_id`)
+) ENGINE=MyISAM DEFAULT CHARSET=latin1;
+
+
 DROP TABLE IF EXISTS `datasets`;
 CREATE TABLE `datasets` (
   `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
@@ -104,9 +104,13 @@ do
   echo "GRANT ALL PRIVILEGES ON `dynamo_tmp`.* TO '$PRIV_USER'@'$HOST';" | $ROOTSQL
   echo 'GRANT SELECT ON `dynamo%`.* TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
   echo 'GRANT UPDATE ON `dynamo`.`system` TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
+  # staging tables of bulk loads (MySQL.load_many)
+  echo 'GRANT CREATE TEMPORARY TABLES ON `dynamo`.* TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
   echo 'GRANT SELECT, INSERT, UPDATE, DELETE, LOCK TABLES, CREATE, DROP ON `dynamohistory%`.* TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
   echo 'GRANT SELECT, INSERT, UPDATE, DELETE ON `dynamo`.`dataset_requests` TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
+  echo 'GRANT SELECT, INSERT, UPDATE, DELETE, CREATE ON `dynamo`.`dataset_request_weights` TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
   echo 'GRANT SELECT, INSERT, UPDATE, DELETE ON `dynamo`.`dataset_accesses` TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
+  echo 'GRANT SELECT, INSERT, UPDATE, DELETE, CREATE ON `dynamo`.`dataset_accesses_monthly` TO "'$PRIV_USER'"@"'$HOST'";' | $ROOTSQL
 
   echo "CREATE USER '$NORMAL_USER'@'$HOST' IDENTIFIED BY '$NORMAL_USER_PASSWD';" | $ROOTSQL
   echo 'GRANT ALL PRIVILEGES ON `dynamo_tmp`.* TO "'$NORMAL_USER'"@"'$HOST'";' | $ROOTSQL
@@ -0,0 +1,69 @@
+import multiprocessing
+import cPickle as pickle
+
+class UpdateChannel(object):
+    """
+    Stream of inventory changes from a write-enabled executable to the server.
+    The executable side accumulates (command, unlinked clone) pairs and sends them in batches of up to
+    batch_size changes, each pickled into a single message. At most max_batches messages are in flight;
+    send() blocks when the server falls behind. The end of the stream is signaled by a None message.
+    """
+
+    CMD_UPDATE, CMD_DELETE = range(2)
+
+    def __init__(self, batch_size = 1000, max_batches = 4):
+        self.batch_size = batch_size
+
+        self._queue = multiprocessing.Queue(max_batches)
+        self._batch = []
+
+    ## Executable side
+
+    def send(self, cmd, obj):
+        self._batch.append((cmd, obj))
+
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the current batch. Blocks while the queue is full."""
+
+        if len(self._batch) == 0:
+            return
+
+        self._queue.put(pickle.dumps(self._batch, pickle.HIGHEST_PROTOCOL))
+        self._batch = []
+
+    def clear(self):
+        """Discard the changes not sent yet."""
+
+        self._batch = []
+
+    def close_stream(self):
+        """Send the remaining changes and the end-of-message."""
+
+        self.flush()
+        self._queue.put(None)
+
+    ## Server side
+
+    def receive(self, block = False, timeout = None):
+        """
+        Return the next batch as a list of (command, object), or None at the end of the stream.
+        Raises Queue.Empty if there is no message.
+        """
+
+        message = self._queue.get(block, timeout)
+        if message is None:
+            return None
+
+        return pickle.loads(message)
+
+    def fileno(self):
+        """File descriptor that becomes readable when a message arrives (for select())."""
+
+        # multiprocessing.Queue does not expose this publicly
+        return self._queue._reader.fileno()
+
+    def close(self):
+        self._queue.close()
@@ -0,0 +1,152 @@
+import logging
+
+from dynamo.core.channel import UpdateChannel
+from dynamo.dataformat import Dataset, Block, File, Site, SitePartition, Group, DatasetReplica, BlockReplica, Partition
+
+LOG = logging.getLogger(__name__)
+
+class ChangeTracker(object):
+    """
+    Optimistic concurrency control for writing executables running in parallel. Each writer works on the
+    inventory as of the moment it was started. When a batch of changes from a writer is applied, changes
+    to datasets (including their blocks, files, and replicas) or sites (including their partitions) that
+    were modified by another writer after this writer started are rejected. Changes to replicas and site
+    partitions are also rejected if the site, group, or partition they refer to was deleted by another
+    writer after this writer started. Once a key is rejected for a writer, all later changes of the writer
+    to the same key are rejected too. Changes to the key accepted in earlier batches stay applied; the
+    tracker does not roll them back.
+    """
+
+    def __init__(self):
+        # incremented at every applied batch
+        self.serial = 0
+        # {key: (serial, writer)}
+        self._last_change = {}
+        # deletions of sites, groups, and partitions {key: (serial, writer)}
+        self._deletions = {}
+        # {writer: (start serial, set of rejected keys)}
+        self._writers = {}
+
+    @staticmethod
+    def object_key(obj):
+        """
+        @param obj  An (unlinked clone of) inventory object
+        @return Granularity key (kind, name) of the object
+        """
+
+        if isinstance(obj, Dataset):
+            return ('dataset', obj.name)
+        elif isinstance(obj, Block):
+            return ('dataset', obj.dataset.name)
+        elif isinstance(obj, File):
+            return ('dataset', obj.block.dataset.name)
+        elif isinstance(obj, DatasetReplica):
+            return ('dataset', obj.dataset.name)
+        elif isinstance(obj, BlockReplica):
+            return ('dataset', obj.block.dataset.name)
+        elif isinstance(obj, Site):
+            return ('site', obj.name)
+        elif isinstance(obj, SitePartition):
+            return ('site', obj.site.name)
+        elif isinstance(obj, Group):
+            return ('group', obj.name)
+        elif isinstance(obj, Partition):
+            return ('partition', obj.name)
+        else:
+            raise TypeError('Unknown inventory object type %s' % type(obj).__name__)
+
+    @staticmethod
+    def referenced_keys(obj):
+        """
+        @param obj  An (unlinked clone of) inventory object
+        @return List of keys of the sites, groups, and partitions obj refers to, other than its own key
+        """
+
+        if isinstance(obj, DatasetReplica):
+            return [('site', obj.site.name)]
+        elif isinstance(obj, BlockReplica):
+            keys = [('site', obj.site.name)]
+            if obj.group.name is not None:
+                keys.append(('group', obj.group.name))
+            return keys
+        elif isinstance(obj, SitePartition):
+            return [('partition', obj.partition.name)]
+        else:
+            return []
+
+    def add_writer(self, writer):
+        """Start tracking a writer. Changes applied from now on are checked against the changes of this writer."""
+
+        self._writers[writer] = (self.serial, set())
+
+    def remove_writer(self, writer):
+        """
+        Stop tracking a writer.
+        @return Set of keys whose changes from the writer were rejected.
+        """
+
+        _, rejected_keys = self._writers.pop(writer)
+
+        # records older than the start of all remaining writers are not needed any more
+        if len(self._writers) == 0:
+            self._last_change.clear()
+            self._deletions.clear()
+        else:
+            min_serial = min(start for start, _ in self._writers.itervalues())
+            for records in (self._last_change, self._deletions):
+                for key in [k for k, (serial, _) in records.iteritems() if serial <= min_serial]:
+                    records.pop(key)
+
+        return rejected_keys
+
+    def filter_batch(self, writer, batch):
+        """
+        Select the changes that can be applied and record them as applied.
+        @param writer  Writer object given in add_writer
+        @param batch   List of (command, object)
+        @return  (accepted list of (command, object), number of rejected changes)
+        """
+
+        start_serial, rejected_keys = self._writers[writer]
+
+        self.serial += 1
+
+        accepted = []
+        num_rejected = 0
+
+        for cmd, obj in batch:
+            key = ChangeTracker.object_key(obj)
+
+            if key not in rejected_keys:
+                try:
+                    serial, last_writer = self._last_change[key]
+                except KeyError:
+                    pass
+                else:
+                    if serial > start_serial and last_writer is not writer:
+                        LOG.warning('%s %s was changed by another writer; rejecting its changes.', key[0].capitalize(), key[1])
+                        rejected_keys.add(key)
+
+            if key not in rejected_keys:
+                for ref_key in ChangeTracker.referenced_keys(obj):
+                    try:
+                        serial, last_writer = self._deletions[ref_key]
+                    except KeyError:
+                        continue
+
+                    if serial > start_serial and last_writer is not writer:
+                        LOG.warning('%s %s was deleted by another writer; rejecting changes to %s %s.', ref_key[0].capitalize(), ref_key[1], key[0], key[1])
+                        rejected_keys.add(key)
+                        break
+
+            if key in rejected_keys:
+                num_rejected += 1
+                continue
+
+            accepted.append((cmd, obj))
+            self._last_change[key] = (self.serial, writer)
+
+            if cmd == UpdateChannel.CMD_DELETE and isinstance(obj, (Site, Group, Partition)):
+                self._deletions[key] = (self.serial, writer)
+
+        return accepted, num_rejected
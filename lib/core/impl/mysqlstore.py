@@ -1,6 +1,7 @@
 import time
 import logging
 import fnmatch
+import collections
 
 from dynamo.core.persistency import InventoryStore
 from dynamo.utils.interface.mysql import MySQL
@@ -9,13 +10,54 @@ from dynamo.dataformat import Dataset, Block, File, Site, SitePartition, Group,
 LOG = logging.getLogger(__name__)
 
 class MySQLInventoryStore(InventoryStore):
-    """InventoryStore with a MySQL backend."""
+    """
+    InventoryStore with a MySQL backend.
+    Saves and deletions are buffered and written out as multi-row statements at flush(). Name -> id
+    mappings of the tables are cached; this store must be the only writer to the tables while it is in use.
+    """
+
+    # {table: (columns, unique key columns)}
+    _table_columns = {
+        'partitions': (('name',), ('name',)),
+        'groups': (('name', 'olevel'), ('name',)),
+        'sites': (('name', 'host', 'storage_type', 'backend', 'storage', 'cpu', 'status'), ('name',)),
+        'quotas': (('site_id', 'partition_id', 'storage'), ('site_id', 'partition_id')),
+        'datasets': (('name', 'size', 'num_files', 'status', 'data_type', 'software_version_id', 'last_update', 'is_open'), ('name',)),
+        'blocks': (('dataset_id', 'name', 'size', 'num_files', 'is_open', 'last_update'), ('dataset_id', 'name')),
+        'files': (('block_id', 'dataset_id', 'size', 'name'), ('name',)),
+        'dataset_replicas': (('dataset_id', 'site_id'), ('dataset_id', 'site_id')),
+        'block_replicas': (('block_id', 'site_id', 'group_id', 'is_complete', 'is_custodial', 'last_update'), ('block_id', 'site_id')),
+        'block_replica_sizes': (('block_id', 'site_id', 'size'), ('block_id', 'site_id'))
+    }
+
+    # order in which the buffered tables are written
+    _buffered_tables = ['partitions', 'groups', 'sites', 'quotas', 'datasets', 'blocks', 'files', 'dataset_replicas', 'block_replicas', 'block_replica_sizes']
+
+    # tables with auto-increment ids
+    _id_tables = set(['partitions', 'groups', 'sites', 'datasets', 'blocks', 'files'])
+
+    # number of keys in one DELETE statement
+    _delete_batch_size = 1000
 
     def __init__(self, config):
         InventoryStore.__init__(self, config)
 
         self._mysql = MySQL(config.db_params)
 
+        # name -> id caches
+        self._dataset_ids = {}
+        self._block_ids = {} # {dataset name: {block name: id}}
+        self._site_ids = {}
+        self._group_ids = {}
+        self._partition_ids = {}
+        self._software_version_ids = {} # {(cycle, major, minor, suffix): id}
+
+        # write-behind buffer {table: OrderedDict(key: row or None for deletion)}
+        self._pending = {}
+        self._num_pending = 0
+        # flush automatically when this many rows are buffered
+        self._max_pending = config.get('max_pending_writes', 10000)
+
     def get_partition_names(self):
         return self._mysql.query('SELECT `name` FROM `partitions`')
 
@@ -84,6 +126,8 @@ class MySQLInventoryStore(InventoryStore):
         return dataset_names
 
     def get_files(self, block):
+        self.flush()
+
         if LOG.getEffectiveLevel() == logging.DEBUG:
             LOG.debug('Loading files for block %s', block.full_name())
 
@@ -100,6 +144,8 @@ class MySQLInventoryStore(InventoryStore):
         return files
 
     def load_data(self, inventory, group_names = None, site_names = None, dataset_names = None): #override
+        self.flush()
+
         ## Load groups
         LOG.info('Loading groups.')
 
@@ -160,6 +206,15 @@ class MySQLInventoryStore(InventoryStore):
 
         LOG.info('Loaded %d dataset replicas and %d block replicas in %.1f seconds.', num_dataset_replicas, num_block_replicas, time.time() - start)
 
+        ## fill the id caches (block ids are fetched per dataset on demand)
+        for group_id, group in id_group_map.iteritems():
+            if group.name is not None:
+                self._group_ids[group.name] = group_id
+        for site_id, site in id_site_map.iteritems():
+            self._site_ids[site.name] = site_id
+        for dataset_id, dataset in id_dataset_map.iteritems():
+            self._dataset_ids[dataset.name] = dataset_id
+
         ## cleanup
         if self._mysql.table_exists('blocks_load_tmp'):
             self._mysql.query('DROP TABLE `blocks_load_tmp`')
@@ -376,13 +431,45 @@ class MySQLInventoryStore(InventoryStore):
             dataset_replica.dataset.replicas.add(dataset_replica)
             dataset_replica.site.add_dataset_replica(dataset_replica, add_block_replicas = True)
 
+    def flush(self): #override
+        """
+        Write out the buffered saves and deletions. Each table receives at most one multi-row
+        DELETE and one multi-row INSERT ... ON DUPLICATE KEY UPDATE per batch.
+        """
+
+        if self._num_pending == 0:
+            return
+
+        for table in MySQLInventoryStore._buffered_tables:
+            try:
+                rows = self._pending.pop(table)
+            except KeyError:
+                continue
+
+            fields, key_fields = MySQLInventoryStore._table_columns[table]
+
+            saved = []
+            deleted = []
+            for key, row in rows.iteritems():
+                if row is None:
+                    deleted.append(key)
+                else:
+                    saved.append(row)
+
+            if len(deleted) != 0:
+                self._delete_rows(table, key_fields, deleted)
+
+            if len(saved) != 0:
+                self._mysql.insert_many(table, fields, None, saved)
+
+        self._num_pending = 0
+
     def save_block(self, block): #override
         dataset_id = self._get_dataset_id(block.dataset)
         if dataset_id == 0:
             return
 
-        fields = ('dataset_id', 'name', 'size', 'num_files', 'is_open', 'last_update')
-        self._insert_update('blocks', fields, dataset_id, block.real_name(), block.size, block.num_files, block.is_open, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block.last_update)))
+        self._buffer_save('blocks', (dataset_id, block.real_name(), block.size, block.num_files, block.is_open, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block.last_update))))
 
     def delete_block(self, block): #override
         # Here we don't assume block name is unique..
@@ -390,8 +477,12 @@ class MySQLInventoryStore(InventoryStore):
         if dataset_id == 0:
             return
 
-        sql = 'DELETE FROM `blocks` WHERE `dataset_id` = %s AND `name` = %s'
-        self._mysql.query(sql, dataset_id, block.real_name())
+        self._buffer_delete('blocks', (dataset_id, block.real_name()))
+
+        try:
+            self._block_ids[block.dataset.name].pop(block.real_name(), None)
+        except KeyError:
+            pass
 
     def save_file(self, lfile): #override
         dataset_id = self._get_dataset_id(lfile.block.dataset)
@@ -402,12 +493,10 @@ class MySQLInventoryStore(InventoryStore):
         if block_id == 0:
             return
 
-        fields = ('block_id', 'dataset_id', 'size', 'name')
-        self._insert_update('files', fields, block_id, dataset_id, lfile.size, lfile.lfn)
+        self._buffer_save('files', (block_id, dataset_id, lfile.size, lfile.lfn))
 
     def delete_file(self, lfile): #override
-        sql = 'DELETE FROM `files` WHERE `name` = %s'
-        self._mysql.query(sql, lfile.lfn)
+        self._buffer_delete('files', (lfile.lfn,))
 
     def save_blockreplica(self, block_replica): #override
         block_id = self._get_block_id(block_replica.block)
@@ -422,15 +511,12 @@ class MySQLInventoryStore(InventoryStore):
         if group_id == 0:
             return
 
-        fields = ('block_id', 'site_id', 'group_id', 'is_complete', 'is_custodial', 'last_update')
-        self._insert_update('block_replicas', fields, block_id, site_id, group_id, block_replica.is_complete, block_replica.is_custodial, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block_replica.last_update)))
+        self._buffer_save('block_replicas', (block_id, site_id, group_id, block_replica.is_complete, block_replica.is_custodial, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block_replica.last_update))))
 
         if block_replica.size != block_replica.block.size:
-            fields = ('block_id', 'site_id', 'size')
-            self._insert_update('block_replica_sizes', fields, block_id, site_id, block_replica.size)
+            self._buffer_save('block_replica_sizes', (block_id, site_id, block_replica.size))
         else:
-            sql = 'DELETE FROM `block_replica_sizes` WHERE `block_id` = %s AND `site_id` = %s'
-            self._mysql.query(sql, block_id, site_id)
+            self._buffer_delete('block_replica_sizes', (block_id, site_id))
 
     def delete_blockreplica(self, block_replica): #override
         block_id = self._get_block_id(block_replica.block)
@@ -441,33 +527,24 @@ class MySQLInventoryStore(InventoryStore):
         if site_id == 0:
             return
 
-        sql = 'DELETE FROM `block_replicas` WHERE `block_id` = %s AND `site_id` = %s'
-        self._mysql.query(sql, block_id, site_id)
-
-        sql = 'DELETE FROM `block_replica_sizes` WHERE `block_id` = %s AND `site_id` = %s'
-        self._mysql.query(sql, block_id, site_id)
+        self._buffer_delete('block_replicas', (block_id, site_id))
+        self._buffer_delete('block_replica_sizes', (block_id, site_id))
 
     def save_dataset(self, dataset): #override
         if dataset.software_version is None:
             software_version_id = 0
         else:
-            sql = 'SELECT `id` FROM `software_versions` WHERE (`cycle`, `major`, `minor`, `suffix`) = (%s, %s, %s, %s)'
-            
-            result = self._mysql.query(sql, *dataset.software_version)
-            if len(result) == 0:
-                sql = 'INSERT INTO `software_versions` (`cycle`, `major`, `minor`, `suffix`) VALUES (%s, %s, %s, %s)'
-                software_version_id = self._mysql.query(sql, *dataset.software_version)
-            else:
-                software_version_id = result[0]
+            software_version_id = self._get_software_version_id(dataset.software_version)
             
-        fields = ('name', 'size', 'num_files', 'status', 'data_type', 'software_version_id', 'last_update', 'is_open')
-        self._insert_update('datasets', fields, dataset.name, dataset.size, dataset.num_files, \
+        self._buffer_save('datasets', (dataset.name, dataset.size, dataset.num_files, \
             dataset.status, dataset.data_type, software_version_id,
-            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(dataset.last_update)), dataset.is_open)
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(dataset.last_update)), dataset.is_open))
 
     def delete_dataset(self, dataset): #override
-        sql = 'DELETE FROM `datasets` WHERE `name` = %s'
-        self._mysql.query(sql, dataset.name)
+        self._buffer_delete('datasets', (dataset.name,))
+
+        self._dataset_ids.pop(dataset.name, None)
+        self._block_ids.pop(dataset.name, None)
 
     def save_datasetreplica(self, dataset_replica): #override
         dataset_id = self._get_dataset_id(dataset_replica.dataset)
@@ -478,8 +555,7 @@ class MySQLInventoryStore(InventoryStore):
         if site_id == 0:
             return
 
-        fields = ('dataset_id', 'site_id')
-        self._insert_update('dataset_replicas', fields, dataset_id, site_id)
+        self._buffer_save('dataset_replicas', (dataset_id, site_id))
 
     def delete_datasetreplica(self, dataset_replica): #override
         dataset_id = self._get_dataset_id(dataset_replica.dataset)
@@ -490,32 +566,31 @@ class MySQLInventoryStore(InventoryStore):
         if site_id == 0:
             return
 
-        sql = 'DELETE FROM `dataset_replicas` WHERE `dataset_id` = %s AND `site_id` = %s'
-        self._mysql.query(sql, dataset_id, site_id)
+        self._buffer_delete('dataset_replicas', (dataset_id, site_id))
 
     def save_group(self, group): #override
-        fields = ('name', 'olevel')
-        self._insert_update('groups', fields, group.name, group.olevel.__name__)
+        self._buffer_save('groups', (group.name, group.olevel.__name__))
 
     def delete_group(self, group): #override
-        sql = 'DELETE FROM `groups` WHERE `name` = %s'
-        self._mysql.query(sql, group.name)
+        self._buffer_delete('groups', (group.name,))
+
+        self._group_ids.pop(group.name, None)
 
     def save_partition(self, partition): #override
-        fields = ('name',)
-        self._insert_update('partitions', fields, partition.name)
+        self._buffer_save('partitions', (partition.name,))
 
     def delete_partition(self, partition): #override
-        sql = 'DELETE FROM `partitions` WHERE `name` = %s'
-        self._mysql.query(sql, partition.name)
+        self._buffer_delete('partitions', (partition.name,))
+
+        self._partition_ids.pop(partition.name, None)
 
     def save_site(self, site): #override
-        fields = ('name', 'host', 'storage_type', 'backend', 'storage', 'cpu', 'status')
-        self._insert_update('sites', fields, site.name, site.host, site.storage_type, site.backend, site.storage, site.cpu, site.status)
+        self._buffer_save('sites', (site.name, site.host, site.storage_type, site.backend, site.storage, site.cpu, site.status))
 
     def delete_site(self, site): #override
-        sql = 'DELETE FROM `sites` WHERE `name` = %s'
-        self._mysql.query(sql, site.name)
+        self._buffer_delete('sites', (site.name,))
+
+        self._site_ids.pop(site.name, None)
 
     def save_sitepartition(self, site_partition): #override
         # We are only saving quotas. For superpartitions, there is nothing to do.
@@ -530,8 +605,7 @@ class MySQLInventoryStore(InventoryStore):
         if partition_id == 0:
             return
 
-        fields = ('site_id', 'partition_id', 'storage')
-        self._insert_update('quotas', fields, site_id, partition_id, site_partition.quota * 1.e-12)
+        self._buffer_save('quotas', (site_id, partition_id, site_partition.quota * 1.e-12))
 
     def delete_sitepartition(self, site_partition): #override
         # We are only saving quotas. For superpartitions, there is nothing to do.
@@ -546,21 +620,78 @@ class MySQLInventoryStore(InventoryStore):
         if partition_id == 0:
             return
 
-        sql = 'DELETE FROM `quotas` WHERE `site_id` = %s AND `partition_id` = %s'
-        self._mysql.query(sql, site_id, partition_id)
+        self._buffer_delete('quotas', (site_id, partition_id))
+
+    def _buffer_save(self, table, row):
+        """
+        Schedule an INSERT ... ON DUPLICATE KEY UPDATE of the row. A later save or deletion of the
+        same key replaces this entry.
+        @param table  Table name
+        @param row    Tuple of values in the order of _table_columns[table][0]
+        """
+
+        fields, key_fields = MySQLInventoryStore._table_columns[table]
+        key = tuple(row[fields.index(f)] for f in key_fields)
+
+        self._buffer(table, key, row)
+
+    def _buffer_delete(self, table, key):
+        """
+        Schedule a deletion of the row with the given key.
+        @param table  Table name
+        @param key    Tuple of values in the order of _table_columns[table][1]
+        """
+
+        self._buffer(table, key, None)
+
+    def _buffer(self, table, key, row):
+        try:
+            rows = self._pending[table]
+        except KeyError:
+            rows = self._pending[table] = collections.OrderedDict()
+
+        if key in rows:
+            if rows[key] is None and row is not None and table in MySQLInventoryStore._id_tables:
+                # Deletion followed by a save creates a new row with a new auto-increment id.
+                # Write out the deletion to reproduce this.
+                self.flush()
+                rows = self._pending[table] = collections.OrderedDict()
+                self._num_pending += 1
+            else:
+                # only the last operation on the key counts
+                rows.pop(key)
+        else:
+            self._num_pending += 1
 
-    def _insert_update(self, table, fields, *values):
-        placeholders = ', '.join(['%s'] * len(fields))
+        rows[key] = row
 
-        sql = 'INSERT INTO `%s` (' % table
-        sql += ', '.join('`%s`' % f for f in fields)
-        sql += ') VALUES (' + placeholders + ')'
-        sql += ' ON DUPLICATE KEY UPDATE '
-        sql += ', '.join(['`%s`=VALUES(`%s`)' % (f, f) for f in fields])
+        if self._num_pending >= self._max_pending:
+            self.flush()
 
-        self._mysql.query(sql, *values)
+    def _delete_rows(self, table, key_fields, keys):
+        if len(key_fields) == 1:
+            key_str = '`%s`' % key_fields[0]
+            template = '%s'
+        else:
+            key_str = '(' + ', '.join('`%s`' % f for f in key_fields) + ')'
+            template = '(' + ', '.join(['%s'] * len(key_fields)) + ')'
+
+        sqlbase = 'DELETE FROM `%s` WHERE %s IN ' % (table, key_str)
+
+        for ik in xrange(0, len(keys), MySQLInventoryStore._delete_batch_size):
+            batch = keys[ik:ik + MySQLInventoryStore._delete_batch_size]
+            sql = sqlbase + '(' + ', '.join([template] * len(batch)) + ')'
+            self._mysql.query(sql, *sum(batch, ()))
 
     def _get_dataset_id(self, dataset):
+        try:
+            return self._dataset_ids[dataset.name]
+        except KeyError:
+            pass
+
+        # the dataset may be in the write buffer
+        self.flush()
+
         sql = 'SELECT `id` FROM `datasets` WHERE `name` = %s'
 
         result = self._mysql.query(sql, dataset.name)
@@ -568,45 +699,102 @@ class MySQLInventoryStore(InventoryStore):
             # should I raise?
             return 0
 
+        self._dataset_ids[dataset.name] = result[0]
+
         return result[0]
 
     def _get_block_id(self, block):
-        sql = 'SELECT b.`id` FROM `blocks` AS b'
-        sql += ' INNER JOIN `datasets` AS d ON d.`id` = b.`dataset_id`'
-        sql += ' WHERE d.`name` = %s AND b.`name` = %s'
+        try:
+            return self._block_ids[block.dataset.name][block.real_name()]
+        except KeyError:
+            pass
 
-        result = self._mysql.query(sql, block.dataset.name, block.real_name())
-        if len(result) == 0:
+        dataset_id = self._get_dataset_id(block.dataset)
+        if dataset_id == 0:
             return 0
 
-        return result[0]
+        # the block may be in the write buffer
+        self.flush()
+
+        # A dataset is usually updated as a whole - fetch the ids of all blocks in one go
+        sql = 'SELECT `name`, `id` FROM `blocks` WHERE `dataset_id` = %s'
+
+        block_ids = self._block_ids[block.dataset.name] = dict(self._mysql.xquery(sql, dataset_id))
+
+        return block_ids.get(block.real_name(), 0)
 
     def _get_site_id(self, site):
+        try:
+            return self._site_ids[site.name]
+        except KeyError:
+            pass
+
+        self.flush()
+
         sql = 'SELECT `id` FROM `sites` WHERE `name` = %s'
         
         result = self._mysql.query(sql, site.name)
         if len(result) == 0:
             return 0
 
+        self._site_ids[site.name] = result[0]
+
         return result[0]
 
     def _get_group_id(self, group):
         if group.name is None:
             return 0
 
+        try:
+            return self._group_ids[group.name]
+        except KeyError:
+            pass
+
+        self.flush()
+
         sql = 'SELECT `id` FROM `groups` WHERE `name` = %s'
         
         result = self._mysql.query(sql, group.name)
         if len(result) == 0:
             return 0
 
+        self._group_ids[group.name] = result[0]
+
         return result[0]
 
     def _get_partition_id(self, partition):
+        try:
+            return self._partition_ids[partition.name]
+        except KeyError:
+            pass
+
+        self.flush()
+
         sql = 'SELECT `id` FROM `partitions` WHERE `name` = %s'
         
         result = self._mysql.query(sql, partition.name)
         if len(result) == 0:
             return 0
 
+        self._partition_ids[partition.name] = result[0]
+
         return result[0]
+
+    def _get_software_version_id(self, version):
+        try:
+            return self._software_version_ids[version]
+        except KeyError:
+            pass
+
+        sql = 'SELECT `id` FROM `software_versions` WHERE (`cycle`, `major`, `minor`, `suffix`) = (%s, %s, %s, %s)'
+
+        result = self._mysql.query(sql, *version)
+        if len(result) == 0:
+            sql = 'INSERT INTO `software_versions` (`cycle`, `major`, `minor`, `suffix`) VALUES (%s, %s, %s, %s)'
+            software_version_id = self._mysql.query(sql, *version)
+        else:
+            software_version_id = result[0]
+
+        self._software_version_ids[version] = software_version_id
+
+        return software_version_id
@@ -4,6 +4,8 @@ import re
 from dynamo.policy.condition import Condition
 from dynamo.policy.variables import replica_variables
 from dynamo.dataformat import Group, Partition, Block, ObjectError, ConfigurationError
+from dynamo.core.snapshot import InventorySnapshot, SnapshotError
+from dynamo.core.channel import UpdateChannel
 import dynamo.core.impl as persistency_impl
 
 LOG = logging.getLogger(__name__)
@@ -51,6 +53,9 @@ class ObjectRepository(object):
     def clear_update(self):
         pass
 
+    def discard_updates(self):
+        pass
+
 
 class DynamoInventory(ObjectRepository):
     """
@@ -63,14 +68,19 @@ class DynamoInventory(ObjectRepository):
         self.init_store(config.persistency.module, config.persistency.config)
 
         self.partition_def_path = config.partition_def_path
+
+        # Optional binary snapshot of the inventory content for fast loading
+        if 'snapshot' in config:
+            self.snapshot = InventorySnapshot(config.snapshot)
+        else:
+            self.snapshot = None
         
         if load:
             self.load()
 
-        # When the user application is authorized to change the inventory state, all updated
-        # and deleted objects are kept in the two lists until the end of execution.
-        self._updated_objects = None
-        self._deleted_objects = None
+        # When the user application is authorized to change the inventory state, unlinked clones of
+        # all updated and deleted objects are streamed to the server through this UpdateChannel.
+        self._update_channel = None
 
     def init_store(self, module, config):
         persistency_cls = getattr(persistency_impl, module)
@@ -78,6 +88,11 @@ class DynamoInventory(ObjectRepository):
 
         Block._inventory_store = self._store
 
+    def flush_store(self):
+        """Write out the changes buffered in the persistency store."""
+
+        self._store.flush()
+
     def load(self, groups = (None, None), sites = (None, None), datasets = (None, None)):
         """
         Load inventory content from persistency store.
@@ -96,6 +111,27 @@ class DynamoInventory(ObjectRepository):
 
         self._load_partitions()
 
+        # Snapshot holds the full inventory and cannot be used for a filtered load
+        if self.snapshot is not None and groups == (None, None) and sites == (None, None) and datasets == (None, None):
+            try:
+                self.snapshot.load(self)
+            except SnapshotError as ex:
+                LOG.info('Cannot use inventory snapshot: %s', str(ex))
+            except:
+                LOG.error('Exception while loading inventory snapshot.', exc_info = True)
+            else:
+                self._report_load()
+                return
+
+            # Unusable snapshot is removed so that a fresh one is written
+            self.snapshot.invalidate()
+
+            # Snapshot can be loaded partially - start over
+            self.groups.clear()
+            self.groups[None] = Group.null_group
+            self.sites.clear()
+            self.datasets.clear()
+
         LOG.info('Loading data from local persistent storage.')
 
         group_names = self._get_group_names(*groups)
@@ -109,6 +145,9 @@ class DynamoInventory(ObjectRepository):
             dataset_names = dataset_names
         )
 
+        self._report_load()
+
+    def _report_load(self):
         num_dataset_replicas = 0
         num_block_replicas = 0
 
@@ -240,7 +279,7 @@ class DynamoInventory(ObjectRepository):
         """
         Update an object. Only update the member values of the immediate object.
         When calling from a subprocess, pass down the unlinked clone of the argument
-        to _updated_objects.
+        to the update channel.
         @param obj    Object to embed into this inventory.
         @param write  Write updated object to persistent store.
         """
@@ -258,18 +297,18 @@ class DynamoInventory(ObjectRepository):
 
     def register_update(self, obj, write = False, changelog = None):
         """
-        Put the obj to _updated_objects list and write to store.
+        Send the obj to the update channel and write to store.
         """
 
-        if self._updated_objects is not None:
+        if self._update_channel is not None:
             if changelog is not None:
                 changelog.info('Updating %s', str(obj))
 
-            LOG.debug('%s has changed. Adding a clone to updated objects list.', str(obj))
-            # The content of updated_objects gets pickled and shipped back to the server process.
+            LOG.debug('%s has changed. Sending a clone to the server.', str(obj))
+            # The updates get pickled and shipped back to the server process.
             # Pickling process follows all links between the objects. We create an unlinked clone
             # here to avoid shipping the entire inventory.
-            self._updated_objects.append(obj.unlinked_clone())
+            self._update_channel.send(UpdateChannel.CMD_UPDATE, obj.unlinked_clone())
 
         if write:
             if changelog is not None:
@@ -292,8 +331,8 @@ class DynamoInventory(ObjectRepository):
 
         ObjectRepository.delete(self, obj)
 
-        if self._deleted_objects is not None:
-            self._deleted_objects.append(obj.unlinked_clone())
+        if self._update_channel is not None:
+            self._update_channel.send(UpdateChannel.CMD_DELETE, obj.unlinked_clone())
 
         if write:
             try:
@@ -302,11 +341,29 @@ class DynamoInventory(ObjectRepository):
                 LOG.error('Exception writing deletion of %s to inventory store', str(obj))
                 raise
 
+    def set_update_channel(self, channel):
+        """
+        Stream the updated and deleted objects to the server through the channel.
+        @param channel  UpdateChannel
+        """
+
+        self._update_channel = channel
+
     def clear_update(self):
         """
-        Empty the _updated_objects and _deleted_objects lists. This operation
-        *does not* revert the updates.
+        Discard the updates not sent to the server yet. Updates are sent in batches while the
+        executable runs; use discard_updates() before making changes to keep all of them local.
+        This operation *does not* revert the updates.
+        """
+
+        if self._update_channel is not None:
+            self._update_channel.clear()
+
+    def discard_updates(self):
+        """
+        Stop sending updates to the server. Subsequent changes to the inventory stay local
+        to this process.
         """
 
-        self._updated_objects = []
-        self._deleted_objects = []
+        self.clear_update()
+        self._update_channel = None
@@ -0,0 +1,131 @@
+import os
+import socket
+import select
+import signal
+import fcntl
+import errno
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class ServerNotification(object):
+    """
+    Wakeup channel for the server main loop. wait() multiplexes the following with select():
+     - A Unix datagram socket. The registry frontend and the scheduler send a datagram (notify_server)
+       after inserting a new action or changing the status of one.
+     - A self-pipe written by the SIGCHLD handler, signaling that a child process exited.
+     - Any additional file descriptors given by the caller (e.g. the update channel of the writing process).
+    """
+
+    def __init__(self, socket_path = ''):
+        """
+        @param socket_path  Path of the notification socket. If empty, only child process exits are notified.
+        """
+
+        self.socket_path = socket_path
+
+        self._pipe_r, self._pipe_w = os.pipe()
+        for fd in (self._pipe_r, self._pipe_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        if socket_path:
+            if os.path.exists(socket_path):
+                # left over from a previous server process
+                os.unlink(socket_path)
+
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(socket_path)
+            self._socket.setblocking(0)
+            # the frontend runs as a different user
+            os.chmod(socket_path, 0777)
+        else:
+            self._socket = None
+
+        self._default_sigchld = signal.signal(signal.SIGCHLD, self._handle_sigchld)
+        # do not interrupt blocking system calls (DB queries) in the main process; select() still returns
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def wait(self, timeout, fds = []):
+        """
+        Wait until one of the events occurs or timeout seconds pass.
+        @param timeout  Timeout in seconds.
+        @param fds      Additional file descriptors to watch for input.
+        @return (notified, child_exited)
+        """
+
+        watched = [self._pipe_r] + list(fds)
+        if self._socket is not None:
+            watched.append(self._socket)
+
+        try:
+            readable = select.select(watched, [], [], timeout)[0]
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+            # the signal handler has written to the pipe
+            readable = [self._pipe_r]
+
+        child_exited = False
+        try:
+            while os.read(self._pipe_r, 4096):
+                child_exited = True
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+        notified = False
+        if self._socket is not None:
+            try:
+                while True:
+                    self._socket.recv(4096)
+                    notified = True
+            except socket.error as err:
+                if err.args[0] != errno.EAGAIN:
+                    raise
+
+        return notified, child_exited
+
+    def detach(self):
+        """Release the resources in a forked child process without removing the socket file."""
+
+        signal.signal(signal.SIGCHLD, self._default_sigchld)
+
+        os.close(self._pipe_r)
+        os.close(self._pipe_w)
+        if self._socket is not None:
+            self._socket.close()
+
+    def close(self):
+        self.detach()
+
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _handle_sigchld(self, signum, frame):
+        try:
+            os.write(self._pipe_w, 'c')
+        except OSError:
+            # pipe is full - the main loop is already going to wake up
+            pass
+
+
+def notify_server(socket_path):
+    """
+    Wake up the server main loop. Failures (e.g. server not running) are ignored; the server
+    reads the registry periodically in any case.
+    @param socket_path  Path of the notification socket of the server.
+    """
+
+    if not socket_path:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(0)
+        sock.sendto('n', socket_path)
+    except socket.error as err:
+        LOG.debug('Could not notify the server: %s', str(err))
+    finally:
+        sock.close()
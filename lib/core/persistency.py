@@ -64,6 +64,14 @@ class InventoryStore(object):
 
         raise NotImplementedError('load_data')
 
+    def flush(self):
+        """
+        Write out any buffered saves and deletions. Called at the end of a batch of updates.
+        Implementations that write through do not need to override this.
+        """
+
+        pass
+
     def save_block(self, block):
         raise NotImplementedError('save_block')
 
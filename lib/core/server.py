@@ -8,7 +8,12 @@ import multiprocessing
 import Queue
 
 from dynamo.core.inventory import DynamoInventory
+from dynamo.core.channel import UpdateChannel
+from dynamo.core.notification import ServerNotification
+from dynamo.core.workerpool import ReadOnlyWorkerPool
+from dynamo.core.conflict import ChangeTracker
 from dynamo.core.registry import DynamoRegistry
+from dynamo.dataformat import SitePartition, ObjectError
 from dynamo.utils.signaling import SignalBlocker
 
 LOG = logging.getLogger(__name__)
@@ -17,8 +22,6 @@ CHANGELOG = logging.getLogger('changelog')
 class Dynamo(object):
     """Main daemon class."""
 
-    CMD_UPDATE, CMD_DELETE, CMD_EOM = range(3)
-
     def __init__(self, config):
         LOG.info('Initializing Dynamo server %s.', __file__)
 
@@ -36,6 +39,33 @@ class Dynamo(object):
         self.inventory = DynamoInventory(config.inventory, load = False)
         self.inventory_config = config.inventory.clone()
 
+        ## Updates from the writing executable are received in batches of this size
+        self.update_batch_size = config.get('update_batch_size', 1000)
+        # Maximum number of batches in flight - the executable waits when the server falls behind
+        self.max_pending_batches = config.get('max_pending_batches', 4)
+
+        ## Number of write-enabled executables allowed to run at the same time
+        self.max_concurrent_writers = config.get('max_concurrent_writers', 1)
+        # Conflicts between the changes of concurrent writers are detected here
+        self.change_tracker = ChangeTracker()
+
+        ## Clients wake the server through this socket when they submit or kill an executable
+        self.notification_socket = config.get('notification_socket', '')
+        # The action table is also read at this interval in case a notification is missed
+        self.action_poll_interval = config.get('action_poll_interval', 10)
+        self.notification = None
+
+        ## Number of pre-forked workers for read-only executables (0 = fork at submission)
+        self.num_readonly_workers = config.get('num_readonly_workers', 0)
+        # Modules imported by the workers before receiving a job
+        self.worker_preload_modules = config.get('worker_preload_modules', [])
+        self.worker_pool = None
+
+        ## Inventory snapshot is written by a forked child process (copy-on-write image of the inventory)
+        self.snapshot_process = None
+        # Set when the inventory changes while the snapshot is written; the written snapshot is then discarded
+        self.snapshot_outdated = False
+
         ## Load the inventory content (filter according to debug config)
         load_opts = {}
         if 'debug' in config:
@@ -44,6 +74,9 @@ class Dynamo(object):
                 excluded = config.debug.get('excluded_' + objs, None)
     
                 load_opts[objs] = (included, excluded)
+
+            # Cross-check the site partition occupancy counters at every access (slow)
+            SitePartition.check_occupancy = config.debug.get('check_occupancy', False)
         
         LOG.info('Loading the inventory.')
         self.inventory.load(**load_opts)
@@ -54,83 +87,121 @@ class Dynamo(object):
         Step 1: Poll the registry for one uploaded script.
         Step 2: If a script is found, check the authorization of the script.
         Step 3: Spawn a child process for the script.
-        Step 4: Collect updates from the write-enabled child process.
+        Step 4: Collect and apply updates from the write-enabled child processes.
         Step 5: Collect completed child processes.
-        Step 6: Sleep for N seconds.
+        Step 6: Wait for a notification, a child process exit, or an update from a write-enabled process.
+        The registry is polled (Step 1) only after a notification, after an executable is started, or when
+        action_poll_interval seconds passed since the last poll.
         """
 
         LOG.info('Started dynamo daemon.')
 
         child_processes = []
 
-        # There can only be one child process with write access at a time. We pass it a Queue to communicate back.
-        # writing_process is a tuple (proc, queue) when some process is writing
-        writing_process = (None, None)
-        # We need to buffer updated and deleted objects from the child process to avoid filling up the pipe
-        updated_objects = []
-        deleted_objects = []
+        # Up to max_concurrent_writers child processes can have write access at a time. We pass each an UpdateChannel to communicate back.
+        # {proc: channel} (channel is None once the end of the stream is received)
+        writing_processes = {}
 
         signal_blocker = SignalBlocker(logger = LOG)
 
+        self.notification = ServerNotification(self.notification_socket)
+
+        if self.num_readonly_workers > 0:
+            self.worker_pool = ReadOnlyWorkerPool(self.num_readonly_workers, self._run_worker)
+
+        # the action table is locked
+        actions_locked = False
+
+        # the server was stopped with SIGTERM or Ctrl+C (not by an exception)
+        clean_shutdown = False
+
         try:
             LOG.info('Start polling for executables.')
 
             first_wait = True
-            sleep_time = 0
+            # read the action table at this iteration
+            check_actions = True
+            child_exited = False
+            last_poll = 0.
 
             while True:
-                self.registry.backend.query('UNLOCK TABLES')
+                if actions_locked:
+                    self.registry.backend.query('UNLOCK TABLES')
+                    actions_locked = False
 
                 ## Step 4 (easier to do here because we use "continue"s)
-                if writing_process[1] is not None:
-                    terminated = self.collect_updates(writing_process[1], updated_objects, deleted_objects)
+                for proc, channel in writing_processes.items():
+                    if channel is None:
+                        continue
+
+                    terminated = self.collect_updates(proc, channel, signal_blocker)
                     if terminated:
-                        writing_process[1].close()
-                        writing_process = (writing_process[0], None)
+                        channel.close()
+                        writing_processes[proc] = None
 
                 ## Step 5 (easier to do here because we use "continue"s)
-                completed_processes = self.collect_processes(child_processes)
+                if child_exited or check_actions:
+                    # check the registry status only when polling - executables can be killed through the frontend
+                    completed_processes = self.collect_processes(child_processes, check_registry = check_actions)
+                    child_exited = False
+                else:
+                    completed_processes = []
                 
                 for proc, status in completed_processes:
-                    if proc is not writing_process[0]:
+                    if proc not in writing_processes:
                         continue
 
-                    # drain the queue
-                    if writing_process[1] is not None:
-                        self.collect_updates(writing_process[1], updated_objects, deleted_objects, drain = True)
-                        writing_process[1].close()
+                    # drain the channel
+                    channel = writing_processes.pop(proc)
+                    if channel is not None:
+                        if status != 'done':
+                            LOG.warning('Writing executable %s ended with status %s. Updates sent until now are applied.', proc.name, status)
 
-                    writing_process = (None, None)
+                        self.collect_updates(proc, channel, signal_blocker, drain = True)
+                        channel.close()
 
-                    if status != 'done':
-                        continue
+                    rejected_keys = self.change_tracker.remove_writer(proc)
+                    if len(rejected_keys) != 0:
+                        LOG.warning('Changes of writing executable %s to %d objects were rejected because of conflicts with other writers.', proc.name, len(rejected_keys))
 
-                    # The child process may send us the list of updated/deleted objects
-                    # Block system signals and get update done
-                    with signal_blocker:
-                        for obj in updated_objects:
-                            self.inventory.update(obj, write = True, changelog = CHANGELOG)
-                        for obj in deleted_objects:
-                            CHANGELOG.info('Deleting %s', str(obj))
-                            self.inventory.delete(obj, write = True)
+                    # write requests may be waiting
+                    check_actions = True
+
+                if self.inventory.snapshot is not None:
+                    if self.snapshot_process is not None:
+                        self.collect_snapshot_writer()
+                    elif self.inventory.snapshot.need_write():
+                        self.start_snapshot_writer()
+
+                if self.worker_pool is not None:
+                    # the pool is invalidated at every applied batch; workers forked here see the current inventory
+                    self.worker_pool.fill()
+
+                if not check_actions:
+                    ## Step 6: Wait
+                    fds = [channel.fileno() for channel in writing_processes.itervalues() if channel is not None]
+
+                    timeout = max(last_poll + self.action_poll_interval - time.time(), 0.)
+                    notified, child_exited = self.notification.wait(timeout, fds)
 
-                    updated_objects = []
-                    deleted_objects = []
+                    check_actions = notified or time.time() >= last_poll + self.action_poll_interval
 
-                ## Step 6 (easier to do here because we use "continue"s)
-                time.sleep(sleep_time)
+                    continue
 
                 ## Step 1: Poll
                 LOG.debug('Polling for executables.')
 
+                last_poll = time.time()
+
                 # UNLOCK statement at the top of the while loop
                 self.registry.backend.query('LOCK TABLES `action` WRITE')
+                actions_locked = True
 
                 sql = 'SELECT s.`id`, s.`write_request`, s.`title`, s.`path`, s.`args`, s.`user_id`, u.`name`'
                 sql += ' FROM `action` AS s INNER JOIN `users` AS u ON u.`id` = s.`user_id`'
                 sql += ' WHERE s.`status` = \'new\''
-                if writing_process[0] is not None:
-                    # we don't allow write_requesting executables while there is one running
+                if len(writing_processes) >= self.max_concurrent_writers:
+                    # we don't allow more write_requesting executables
                     sql += ' AND s.`write_request` = 0'
                 sql += ' ORDER BY s.`timestamp` LIMIT 1'
                 result = self.registry.backend.query(sql)
@@ -140,17 +211,17 @@ class Dynamo(object):
                         LOG.info('Waiting for executables.')
                         first_wait = False
 
-                    sleep_time = 0.5
+                    LOG.debug('No executable found, waiting for notifications.')
 
-                    LOG.debug('No executable found, sleeping for %d seconds.', sleep_time)
+                    check_actions = False
 
                     continue
 
                 ## Step 2: If a script is found, check the authorization of the script.
+                # There may be more executables in the queue; check_actions stays True
                 exec_id, write_request, title, path, args, user_id, user_name = result[0]
 
                 first_wait = True
-                sleep_time = 0
 
                 if not os.path.exists(path + '/exec.py'):
                     LOG.info('Executable %s from user %s (write request: %s) not found.', title, user_name, write_request)
@@ -169,25 +240,32 @@ class Dynamo(object):
                         self.registry.backend.query('UPDATE `action` SET `status` = %s where `id` = %s', 'authfailed', exec_id)
                         continue
 
-                    queue = multiprocessing.Queue()
-                    proc_args += (queue,)
+                    channel = UpdateChannel(self.update_batch_size, self.max_pending_batches)
+                    proc_args += (channel,)
 
                 ## Step 3: Spawn a child process for the script
                 self.registry.backend.query('UPDATE `action` SET `status` = %s WHERE `id` = %s', 'run', exec_id)
 
-                proc = multiprocessing.Process(target = self._run_one, name = title, args = proc_args)
-                child_processes.append((exec_id, proc, user_name, path))
+                proc = None
+                if not write_request and self.worker_pool is not None:
+                    proc = self.worker_pool.submit(title, path, args)
 
-                proc.daemon = True
-                proc.start()
+                if proc is None:
+                    proc = multiprocessing.Process(target = self._run_one, name = title, args = proc_args)
+                    proc.daemon = True
+                    proc.start()
+
+                child_processes.append((exec_id, proc, user_name, path))
 
                 if write_request:
-                    writing_process = (proc, proc_args[-1])
+                    writing_processes[proc] = proc_args[-1]
+                    self.change_tracker.add_writer(proc)
 
                 LOG.info('Started executable %s (%s) from user %s (PID %d).', title, path, user_name, proc.pid)
 
         except KeyboardInterrupt:
             LOG.info('Server process was interrupted.')
+            clean_shutdown = True
 
         except:
             # log the exception
@@ -195,13 +273,24 @@ class Dynamo(object):
             raise
 
         finally:
+            self.notification.close()
+            self.notification = None
+
+            if self.worker_pool is not None:
+                self.worker_pool.close()
+                self.worker_pool = None
+
+            if self.snapshot_process is not None and not clean_shutdown:
+                self.abort_snapshot_writer()
+
             # If the main process was interrupted by Ctrl+C:
             # Ctrl+C will pass SIGINT to all child processes (if this process is the head of the
             # foreground process group). In this case calling terminate() will duplicate signals
             # in the child. Child processes have to always ignore SIGINT and be killed only from
             # SIGTERM sent by the line below.
 
-            self.registry.backend.query('UNLOCK TABLES')
+            if actions_locked:
+                self.registry.backend.query('UNLOCK TABLES')
 
             for exec_id, proc, user_name, path in child_processes:
                 LOG.warning('Terminating %s (%s) requested by %s (PID %d)', proc.name, path, user_name, proc.pid)
@@ -215,8 +304,24 @@ class Dynamo(object):
 
                 self.registry.backend.query('UPDATE `action` SET `status` = \'killed\' where `id` = %s', exec_id)
 
-            if writing_process[1] is not None:
-                writing_process[1].close()
+            for proc, channel in writing_processes.iteritems():
+                if channel is None:
+                    continue
+
+                if clean_shutdown:
+                    # apply the updates the writer sent before it was terminated
+                    try:
+                        self.collect_updates(proc, channel, signal_blocker, drain = True, timeout = 1)
+                    except:
+                        LOG.error('Failed to collect the updates from %s.', proc.name, exc_info = True)
+                        clean_shutdown = False
+
+                channel.close()
+
+            if clean_shutdown and self.inventory.snapshot is not None:
+                # the snapshot is what makes the next startup fast
+                with signal_blocker:
+                    self.write_final_snapshot()
 
     def check_write_auth(self, title, user_id, path):
         # check authorization
@@ -230,7 +335,90 @@ class Dynamo(object):
 
         return False
 
-    def collect_processes(self, child_processes):
+    def write_final_snapshot(self):
+        """
+        Make sure a valid snapshot exists when the server exits. An in-flight writer is waited for, and the
+        snapshot is written synchronously if the writer did not produce a valid one.
+        """
+
+        if self.snapshot_process is not None:
+            LOG.info('Waiting for the inventory snapshot writer.')
+            self.collect_snapshot_writer(wait = True)
+
+        if self.inventory.snapshot.is_valid():
+            return
+
+        LOG.info('Writing the inventory snapshot before exiting.')
+
+        try:
+            self.inventory.snapshot.save(self.inventory)
+        except:
+            LOG.error('Failed to write the inventory snapshot.', exc_info = True)
+            self.inventory.snapshot.discard()
+
+    def start_snapshot_writer(self):
+        """
+        Fork a child process that writes the inventory snapshot. The main loop continues while the child
+        writes out its copy-on-write image of the inventory.
+        """
+
+        proc = multiprocessing.Process(target = self._write_snapshot, name = 'snapshot-writer')
+        proc.daemon = True
+        proc.start()
+
+        self.snapshot_process = proc
+        self.snapshot_outdated = False
+
+        LOG.debug('Started snapshot writer (PID %d).', proc.pid)
+
+    def collect_snapshot_writer(self, wait = False):
+        """
+        Install the snapshot written by the child process if it completed and the inventory did not change
+        in the meantime. An outdated snapshot is discarded; a new one is written after the next quiet period.
+        @param wait  Block until the writer exits.
+        """
+
+        if wait:
+            self.snapshot_process.join()
+
+        # is_alive() reaps the process with waitpid
+        if self.snapshot_process.is_alive():
+            return
+
+        snapshot = self.inventory.snapshot
+
+        if self.snapshot_process.exitcode != 0:
+            # Failure to write the snapshot is not fatal - inventory will be loaded from the store at next startup
+            LOG.error('Snapshot writer failed (exit code %d).', self.snapshot_process.exitcode)
+            snapshot.discard()
+        elif self.snapshot_outdated:
+            LOG.info('Inventory changed while the snapshot was written. Discarding the snapshot.')
+            snapshot.discard()
+        else:
+            snapshot.install()
+
+        self.snapshot_process = None
+        self.snapshot_outdated = False
+
+    def abort_snapshot_writer(self):
+        """Terminate the snapshot writer. Called when the server exits on an exception."""
+
+        LOG.info('Aborting the inventory snapshot writer.')
+
+        self.snapshot_process.terminate()
+        self.snapshot_process.join(5)
+        self.snapshot_process = None
+
+        self.inventory.snapshot.discard()
+
+    def collect_processes(self, child_processes, check_registry = True):
+        """
+        Find the completed child processes and record their status in the registry.
+        @param child_processes  List of (exec_id, proc, user_name, path). Completed processes are removed.
+        @param check_registry   Terminate the processes whose status was changed in the registry.
+        @return  List of (proc, status)
+        """
+
         completed_processes = []
 
         ichild = 0
@@ -239,16 +427,19 @@ class Dynamo(object):
 
             status = 'done'
 
-            result = self.registry.backend.query('SELECT `status` FROM `action` WHERE `id` = %s', exec_id)
-            if len(result) == 0 or result[0] != 'run':
-                # Job was aborted in the registry
-                uid = os.geteuid()
-                os.seteuid(0)
-                proc.terminate()
-                os.seteuid(uid)
-                proc.join(5)
-                status = 'killed'
+            if check_registry:
+                result = self.registry.backend.query('SELECT `status` FROM `action` WHERE `id` = %s', exec_id)
+                if len(result) == 0 or result[0] != 'run':
+                    # Job was aborted in the registry
+                    uid = os.geteuid()
+                    os.seteuid(0)
+                    proc.terminate()
+                    os.seteuid(uid)
+                    proc.join(5)
+                    status = 'killed'
     
+            # is_alive() reaps the process with waitpid
+
             if proc.is_alive():
                 ichild += 1
             else:
@@ -264,28 +455,137 @@ class Dynamo(object):
 
         return completed_processes
 
-    def collect_updates(self, queue, updated_objects, deleted_objects, drain = False):
-        while True:
+    def collect_updates(self, proc, channel, signal_blocker, drain = False, timeout = 30):
+        """
+        Receive batches of updates from a writing child process and apply them to the inventory.
+        Changes conflicting with those of other writers are rejected (see ChangeTracker).
+        Unless drain is True, at most max_pending_batches are applied so the main loop stays responsive.
+        @param proc            Writing process
+        @param channel         UpdateChannel
+        @param signal_blocker  SignalBlocker
+        @param drain           Wait for the end of the stream.
+        @param timeout         When draining, give up if no message arrives in this many seconds.
+        @return  True if the end of the stream was reached.
+        """
+
+        num_batches = 0
+
+        while drain or num_batches < self.max_pending_batches:
             try:
-                # If drain is True, we are calling this function to wait to empty out the queue.
-                # In case the child process fails to put EOM at the end, we time out in 30 seconds.
-                cmd, obj = queue.get(block = drain, timeout = 30)
+                # If drain is True, we are calling this function to wait to empty out the channel.
+                # In case the child process fails to put EOM at the end, we time out.
+                batch = channel.receive(block = drain, timeout = timeout)
             except Queue.Empty:
                 return False
-            else:
-                if cmd == Dynamo.CMD_UPDATE:
-                    updated_objects.append(obj)
-                elif cmd == Dynamo.CMD_DELETE:
-                    deleted_objects.append(obj)
-                elif cmd == Dynamo.CMD_EOM:
-                    return True
+
+            if batch is None:
+                return True
+
+            batch, num_rejected = self.change_tracker.filter_batch(proc, batch)
+            if num_rejected != 0:
+                LOG.warning('Rejected %d conflicting changes from %s.', num_rejected, proc.name)
+
+            self.apply_updates(batch, signal_blocker)
+            num_batches += 1
+
+        return False
+
+    def apply_updates(self, batch, signal_blocker):
+        """
+        Apply a batch of updates and deletions to the inventory and the store. The store flushes once per batch.
+        @param batch           List of (UpdateChannel.CMD_*, object)
+        @param signal_blocker  SignalBlocker
+        """
+
+        if len(batch) == 0:
+            return
+
+        if self.worker_pool is not None:
+            # idle workers hold the inventory before the update
+            self.worker_pool.invalidate()
+
+        if self.snapshot_process is not None:
+            # the snapshot being written does not contain this batch; let the writer finish and discard its output
+            self.snapshot_outdated = True
+
+        # Block system signals and get update done
+        with signal_blocker:
+            if self.inventory.snapshot is not None:
+                # Inventory store content is about to change
+                self.inventory.snapshot.invalidate()
+
+            try:
+                for cmd, obj in batch:
+                    try:
+                        if cmd == UpdateChannel.CMD_UPDATE:
+                            self.inventory.update(obj, write = True, changelog = CHANGELOG)
+                        else:
+                            CHANGELOG.info('Deleting %s', str(obj))
+                            self.inventory.delete(obj, write = True)
+                    except (KeyError, ObjectError):
+                        # e.g. the object refers to something deleted by another writer; a bad change
+                        # from an executable must not bring down the server
+                        LOG.error('Rejected change to %s: inconsistent with the inventory.', str(obj), exc_info = True)
+            finally:
+                # the store may buffer the writes
+                self.inventory.flush_store()
         
-    def _run_one(self, path, args, queue = None):
+    def _write_snapshot(self):
+        """
+        Target of the snapshot writer process. Runs as the server user and writes only the snapshot file.
+        """
+
+        import signal
+
+        if self.notification is not None:
+            self.notification.detach()
+
+        # Terminated with SIGTERM by the server; SIGINT is for the server (see note above proc.terminate())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        try:
+            # the server installs the file if the inventory did not change in the meantime
+            self.inventory.snapshot.save(self.inventory, install = False)
+        except:
+            LOG.error('Failed to write the inventory snapshot.', exc_info = True)
+            sys.exit(1)
+
+    def _run_one(self, path, args, channel = None):
+        self._setup_child(read_only = (channel is None))
+        self._execute(path, args, channel)
+
+    def _run_worker(self, job_conn):
+        """
+        Target of the read-only worker processes. Set up the environment and wait for one job.
+        @param job_conn  Connection from which (path, args) is received.
+        """
+
+        self._setup_child(read_only = True)
+
+        for module in self.worker_preload_modules:
+            __import__(module)
+
+        try:
+            path, args = job_conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            # Terminated by the server (inventory changed or server shutting down)
+            return
+
+        job_conn.close()
+
+        self._execute(path, args)
+
+    def _setup_child(self, read_only):
+        """
+        Set the uid of the child process and re-initialize the logging, registry, and inventory store.
+        """
+
         # Set the uid of the process
         os.seteuid(0)
         os.setegid(0)
 
-        if queue is None:
+        if read_only:
             pwnam = pwd.getpwnam(self.read_user)
         else:
             pwnam = pwd.getpwnam(self.full_user)
@@ -293,11 +593,10 @@ class Dynamo(object):
         os.setgid(pwnam.pw_gid)
         os.setuid(pwnam.pw_uid)
 
-        # Redirect STDOUT and STDERR to file, close STDIN
-        stdout = sys.stdout
-        stderr = sys.stderr
-        sys.stdout = open(path + '/_stdout', 'a')
-        sys.stderr = open(path + '/_stderr', 'a')
+        # The notification channel belongs to the server process
+        if self.notification is not None:
+            self.notification.detach()
+
         sys.stdin.close()
 
         ## Ignore SIGINT - see note above proc.terminate()
@@ -310,11 +609,6 @@ class Dynamo(object):
         signal_converter = SignalConverter()
         signal_converter.set(signal.SIGTERM)
 
-        # Set argv
-        sys.argv = [path + '/exec.py']
-        if args:
-            sys.argv += args.split()
-
         # Reset logging
         # This is a rather hacky solution relying perhaps on the implementation internals of
         # the logging module. It might stop working with changes to the logging.
@@ -352,31 +646,39 @@ class Dynamo(object):
         executable.registry = self.registry
         executable.inventory = self.inventory
 
-        if queue is not None:
+    def _execute(self, path, args, channel = None):
+        """
+        Run the executable in the environment prepared by _setup_child.
+        """
+
+        # Redirect STDOUT and STDERR to file
+        stdout = sys.stdout
+        stderr = sys.stderr
+        sys.stdout = open(path + '/_stdout', 'a')
+        sys.stderr = open(path + '/_stderr', 'a')
+
+        # Set argv
+        sys.argv = [path + '/exec.py']
+        if args:
+            sys.argv += args.split()
+
+        import dynamo.core.executable as executable
+
+        if channel is not None:
             executable.read_only = False
-            # create a list of updated objects the executable can fill
-            executable.inventory._updated_objects = []
-            executable.inventory._deleted_objects = []
+            # updated and deleted objects are streamed to the server while the executable runs
+            executable.inventory.set_update_channel(channel)
 
         execfile(path + '/exec.py')
 
-        if queue is not None:
-            for obj in self.inventory._updated_objects:
-                try:
-                    queue.put((Dynamo.CMD_UPDATE, obj))
-                except:
-                    sys.stderr.write('Exception while sending updated %s\n' % str(obj))
-                    raise
-
-            for obj in self.inventory._deleted_objects:
-                try:
-                    queue.put((Dynamo.CMD_DELETE, obj))
-                except:
-                    sys.stderr.write('Exception while sending updated %s\n' % str(obj))
-                    raise
-            
-            # Put end-of-message
-            queue.put((Dynamo.CMD_EOM, None))
+        if channel is not None:
+            # Send the last batch and the end-of-message
+            # The executable may have stopped the updates with discard_updates(), but we still need to close the stream
+            try:
+                channel.close_stream()
+            except:
+                sys.stderr.write('Exception while sending updates\n')
+                raise
 
         # Queue stays available on the other end even if we terminate the process
 
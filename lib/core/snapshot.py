@@ -0,0 +1,385 @@
+import os
+import time
+import struct
+import hashlib
+import logging
+import cPickle as pickle
+
+from dynamo.dataformat import Dataset, Block, Site, SitePartition, Group, DatasetReplica, BlockReplica
+
+LOG = logging.getLogger(__name__)
+
+class SnapshotError(Exception):
+    """Exception to be raised when a snapshot is unusable (missing, stale, corrupt, or of a wrong version)."""
+    pass
+
+
+class InventorySnapshot(object):
+    """
+    Binary dump of the inventory content, used to restore the full object graph at startup
+    without streaming everything from the persistency store.
+    File layout:
+      header: magic, format version, creation time, payload length, md5 digest of the payload
+      payload: sequence of length-prefixed pickled chunks (section name, list of flat records)
+    The snapshot is valid only while the file exists. The server removes it whenever it writes
+    to the persistency store, writes a new one once the store was not modified for quiet_period
+    seconds, and writes one at shutdown.
+    """
+
+    MAGIC = 'DYNAMOSNAP'
+    VERSION = 1
+
+    _header = struct.Struct('!10sIdQ16s')
+    _chunk_length = struct.Struct('!I')
+
+    # number of datasets written in one pickled chunk
+    _CHUNK_SIZE = 1000
+
+    def __init__(self, config):
+        self.path = config.path
+        # the snapshot is first written here and moved to path by install()
+        self.tmp_path = self.path + '.tmp'
+        # snapshot files older than max_age seconds are considered stale (0 -> no limit)
+        self.max_age = config.get('max_age', 0)
+        # a new snapshot is written when the store content did not change for this many seconds
+        self.quiet_period = config.get('quiet_period', 30)
+
+        # time of the last invalidate()
+        self.last_change = 0
+
+    def is_valid(self):
+        return os.path.exists(self.path)
+
+    def need_write(self):
+        return not self.is_valid() and time.time() - self.last_change > self.quiet_period
+
+    def invalidate(self):
+        """Remove the snapshot file. Called whenever the persistency store content changes."""
+
+        self.last_change = time.time()
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def save(self, inventory, install = True):
+        """
+        Write the content of the inventory into the snapshot file. The file is written under a temporary
+        name and moved in place at the end.
+        @param inventory  DynamoInventory object
+        @param install    If False, leave the file under the temporary name. Call install() or discard() later.
+        """
+
+        LOG.info('Writing inventory snapshot to %s.', self.path)
+        start = time.time()
+
+        tmp_path = self.tmp_path
+
+        digest = hashlib.md5()
+        length = 0
+
+        with open(tmp_path, 'wb') as output:
+            # placeholder for the header
+            output.write('\0' * InventorySnapshot._header.size)
+
+            for section, records in self._make_records(inventory):
+                chunk = pickle.dumps((section, records), pickle.HIGHEST_PROTOCOL)
+                data = InventorySnapshot._chunk_length.pack(len(chunk)) + chunk
+
+                output.write(data)
+                digest.update(data)
+                length += len(data)
+
+            header = InventorySnapshot._header.pack(InventorySnapshot.MAGIC, InventorySnapshot.VERSION, time.time(), length, digest.digest())
+
+            output.seek(0)
+            output.write(header)
+
+        if install:
+            self.install()
+
+        LOG.info('Wrote inventory snapshot (%d bytes) in %.1f seconds.', length + InventorySnapshot._header.size, time.time() - start)
+
+    def install(self):
+        """Move the snapshot written by save(install = False) in place."""
+
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        """Remove the snapshot written by save(install = False)."""
+
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+    def load(self, inventory):
+        """
+        Fill the inventory from the snapshot file. Partitions must already be loaded.
+        Raises SnapshotError if the snapshot cannot be used. In such a case, the inventory
+        can be partially filled and must be cleared by the caller.
+        @param inventory  DynamoInventory object
+        """
+
+        try:
+            source = open(self.path, 'rb')
+        except IOError:
+            raise SnapshotError('Snapshot %s does not exist' % self.path)
+
+        with source:
+            header = source.read(InventorySnapshot._header.size)
+            if len(header) != InventorySnapshot._header.size:
+                raise SnapshotError('Truncated snapshot header')
+
+            magic, version, timestamp, length, checksum = InventorySnapshot._header.unpack(header)
+
+            if magic != InventorySnapshot.MAGIC:
+                raise SnapshotError('%s is not an inventory snapshot' % self.path)
+
+            if version != InventorySnapshot.VERSION:
+                raise SnapshotError('Snapshot version %d does not match the current version %d' % (version, InventorySnapshot.VERSION))
+
+            if self.max_age > 0 and time.time() - timestamp > self.max_age:
+                raise SnapshotError('Snapshot is stale (written at %s)' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)))
+
+            LOG.info('Loading inventory snapshot written at %s.', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)))
+
+            digest = hashlib.md5()
+            nread = 0
+
+            loader = _SnapshotLoader(inventory)
+
+            while nread != length:
+                data = source.read(InventorySnapshot._chunk_length.size)
+                if len(data) != InventorySnapshot._chunk_length.size:
+                    raise SnapshotError('Truncated snapshot payload')
+
+                chunk_length = InventorySnapshot._chunk_length.unpack(data)[0]
+                chunk = source.read(chunk_length)
+                if len(chunk) != chunk_length:
+                    raise SnapshotError('Truncated snapshot payload')
+
+                digest.update(data)
+                digest.update(chunk)
+                nread += len(data) + len(chunk)
+
+                if nread > length:
+                    raise SnapshotError('Snapshot payload is longer than declared')
+
+                try:
+                    section, records = pickle.loads(chunk)
+                except Exception as ex:
+                    raise SnapshotError('Corrupt snapshot chunk (%s)' % str(ex))
+
+                loader.fill(section, records)
+
+            if digest.digest() != checksum:
+                raise SnapshotError('Snapshot checksum mismatch')
+
+            loader.finalize()
+
+    def compare(self, inventory):
+        """
+        Load the snapshot into a separate object repository and compare it with the inventory (typically
+        loaded from the persistency store). Partition objects are shared with the inventory.
+        Raises SnapshotError if the snapshot cannot be used.
+        @param inventory  DynamoInventory object with the partitions loaded
+        @return  List of differences (strings). Empty if the snapshot reproduces the inventory.
+        """
+
+        # inventory module imports this module
+        from dynamo.core.inventory import ObjectRepository
+
+        repository = ObjectRepository()
+        for partition in inventory.partitions.itervalues():
+            repository.partitions.add(partition)
+
+        self.load(repository)
+
+        return compare_inventories(inventory, repository)
+
+    def _make_records(self, inventory):
+        """
+        Generator of (section, records) pairs. Records are flat tuples referring to other objects by name.
+        """
+
+        yield 'partitions', sorted(inventory.partitions.iterkeys())
+
+        yield 'groups', [(g.name, g.olevel.__name__) for g in inventory.groups.itervalues() if g.name is not None]
+
+        site_records = []
+        for site in inventory.sites.itervalues():
+            quotas = []
+            for partition, site_partition in site.partitions.iteritems():
+                if partition.subpartitions is None:
+                    quotas.append((partition.name, site_partition.quota))
+
+            site_records.append((site.name, site.host, site.storage_type, site.backend, site.storage, site.cpu, site.status, quotas))
+
+        yield 'sites', site_records
+
+        dataset_records = []
+        for dataset in inventory.datasets.itervalues():
+            block_index = {}
+            block_records = []
+            for block in dataset.blocks:
+                block_index[block] = len(block_records)
+                block_records.append((block.name, block.size, block.num_files, block.is_open, block.last_update))
+
+            replica_records = []
+            for replica in dataset.replicas:
+                block_replica_records = []
+                for br in replica.block_replicas:
+                    block_replica_records.append((block_index[br.block], br.group.name, br.is_complete, br.is_custodial, br.size, br.last_update))
+
+                replica_records.append((replica.site.name, block_replica_records))
+
+            dataset_records.append((dataset.name, dataset.size, dataset.num_files, dataset.status, dataset.data_type,
+                dataset.software_version, dataset.last_update, dataset.is_open, block_records, replica_records))
+
+            if len(dataset_records) == InventorySnapshot._CHUNK_SIZE:
+                yield 'datasets', dataset_records
+                dataset_records = []
+
+        if len(dataset_records) != 0:
+            yield 'datasets', dataset_records
+
+
+def compare_inventories(inventory1, inventory2):
+    """
+    Compare the content (groups, sites and quotas, datasets, blocks, and block replicas) of two object repositories.
+    @param inventory1  ObjectRepository
+    @param inventory2  ObjectRepository
+    @return  List of differences (strings).
+    """
+
+    differences = []
+
+    def common_keys(kind, keys1, keys2):
+        for key in sorted(keys1 - keys2):
+            differences.append('%s %s only in the first inventory' % (kind, key))
+        for key in sorted(keys2 - keys1):
+            differences.append('%s %s only in the second inventory' % (kind, key))
+
+        return sorted(keys1 & keys2)
+
+    def compare_attrs(kind, key, attrs1, attrs2):
+        if attrs1 != attrs2:
+            differences.append('%s %s differs: %s != %s' % (kind, key, repr(attrs1), repr(attrs2)))
+
+    def site_attrs(site):
+        quotas = sorted((p.name, sp.quota) for p, sp in site.partitions.iteritems() if p.subpartitions is None)
+        return (site.host, site.storage_type, site.backend, site.storage, site.cpu, site.status, quotas)
+
+    def dataset_attrs(dataset):
+        return (dataset.size, dataset.num_files, dataset.status, dataset.data_type, dataset.software_version, dataset.last_update, dataset.is_open)
+
+    def block_attrs(block):
+        return (block.size, block.num_files, block.is_open, block.last_update)
+
+    def replica_attrs(replica):
+        return sorted((br.block.real_name(), br.group.name, br.is_complete, br.is_custodial, br.size, br.last_update) for br in replica.block_replicas)
+
+    groups1 = inventory1.groups
+    groups2 = inventory2.groups
+    for name in common_keys('Group', set(groups1.iterkeys()), set(groups2.iterkeys())):
+        compare_attrs('Group', name, groups1[name].olevel, groups2[name].olevel)
+
+    sites1 = inventory1.sites
+    sites2 = inventory2.sites
+    for name in common_keys('Site', set(sites1.iterkeys()), set(sites2.iterkeys())):
+        compare_attrs('Site', name, site_attrs(sites1[name]), site_attrs(sites2[name]))
+
+    datasets1 = inventory1.datasets
+    datasets2 = inventory2.datasets
+    for name in common_keys('Dataset', set(datasets1.iterkeys()), set(datasets2.iterkeys())):
+        dataset1 = datasets1[name]
+        dataset2 = datasets2[name]
+
+        compare_attrs('Dataset', name, dataset_attrs(dataset1), dataset_attrs(dataset2))
+
+        blocks1 = dict((b.full_name(), b) for b in dataset1.blocks)
+        blocks2 = dict((b.full_name(), b) for b in dataset2.blocks)
+        for block_name in common_keys('Block', set(blocks1.iterkeys()), set(blocks2.iterkeys())):
+            compare_attrs('Block', block_name, block_attrs(blocks1[block_name]), block_attrs(blocks2[block_name]))
+
+        replicas1 = dict((r.site.name, r) for r in dataset1.replicas)
+        replicas2 = dict((r.site.name, r) for r in dataset2.replicas)
+        for site_name in common_keys('Replica of %s at' % name, set(replicas1.iterkeys()), set(replicas2.iterkeys())):
+            compare_attrs('Replica of %s at' % name, site_name, replica_attrs(replicas1[site_name]), replica_attrs(replicas2[site_name]))
+
+    return differences
+
+
+class _SnapshotLoader(object):
+    """Helper to construct inventory objects from snapshot records."""
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.sections = set()
+
+    def fill(self, section, records):
+        self.sections.add(section)
+
+        if section == 'partitions':
+            if sorted(self.inventory.partitions.iterkeys()) != records:
+                raise SnapshotError('Partition definitions changed since the snapshot was written')
+
+        elif section == 'groups':
+            for name, olname in records:
+                if olname == 'Dataset':
+                    olevel = Dataset
+                else:
+                    olevel = Block
+
+                self.inventory.groups[name] = Group(name, olevel)
+
+        elif section == 'sites':
+            for name, host, storage_type, backend, storage, cpu, status, quotas in records:
+                site = Site(name, host = host, storage_type = storage_type, backend = backend, storage = storage, cpu = cpu, status = status)
+                self.inventory.sites[name] = site
+
+                for partition in self.inventory.partitions.itervalues():
+                    site.partitions[partition] = SitePartition(site, partition)
+
+                for partition_name, quota in quotas:
+                    site.partitions[self.inventory.partitions[partition_name]].set_quota(quota)
+
+        elif section == 'datasets':
+            groups = self.inventory.groups
+            sites = self.inventory.sites
+
+            for name, size, num_files, status, data_type, software_version, last_update, is_open, block_records, replica_records in records:
+                dataset = Dataset(name, size = size, num_files = num_files, status = status, data_type = data_type,
+                    software_version = software_version, last_update = last_update, is_open = is_open)
+
+                self.inventory.datasets[name] = dataset
+
+                blocks = []
+                for block_name, block_size, block_num_files, block_is_open, block_last_update in block_records:
+                    block = Block(block_name, dataset, block_size, block_num_files, block_is_open, block_last_update)
+                    dataset.blocks.add(block)
+                    blocks.append(block)
+
+                for site_name, block_replica_records in replica_records:
+                    site = sites[site_name]
+                    dataset_replica = DatasetReplica(dataset, site)
+
+                    for iblock, group_name, is_complete, is_custodial, br_size, br_last_update in block_replica_records:
+                        block = blocks[iblock]
+                        block_replica = BlockReplica(block, site, groups[group_name], is_complete, is_custodial, br_size, br_last_update)
+
+                        dataset_replica.block_replicas.add(block_replica)
+                        block.replicas.add(block_replica)
+
+                    dataset.replicas.add(dataset_replica)
+                    site.add_dataset_replica(dataset_replica, add_block_replicas = True)
+
+        else:
+            raise SnapshotError('Unknown snapshot section %s' % section)
+
+    def finalize(self):
+        for section in ['partitions', 'groups', 'sites']:
+            if section not in self.sections:
+                raise SnapshotError('Section %s missing in snapshot' % section)
@@ -0,0 +1,147 @@
+import os
+import time
+import logging
+import multiprocessing
+
+LOG = logging.getLogger(__name__)
+
+class ReadOnlyWorkerPool(object):
+    """
+    Pool of pre-forked processes for read-only executables. A worker is forked from the server, sets up
+    the read-only environment (user, store and registry connections, preloaded modules), and waits for
+    one job on a pipe. Workers carry the inventory as of the moment of the fork; the pool must be
+    invalidated whenever the inventory changes, and is refilled afterwards.
+    Each worker runs exactly one job and exits. Idle workers that exit on their own within setup_time
+    seconds of the fork (e.g. failure in the setup) are counted; when max_failures of them exit in a row,
+    the pool stops forking for backoff seconds.
+    """
+
+    # a worker alive for this many seconds is considered set up
+    setup_time = 60
+
+    def __init__(self, size, target, max_failures = 5, backoff = 300):
+        """
+        @param size          Number of idle workers to keep.
+        @param target        Function executed in the worker. Called with the receiving end of the job pipe.
+        @param max_failures  Number of consecutive early worker exits that suspends the pool.
+        @param backoff       Seconds to suspend the pool for.
+        """
+
+        self.size = size
+        self._target = target
+
+        self.max_failures = max_failures
+        self.backoff = backoff
+
+        # idle workers [(proc, job_conn, start time)]
+        self._idle = []
+        # terminated idle workers to be reaped
+        self._retired = []
+
+        # consecutive idle workers that exited within setup_time
+        self._num_failures = 0
+        # no worker is forked until this time
+        self._suspended_until = 0
+
+    def fill(self):
+        """Replace dead idle workers and start new ones up to the pool size."""
+
+        # is_alive() reaps the exited processes
+        self._retired = [proc for proc in self._retired if proc.is_alive()]
+
+        now = time.time()
+
+        idle = []
+        for proc, conn, start in self._idle:
+            if proc.is_alive():
+                idle.append((proc, conn, start))
+                if now - start > ReadOnlyWorkerPool.setup_time:
+                    self._num_failures = 0
+            else:
+                LOG.warning('Read-only worker (PID %d) exited before receiving a job (exit code %d).', proc.pid, proc.exitcode)
+                conn.close()
+                if now - start < ReadOnlyWorkerPool.setup_time:
+                    self._num_failures += 1
+
+        self._idle = idle
+
+        if self._num_failures >= self.max_failures:
+            LOG.error('%d read-only workers exited in a row before receiving a job. Not forking workers for %d seconds.', self._num_failures, self.backoff)
+            self._num_failures = 0
+            self._suspended_until = time.time() + self.backoff
+
+        if time.time() < self._suspended_until:
+            return
+
+        while len(self._idle) < self.size:
+            recv_conn, send_conn = multiprocessing.Pipe(duplex = False)
+
+            proc = multiprocessing.Process(target = self._target, name = 'readonly-worker', args = (recv_conn,))
+            proc.daemon = True
+            proc.start()
+
+            recv_conn.close()
+
+            self._idle.append((proc, send_conn, time.time()))
+
+            LOG.debug('Started read-only worker (PID %d).', proc.pid)
+
+    def submit(self, title, path, args):
+        """
+        Hand a job to an idle worker.
+        @param title  Executable title (becomes the process name).
+        @param path   Executable path.
+        @param args   Executable arguments.
+        @return  The worker process, or None if no worker is available.
+        """
+
+        while len(self._idle) != 0:
+            proc, conn, _ = self._idle.pop(0)
+
+            try:
+                conn.send((path, args))
+            except (IOError, OSError):
+                # worker is gone
+                continue
+            finally:
+                conn.close()
+
+            proc.name = title
+            return proc
+
+        return None
+
+    def invalidate(self):
+        """Terminate all idle workers. Called when the inventory changes."""
+
+        if len(self._idle) == 0:
+            return
+
+        LOG.debug('Terminating %d read-only workers holding an outdated inventory.', len(self._idle))
+
+        self._terminate([proc for proc, _, _ in self._idle])
+
+        for _, conn, _ in self._idle:
+            conn.close()
+
+        self._idle = []
+
+    def close(self):
+        self.invalidate()
+
+        for proc in self._retired:
+            proc.join(5)
+
+        self._retired = []
+
+    def _terminate(self, procs):
+        # workers run under a different user
+        uid = os.geteuid()
+        os.seteuid(0)
+        try:
+            for proc in procs:
+                proc.terminate()
+        finally:
+            os.seteuid(uid)
+
+        self._retired.extend(procs)
@@ -4,6 +4,7 @@ import threading
 import weakref
 
 from exceptions import ObjectError
+from indexedset import IndexedSet
 
 class Block(object):
     """Smallest data unit for data management."""
@@ -71,7 +72,7 @@ class Block(object):
         self.is_open = is_open
         self.last_update = last_update
 
-        self.replicas = set()
+        self.replicas = IndexedSet('site.name') # indexed by site name
 
         self._files = None
 
@@ -124,7 +125,10 @@ class Block(object):
             # identical object -> return False if check is requested
             pass
         else:
+            old_size = block.size
             block.copy(self)
+            if block.size != old_size:
+                block._update_replica_occupancy(block.size - old_size)
             updated = True
 
         if check:
@@ -178,17 +182,22 @@ class Block(object):
                 return None
 
     def find_replica(self, site, must_find = False):
-        try:
-            if type(site) is str:
-                return next(r for r in self.replicas if r.site.name == site)
-            else:
-                return next(r for r in self.replicas if r.site == site)
+        if type(site) is str:
+            replica = self.replicas.find(site)
+        else:
+            replica = self.replicas.find(site.name)
+            if replica is not None and replica.site != site:
+                replica = None
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Cannot find replica at %s for %s', site.name, self.full_name())
-            else:
-                return None
+        if replica is None and must_find:
+            raise ObjectError('Cannot find replica at %s for %s', str(site), self.full_name())
+
+        return replica
+
+    def _update_replica_occupancy(self, size_change):
+        # projected occupancy of site partitions is computed from block sizes
+        for replica in self.replicas:
+            replica.site.resize_block_replica(replica, 0, size_change)
 
     def add_file(self, lfile):
         # this function can change block_replica.is_complete
@@ -199,6 +208,8 @@ class Block(object):
         self.size += lfile.size
         self.num_files += 1
 
+        self._update_replica_occupancy(lfile.size)
+
     def remove_file(self, lfile):
         # this function can change block_replica.is_complete
 
@@ -208,6 +219,8 @@ class Block(object):
         self.size -= lfile.size
         self.num_files -= 1
 
+        self._update_replica_occupancy(-lfile.size)
+
 #        for replica in self.replicas:
 #            if replica.files is not None:
 #                try:
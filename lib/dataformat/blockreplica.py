@@ -99,7 +99,10 @@ class BlockReplica(object):
             # identical object -> return False if check is requested
             pass
         else:
+            old_size = replica.size
             replica.copy(self)
+            if replica.size != old_size:
+                site.resize_block_replica(replica, replica.size - old_size, 0)
             site.update_partitioning(replica)
             updated = True
 
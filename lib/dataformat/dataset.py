@@ -2,6 +2,7 @@ import time
 import copy
 
 from exceptions import ObjectError
+from indexedset import IndexedSet
 
 class Dataset(object):
     """Represents a dataset."""
@@ -67,8 +68,8 @@ class Dataset(object):
         self.last_update = last_update # in UNIX time
         self.is_open = is_open
 
-        self.blocks = set()
-        self.replicas = set()
+        self.blocks = IndexedSet('name') # indexed by block name
+        self.replicas = IndexedSet('site.name') # indexed by site name
 
         # "transient" members - excluded in __getstate__
         self.attr = {} # freeform key-value pairs
@@ -159,13 +160,12 @@ class Dataset(object):
             store.save_dataset(self)
 
     def find_block(self, block_name, must_find = False):
-        try:
-            return next(b for b in self.blocks if b.name == block_name)
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Could not find block %s in %s', block_name, self._name)
-            else:
-                return None
+        block = self.blocks.find(block_name)
+
+        if block is None and must_find:
+            raise ObjectError('Could not find block %s in %s', block_name, self._name)
+
+        return block
 
     def find_file(self, path, must_find = False):
         for block in self.blocks:
@@ -179,17 +179,17 @@ class Dataset(object):
             return None
 
     def find_replica(self, site, must_find = False):
-        try:
-            if type(site) is str:
-                return next(r for r in self.replicas if r.site.name == site)
-            else:
-                return next(r for r in self.replicas if r.site == site)
+        if type(site) is str:
+            replica = self.replicas.find(site)
+        else:
+            replica = self.replicas.find(site.name)
+            if replica is not None and replica.site != site:
+                replica = None
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Could not find replica on %s of %s', str(site), self._name)
-            else:
-                return None
+        if replica is None and must_find:
+            raise ObjectError('Could not find replica on %s of %s', str(site), self._name)
+
+        return replica
 
     def add_block(self, block):
         self.blocks.add(block)
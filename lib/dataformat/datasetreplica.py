@@ -1,4 +1,5 @@
 from exceptions import ObjectError
+from indexedset import IndexedSet
 
 class DatasetReplica(object):
     """Represents a dataset replica. Just a container for block replicas."""
@@ -16,7 +17,7 @@ class DatasetReplica(object):
     def __init__(self, dataset, site):
         self._dataset = dataset
         self._site = site
-        self.block_replicas = set()
+        self.block_replicas = IndexedSet('block.name') # indexed by block name
 
     def __str__(self):
         return 'DatasetReplica %s:%s (%d block_replicas)' % \
@@ -155,18 +156,20 @@ class DatasetReplica(object):
                     return sum([r.block.size for r in self.block_replicas if r.group in groups])
 
     def find_block_replica(self, block, must_find = False):
-        try:
-            if type(block).__name__ == 'Block':
-                return next(b for b in self.block_replicas if b.block == block)
-            else:
-                return next(b for b in self.block_replicas if b.block.name == block)
+        if type(block).__name__ == 'Block':
+            block_replica = self.block_replicas.find(block.name)
+            if block_replica is not None and block_replica.block != block:
+                block_replica = None
+        else:
+            block_replica = self.block_replicas.find(block)
 
-        except StopIteration:
-            if must_find:
-                raise ObjectError('Cannot find block replica %s/%s', self._site.name, block.full_name())
-            else:
-                return None
+        if block_replica is None and must_find:
+            raise ObjectError('Cannot find block replica %s/%s', self._site.name, str(block))
+
+        return block_replica
 
     def remove_block_replica(self, block_replica):
+        # take the block replica out of the site partitions first so the occupancy is updated
+        self._site.remove_block_replica(block_replica)
         self.block_replicas.remove(block_replica)
         self._site.update_partitioning(self)
@@ -0,0 +1,140 @@
+import operator
+
+class IndexedSet(set):
+    """
+    A set of objects with a dict index {key: object} for constant-time lookups.
+    The key of an object is given by an attribute path (e.g. 'site.name') and must not change
+    while the object is in the set. Operations that create a new set return a plain set.
+    """
+
+    __slots__ = ['_key_attr', '_key', '_index']
+
+    def __init__(self, key_attr, iterable = ()):
+        set.__init__(self, iterable)
+
+        self._key_attr = key_attr
+        self._key = operator.attrgetter(key_attr)
+        # Index is built at the first lookup. This way the elements need not be fully
+        # constructed when the set is filled (e.g. during unpickling).
+        self._index = None
+
+    def __reduce__(self):
+        return (self.__class__, (self._key_attr, list(self)))
+
+    def find(self, key):
+        """
+        Return the object with the given key or None.
+        """
+
+        if self._index is None:
+            getkey = self._key
+            self._index = dict((getkey(obj), obj) for obj in self)
+
+        return self._index.get(key)
+
+    def add(self, obj):
+        set.add(self, obj)
+
+        if self._index is not None:
+            self._index[self._key(obj)] = obj
+
+    def remove(self, obj):
+        set.remove(self, obj)
+        self._unindex(obj)
+
+    def discard(self, obj):
+        if obj in self:
+            self.remove(obj)
+
+    def pop(self):
+        obj = set.pop(self)
+        self._unindex(obj)
+        return obj
+
+    def clear(self):
+        set.clear(self)
+        self._index = None
+
+    def update(self, *others):
+        for other in others:
+            for obj in other:
+                self.add(obj)
+
+    def difference_update(self, *others):
+        set.difference_update(self, *others)
+        self._index = None
+
+    def intersection_update(self, *others):
+        set.intersection_update(self, *others)
+        self._index = None
+
+    def symmetric_difference_update(self, other):
+        set.symmetric_difference_update(self, other)
+        self._index = None
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def copy(self):
+        return set(self)
+
+    def union(self, *others):
+        return set(self).union(*others)
+
+    def intersection(self, *others):
+        return set(self).intersection(*others)
+
+    def difference(self, *others):
+        return set(self).difference(*others)
+
+    def symmetric_difference(self, other):
+        return set(self).symmetric_difference(other)
+
+    def __or__(self, other):
+        return set(self) | other
+
+    def __and__(self, other):
+        return set(self) & other
+
+    def __sub__(self, other):
+        return set(self) - other
+
+    def __xor__(self, other):
+        return set(self) ^ other
+
+    def __ror__(self, other):
+        return other | set(self)
+
+    def __rand__(self, other):
+        return other & set(self)
+
+    def __rsub__(self, other):
+        return other - set(self)
+
+    def __rxor__(self, other):
+        return other ^ set(self)
+
+    def _unindex(self, obj):
+        if self._index is None:
+            return
+
+        key = self._key(obj)
+        if self._index.get(key) is obj:
+            self._index.pop(key)
+
+        if len(self._index) != len(self):
+            # there were multiple objects with the same key
+            self._index = None
@@ -132,20 +132,20 @@ class Site(object):
 
             # Special case: automatically createing new site partitions.
             # In write-enabled applications, inventory will add the newly created
-            # site clone into _updated_objects after this function returns.
-            # To have site partitions also added to _updated_objects *after* the
+            # site clone into the update stream after this function returns.
+            # To have site partitions also added to the update stream *after* the
             # site is added to the list, we need to call the update() back from within.
 
             # Just set some value off so updated is triggered
             site.status = self.status + 1
             inventory.update(self)
 
-            # Now site is saved in inventory._updated_objects
+            # Now site is in the update stream
 
             for partition in inventory.partitions.itervalues():
                 inventory.update(SitePartition(site, partition))
 
-            # Reporting updated = True causes the site to be added to _updated_objects twice,
+            # Reporting updated = True causes the site to be added to the update stream twice,
             # but this is the only way to trigger writing update by the server
             updated = True
             # site_partitions will always be written in Site.write_into.
@@ -206,14 +206,14 @@ class Site(object):
             else:
                 return dataset_replica.find_block_replica(block, must_find = must_find)
         else:
-            # lookup by block name - very inefficient operation
+            # lookup by block name - need to go through all dataset replicas at the site
             for dataset_replica in self._dataset_replicas.itervalues():
-                for block_replica in dataset_replica.block_replicas:
-                    if block_replica.block.name == block:
-                        return block_replica
+                block_replica = dataset_replica.find_block_replica(block)
+                if block_replica is not None:
+                    return block_replica
 
             if must_find:
-                raise ObjectError('Could not find replica of %s in %s', block.full_name(), self._name)
+                raise ObjectError('Could not find replica of %s in %s', str(block), self._name)
             else:
                 return None
 
@@ -225,6 +225,16 @@ class Site(object):
 
         if add_block_replicas:
             for partition, site_partition in self.partitions.iteritems():
+                try:
+                    existing = site_partition.replicas.pop(replica)
+                except KeyError:
+                    pass
+                else:
+                    # replica is being added again - take out the old content
+                    if existing is None:
+                        existing = replica.block_replicas
+                    site_partition.subtract_occupancy(existing)
+
                 block_replicas = set()
                 for block_replica in replica.block_replicas:
                     if partition.contains(block_replica):
@@ -232,6 +242,8 @@ class Site(object):
     
                 if len(block_replicas) == 0:
                     continue
+
+                site_partition.add_occupancy(block_replicas)
     
                 if block_replicas == replica.block_replicas:
                     site_partition.replicas[replica] = None
@@ -265,12 +277,17 @@ class Site(object):
                     # assume this function was called for all new block replicas
                     # then we are just adding another replica to this partition
                     pass
+                elif replica in block_replica_list:
+                    # already accounted for
+                    continue
                 else:
                     # again assuming this function is called for all new block replicas,
                     # block_replica_list not being None implies that adding this new
                     # replica will not make the dataset replica in this partition complete
                     block_replica_list.add(replica)
 
+            site_partition.add_occupancy((replica,))
+
     def update_partitioning(self, replica):
         for partition, site_partition in self.partitions.iteritems():
             if type(replica).__name__ == 'DatasetReplica':
@@ -285,9 +302,14 @@ class Site(object):
                 if block_replicas is None:
                     # previously, was all contained - need to check again
                     block_replicas = set()
+                    excluded_replicas = []
                     for block_replica in replica.block_replicas:
                         if partition.contains(block_replica):
                             block_replicas.add(block_replica)
+                        else:
+                            excluded_replicas.append(block_replica)
+
+                    site_partition.subtract_occupancy(excluded_replicas)
 
                     if block_replicas != replica.block_replicas:
                         site_partition.replicas[replica] = block_replicas
@@ -297,17 +319,20 @@ class Site(object):
                 # remove block replicas that were deleted
                 deleted_replicas = block_replicas - replica.block_replicas
                 block_replicas -= deleted_replicas
+                site_partition.subtract_occupancy(deleted_replicas)
 
                 # reevaluate existing block replicas
                 for block_replica in list(block_replicas):
                     if not partition.contains(block_replica):
                         block_replicas.remove(block_replica)
+                        site_partition.subtract_occupancy((block_replica,))
 
                 # add new block replicas
                 new_replicas = replica.block_replicas - block_replicas
                 for block_replica in new_replicas:
                     if partition.contains(block_replica):
                         block_replicas.add(block_replica)
+                        site_partition.add_occupancy((block_replica,))
                
                 if len(block_replicas) == 0:
                     try:
@@ -337,13 +362,16 @@ class Site(object):
                         pass
                     else:
                         block_replicas.add(replica)
+                        site_partition.add_occupancy((replica,))
                 else:
                     if block_replicas is None:
                         # this dataset replica used to be fully included but now it's not
                         block_replicas = set(dataset_replica.block_replicas)
                         block_replicas.remove(replica)
+                        site_partition.subtract_occupancy((replica,))
                     elif replica in block_replicas:
                         block_replicas.remove(replica)
+                        site_partition.subtract_occupancy((replica,))
 
                 if len(block_replicas) == 0:
                     try:
@@ -355,14 +383,44 @@ class Site(object):
                 else:
                     site_partition.replicas[dataset_replica] = block_replicas
 
+    def resize_block_replica(self, replica, physical_change, projected_change):
+        """
+        Propagate a change of the block replica size (physical) or the block size (projected)
+        to the occupancy of the partitions containing the replica. Call before update_partitioning.
+        """
+
+        try:
+            dataset_replica = self._dataset_replicas[replica.block.dataset]
+        except KeyError:
+            return
+
+        for site_partition in self.partitions.itervalues():
+            try:
+                block_replicas = site_partition.replicas[dataset_replica]
+            except KeyError:
+                continue
+
+            if block_replicas is None:
+                if replica not in dataset_replica.block_replicas:
+                    continue
+            elif replica not in block_replicas:
+                continue
+
+            site_partition.resize_occupancy(physical_change, projected_change)
+
     def remove_dataset_replica(self, replica):
         self._dataset_replicas.pop(replica.dataset)
 
         for site_partition in self.partitions.itervalues():
             try:
-                site_partition.replicas.pop(replica)
+                block_replicas = site_partition.replicas.pop(replica)
             except KeyError:
-                pass
+                continue
+
+            if block_replicas is None:
+                block_replicas = replica.block_replicas
+
+            site_partition.subtract_occupancy(block_replicas)
 
     def remove_block_replica(self, replica):
         dataset_replica = self._dataset_replicas[replica.block.dataset]
@@ -374,6 +432,14 @@ class Site(object):
                 continue
 
             if block_replicas is None:
+                if replica not in dataset_replica.block_replicas:
+                    # already taken out of the dataset replica
+                    continue
+
                 block_replicas = site_partition.replicas[dataset_replica] = set(dataset_replica.block_replicas)
 
+            elif replica not in block_replicas:
+                continue
+
             block_replicas.remove(replica)
+            site_partition.subtract_occupancy((replica,))
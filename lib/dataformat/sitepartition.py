@@ -1,11 +1,19 @@
 import sys
 
-from exceptions import IntegrityError
+from exceptions import IntegrityError, ObjectError
 
 class SitePartition(object):
-    """State of a partition at a site."""
+    """
+    State of a partition at a site.
+    The total physical and projected sizes of the block replicas in the partition are kept as running
+    counters, updated by the Site methods that change the partition content. Code that fills the
+    replicas dict directly must call recompute_occupancy() afterwards.
+    """
 
-    __slots__ = ['_site', '_partition', '_quota', 'replicas']
+    __slots__ = ['_site', '_partition', '_quota', 'replicas', '_occupancy_physical', '_occupancy_projected']
+
+    # If True, occupancy counters are cross-checked against a full recount at each occupancy_fraction call.
+    check_occupancy = False
 
     @property
     def site(self):
@@ -38,6 +46,9 @@ class SitePartition(object):
         self._quota = quota
         # {dataset_replica: set(block_replicas) or None (if all blocks are in)}
         self.replicas = {}
+        # sum of block replica sizes and block sizes in the partition
+        self._occupancy_physical = 0
+        self._occupancy_projected = 0
 
     def __str__(self):
         return 'SitePartition %s/%s (quota=%f TB, occupancy %s)' % (self._site.name, self._partition.name, \
@@ -128,16 +139,55 @@ class SitePartition(object):
         elif quota < 0.:
             return 0.
         else:
-            total_size = 0.
-            for replica, block_replicas in self.replicas.iteritems():
-                if block_replicas is None:
-                    total_size += replica.size(physical = physical)
-                elif physical:
-                    total_size += sum(br.size for br in block_replicas)
-                else:
-                    total_size += sum(br.block.size for br in block_replicas)
-
-            return total_size / quota
+            if SitePartition.check_occupancy:
+                self._check_occupancy()
+
+            if physical:
+                return float(self._occupancy_physical) / quota
+            else:
+                return float(self._occupancy_projected) / quota
+
+    def add_occupancy(self, block_replicas):
+        """Add the sizes of block replicas newly included in the partition to the occupancy counters."""
+
+        for block_replica in block_replicas:
+            self._occupancy_physical += block_replica.size
+            self._occupancy_projected += block_replica.block.size
+
+    def subtract_occupancy(self, block_replicas):
+        """Subtract the sizes of block replicas taken out of the partition from the occupancy counters."""
+
+        for block_replica in block_replicas:
+            self._occupancy_physical -= block_replica.size
+            self._occupancy_projected -= block_replica.block.size
+
+    def resize_occupancy(self, physical_change, projected_change):
+        self._occupancy_physical += physical_change
+        self._occupancy_projected += projected_change
+
+    def recompute_occupancy(self):
+        """Set the occupancy counters from a full recount of the partition content."""
+
+        self._occupancy_physical, self._occupancy_projected = self._count_occupancy()
+
+    def _count_occupancy(self):
+        physical = 0
+        projected = 0
+        for replica, block_replicas in self.replicas.iteritems():
+            if block_replicas is None:
+                block_replicas = replica.block_replicas
+
+            for block_replica in block_replicas:
+                physical += block_replica.size
+                projected += block_replica.block.size
+
+        return physical, projected
+
+    def _check_occupancy(self):
+        physical, projected = self._count_occupancy()
+        if physical != self._occupancy_physical or projected != self._occupancy_projected:
+            raise IntegrityError('Occupancy counters of %s/%s (physical %d, projected %d) do not match the recount (physical %d, projected %d)' % \
+                (self._site.name, self._partition.name, self._occupancy_physical, self._occupancy_projected, physical, projected))
 
     def embed_tree(self, inventory):
         if self._partition._subpartitions is not None:
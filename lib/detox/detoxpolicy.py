@@ -1,4 +1,6 @@
+import os
 import logging
+import cPickle as pickle
 
 from dynamo.dataformat import ConfigurationError
 import dynamo.policy.variables as variables
@@ -98,7 +100,12 @@ class PolicyLine(object):
 
 
 class DetoxPolicy(object):
-    def __init__(self, config):
+    def __init__(self, config, policy_file = None):
+        """
+        @param config       Detox configuration
+        @param policy_file  Path to the policy file. If None, config.policy_file is used.
+        """
+
         # Classes from dynamo.policy.producers that provide dataset attrs necessary for
         # policy evaluation.
         self.attr_producers = []
@@ -106,9 +113,20 @@ class DetoxPolicy(object):
         # Iterative deletion can be turned off in specific policy files. When this is False,
         # Detox will finalize the delete and protect list in the first iteration.
         self.iterative_deletion = True
+
+        # Policy line conditions are compiled into Python functions. When this is True, the
+        # compiled functions are cross-checked against the interpreted predicates (slow).
+        self.check_compiled_conditions = config.get('check_compiled_conditions', False)
+
+        # When this is True, the results of evaluate_parallel are cross-checked against the serial
+        # evaluation in the main process (slow).
+        self.check_parallel_evaluation = config.get('check_parallel_evaluation', False)
         
         LOG.info('Reading the policy file.')
-        with open(config.policy_file) as policy_def:
+        if policy_file is None:
+            policy_file = config.policy_file
+
+        with open(policy_file) as policy_def:
             self.parse_lines(policy_def, config.attrs)
         
         # Special config - shift time-based policies by config.time_shift days for simulation
@@ -118,6 +136,9 @@ class DetoxPolicy(object):
                     if type(pred) is predicates.BinaryExpr and pred.variable.vtype == attrs.Attr.TIME_TYPE:
                         pred.rhs += config.time_shift * 24. * 3600.
 
+                # the compiled function binds the rhs values
+                line.condition.compile(check = self.check_compiled_conditions)
+
         self.version = config.policy_version
 
         # Check if the replicas can be deleted just before making the deletion requests.
@@ -190,7 +211,9 @@ class DetoxPolicy(object):
                     if len(words) == 1:
                         self.default_decision = decision
                     else:
-                        self.policy_lines.append(PolicyLine(decision, cond_text))
+                        policy_line = PolicyLine(decision, cond_text)
+                        policy_line.condition.compile(check = self.check_compiled_conditions)
+                        self.policy_lines.append(policy_line)
 
                 elif line_type == LINE_ORDER:
                     self.candidate_sort_key = SortKey(cond_text)
@@ -208,6 +231,13 @@ class DetoxPolicy(object):
         if self.default_decision == None:
             raise ConfigurationError('Default decision not given')
 
+        # Dependency scopes of the variables in the policy lines. Detox uses them to decide which
+        # replicas to re-evaluate after a deletion.
+        self.variable_scopes = set()
+        for line in self.policy_lines:
+            for pred in line.condition.predicates:
+                self.variable_scopes.add(pred.variable.scope)
+
         # Collect attr names from all conditions and sortkey, instantiate the plugins
         attr_names = set()
 
@@ -261,10 +291,188 @@ class DetoxPolicy(object):
                     replica.block_replicas.remove(block_replica)
                     block_replicas_tmp.add(block_replica)
 
+                # values memoized for the full replica do not apply any more
+                attrs.value_cache.invalidate(replica.dataset)
+
         else:
             actions.append(self.default_decision.action(None))
 
         # return the block replicas
-        replica.block_replicas.update(block_replicas_tmp)
+        if len(block_replicas_tmp) != 0:
+            replica.block_replicas.update(block_replicas_tmp)
+            attrs.value_cache.invalidate(replica.dataset)
         
         return actions
+
+    def evaluate_parallel(self, replicas, num_processes):
+        """
+        Evaluate the replicas in forked processes. Replicas are sharded by dataset, so that the values
+        memoized per dataset are computed in one process only. The workers see the inventory as of the fork
+        and send back the index of the matched line and the names of the matched blocks for each action.
+        Workers are forked with os.fork() because Detox itself runs in a daemonic process, which cannot
+        have multiprocessing children.
+        @param replicas       Collection of dataset replicas
+        @param num_processes  Number of worker processes
+        @return {replica: list of actions}, same as calling evaluate() on each replica.
+        """
+
+        # deterministic sharding
+        shards = [[] for _ in xrange(num_processes)]
+        by_dataset = {}
+        for replica in replicas:
+            try:
+                by_dataset[replica.dataset.name].append(replica)
+            except KeyError:
+                by_dataset[replica.dataset.name] = [replica]
+
+        for idat, dataset_name in enumerate(sorted(by_dataset.iterkeys())):
+            shards[idat % num_processes].extend(by_dataset[dataset_name])
+
+        shards = [shard for shard in shards if len(shard) != 0]
+
+        workers = [] # [(pid, read end of the pipe)]
+        for shard in shards:
+            read_fd, write_fd = os.pipe()
+
+            pid = os.fork()
+            if pid == 0:
+                # worker process - never returns
+                exit_code = 1
+                try:
+                    os.close(read_fd)
+                    for _, fd in workers:
+                        os.close(fd)
+
+                    if self._evaluate_shard(shard, write_fd):
+                        exit_code = 0
+                finally:
+                    os._exit(exit_code)
+
+            os.close(write_fd)
+            workers.append((pid, read_fd))
+
+        # receive all results before waiting, otherwise the workers can block on a full pipe
+        shard_data = []
+        for _, read_fd in workers:
+            chunks = []
+            with os.fdopen(read_fd, 'rb') as source:
+                while True:
+                    chunk = source.read(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+
+            shard_data.append(''.join(chunks))
+
+        failed = False
+        for pid, _ in workers:
+            _, status = os.waitpid(pid, 0)
+            if status != 0:
+                failed = True
+
+        if failed:
+            raise RuntimeError('Policy evaluation failed in a worker process')
+
+        results = {}
+
+        for shard, data in zip(shards, shard_data):
+            for replica, encoded_actions in zip(shard, pickle.loads(data)):
+                results[replica] = self._decode_actions(replica, encoded_actions)
+
+        if self.check_parallel_evaluation:
+            self._check_parallel_results(results)
+
+        return results
+
+    def _evaluate_shard(self, replicas, fd):
+        """
+        Worker process function of evaluate_parallel. Writes a pickled list of encoded actions per replica to fd.
+        Actions are encoded as (line index, block names or None); line index is -1 for the default decision.
+        @return  True if the evaluation succeeded.
+        """
+
+        line_index = dict((line, iline) for iline, line in enumerate(self.policy_lines))
+
+        try:
+            shard_result = []
+            for replica in replicas:
+                encoded_actions = []
+                for action in self.evaluate(replica):
+                    if action.matched_line is None:
+                        iline = -1
+                    else:
+                        iline = line_index[action.matched_line]
+
+                    if isinstance(action, BlockAction):
+                        block_names = tuple(br.block.name for br in action.block_replicas)
+                    else:
+                        block_names = None
+
+                    encoded_actions.append((iline, block_names))
+
+                shard_result.append(encoded_actions)
+
+        except:
+            LOG.exception('Error in policy evaluation')
+            os.close(fd)
+            return False
+
+        with os.fdopen(fd, 'wb') as output:
+            pickle.dump(shard_result, output, pickle.HIGHEST_PROTOCOL)
+
+        return True
+
+    def _check_parallel_results(self, results):
+        """
+        Evaluate the replicas again in this process and compare with the results of evaluate_parallel.
+        Disagreements are logged, and the serial results are used.
+        @param results  {replica: list of actions}, updated in place
+        """
+
+        def signature(actions):
+            sig = []
+            for action in actions:
+                if isinstance(action, BlockAction):
+                    block_names = frozenset(br.block.name for br in action.block_replicas)
+                else:
+                    block_names = None
+
+                sig.append((type(action), action.matched_line, block_names))
+
+            return sig
+
+        num_mismatch = 0
+
+        for replica, actions in results.iteritems():
+            serial_actions = self.evaluate(replica)
+            if signature(actions) != signature(serial_actions):
+                LOG.error('Parallel policy evaluation disagrees with the serial result for %s:%s', replica.site.name, replica.dataset.name)
+                results[replica] = serial_actions
+                num_mismatch += 1
+
+        if num_mismatch == 0:
+            LOG.info('Parallel policy evaluation agrees with the serial result for %d replicas.', len(results))
+
+    def _decode_actions(self, replica, encoded_actions):
+        actions = []
+
+        for iline, block_names in encoded_actions:
+            if iline == -1:
+                actions.append(self.default_decision.action(None))
+                continue
+
+            line = self.policy_lines[iline]
+            line.has_match = True
+
+            if block_names is None:
+                if issubclass(line.decision.action_cls, BlockAction):
+                    # block-level line matching all blocks
+                    actions.append(line.decision.action_cls.dataset_level(line))
+                else:
+                    actions.append(line.decision.action(line))
+            else:
+                block_names = set(block_names)
+                block_replicas = [br for br in replica.block_replicas if br.block.name in block_names]
+                actions.append(line.decision.action(line, block_replicas))
+
+        return actions
@@ -2,17 +2,216 @@ import sys
 import time
 import logging
 import collections
+import heapq
 
-from dynamo.core.inventory import ObjectRepository
-from dynamo.dataformat import Group, Site, Dataset, Block, DatasetReplica, BlockReplica
+from dynamo.dataformat import Group, Site, Dataset, BlockReplica
 from dynamo.detox.detoxpolicy import DetoxPolicy
+from dynamo.detox.partitionview import PartitionView
 from dynamo.detox.detoxpolicy import Ignore, Protect, Delete, Dismiss, ProtectBlock, DeleteBlock, DismissBlock
+from dynamo.policy.attrs import Attr, value_cache
 import dynamo.operation.impl as operation_impl
 import dynamo.history.impl as history_impl
 from dynamo.utils.signaling import SignalBlocker
 
 LOG = logging.getLogger(__name__)
 
+class DecisionCache(object):
+    """
+    Policy evaluation results (lists of actions) of dataset replicas, reused across the iterations of
+    Detox._execute_policy. A result becomes stale when an object in the dependency scopes of the policy
+    variables (the replica itself, its dataset, or its site) is modified after the evaluation.
+    Modifications are ordered by a counter and compared with the time of evaluation. If the policy depends
+    on global quantities, results are valid only until the next modification of any replica.
+    """
+
+    def __init__(self, scopes):
+        """
+        @param scopes  Set of Attr.SCOPE_* of the variables in the policy.
+        """
+
+        self._reevaluate_all = (Attr.SCOPE_GLOBAL in scopes)
+        self._check_replica = (Attr.SCOPE_REPLICA in scopes)
+        self._check_dataset = (Attr.SCOPE_DATASET in scopes)
+        self._check_site = (Attr.SCOPE_SITE in scopes)
+
+        self._clock = 0
+        # last modification times
+        self._replica_modified = {} # {replica: clock}
+        self._dataset_modified = {} # {dataset: clock}
+        self._site_modified = {} # {site: clock}
+        self._actions = {} # {replica: (clock, actions)}
+
+    def get(self, replica):
+        """
+        Return the cached list of actions, or None if the replica needs to be evaluated.
+        """
+
+        try:
+            evaluated, actions = self._actions[replica]
+        except KeyError:
+            return None
+
+        if self._reevaluate_all:
+            if self._clock > evaluated:
+                return None
+            else:
+                return actions
+
+        if self._check_replica and self._replica_modified.get(replica, 0) > evaluated:
+            return None
+        if self._check_dataset and self._dataset_modified.get(replica.dataset, 0) > evaluated:
+            return None
+        if self._check_site and self._site_modified.get(replica.site, 0) > evaluated:
+            return None
+
+        return actions
+
+    def set(self, replica, actions):
+        self._actions[replica] = (self._clock, actions)
+
+    def set_modified(self, replica):
+        """
+        Record a change to the block replicas of the replica.
+        """
+
+        self._clock += 1
+        self._replica_modified[replica] = self._clock
+        self._dataset_modified[replica.dataset] = self._clock
+        self._site_modified[replica.site] = self._clock
+
+        # derived values memoized for the dataset are also stale
+        value_cache.invalidate(replica.dataset)
+
+class CandidateQueue(object):
+    """
+    Deletion candidates at a site, ordered by the policy sort key. The queue persists across the iterations
+    of Detox._execute_policy. Keys are computed when a replica is pushed and recomputed only through
+    update(); outdated heap entries are skipped when they come to the top.
+    """
+
+    def __init__(self, sort_key):
+        self._sort_key = sort_key
+        self._heap = [] # [(key, dataset name, replica)]
+        self._keys = {} # {replica: current key}
+        # replicas returned by iterate() and not pushed back yet
+        self._popped = []
+
+    def add(self, replica):
+        if replica not in self._keys:
+            self._push(replica)
+
+    def update(self, replica):
+        """Recompute the key of a replica already in the queue."""
+
+        if replica in self._keys:
+            self._push(replica)
+
+    def update_all(self):
+        replicas = self._keys.keys()
+        self._heap = []
+        self._keys = {}
+        for replica in replicas:
+            self._push(replica)
+
+    def iterate(self, candidates):
+        """
+        Generator of replicas in the order of the key. Replicas not in candidates are dropped from the queue.
+        Call restore() after the iteration to put the yielded replicas back.
+        @param candidates  Dict or set of current deletion candidates.
+        """
+
+        while len(self._heap) != 0:
+            key, _, replica = heapq.heappop(self._heap)
+            if self._keys.get(replica) != key:
+                # outdated entry
+                continue
+
+            self._keys.pop(replica)
+
+            if replica not in candidates:
+                continue
+
+            self._popped.append(replica)
+            yield replica
+
+    def restore(self):
+        """Push back the replicas yielded by iterate() that still have block replicas."""
+
+        for replica in self._popped:
+            if len(replica.block_replicas) != 0:
+                self._push(replica)
+
+        self._popped = []
+
+    def _push(self, replica):
+        key = self._sort_key(replica)
+        if self._keys.get(replica) == key:
+            return
+
+        self._keys[replica] = key
+        # dataset name is unique within a site and breaks the ties
+        heapq.heappush(self._heap, (key, replica.dataset.name, replica))
+
+class SiteQueue(object):
+    """
+    Sites ordered by the fraction of the partition quota occupied by protected block replicas, in
+    decreasing order. The protected volume is accumulated through add_volume().
+    """
+
+    def __init__(self, quotas):
+        """
+        @param quotas  {site: partition quota}
+        """
+
+        self._quotas = quotas
+        self._volumes = dict((site, 0) for site in quotas.iterkeys())
+        self._fractions = {} # {site: current fraction}
+        self._heap = [] # [(-fraction, site name, site)]
+
+        for site in quotas.iterkeys():
+            self._push(site)
+
+    def add_volume(self, site, volume):
+        self._volumes[site] += volume
+        self._push(site)
+
+    def select(self, sites):
+        """Return the site with the highest protected fraction among the given sites."""
+
+        selected = None
+        entries = []
+
+        while len(self._heap) != 0:
+            entry = heapq.heappop(self._heap)
+            neg_fraction, _, site = entry
+            if self._fractions[site] != -neg_fraction:
+                # outdated entry
+                continue
+
+            entries.append(entry)
+
+            if site in sites:
+                selected = site
+                break
+
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+
+        return selected
+
+    def _push(self, site):
+        quota = self._quotas[site]
+        if quota > 0.:
+            fraction = float(self._volumes[site]) / quota
+        else:
+            fraction = 1.
+
+        if self._fractions.get(site) == fraction:
+            return
+
+        self._fractions[site] = fraction
+        heapq.heappush(self._heap, (-fraction, site.name, site))
+
 class Detox(object):
 
     def __init__(self, config):
@@ -24,18 +223,67 @@ class Detox(object):
         self.copy_op = getattr(operation_impl, config.copy_op.module)(config.copy_op.config)
         self.history = getattr(history_impl, config.history.module)(config.history.config)
 
-        self.policy = DetoxPolicy(config)
+        # config.policy_file can be a list of policy files, which are executed in one run
+        if type(config.policy_file) is list:
+            policy_files = config.policy_file
+        else:
+            policy_files = [config.policy_file]
+
+        self.policies = [DetoxPolicy(config, policy_file) for policy_file in policy_files]
+
+        # The policy being executed
+        self.policy = self.policies[0]
+
+        # Partition-independent source data of the attr producers, fetched once per run
+        self.attr_source_data = {} # {producer type: data}
 
         self.deletion_per_iteration = config.deletion_per_iteration
 
+        # Number of processes for the first evaluation of the policy
+        self.num_evaluation_processes = config.get('num_evaluation_processes', 1)
+
     def run(self, inventory, comment = '', create_cycle = True):
         """
-        Main executable.
+        Main executable. The policies are executed one after another, each with its own deletion cycle.
+        Source data of the attr producers (access records, locks, request weights) are read once and
+        shared by the policies; the attrs themselves are computed per partition.
         @param inventory    Dynamo inventory
         @param comment      Passed to dynamo history
         @param create_cycle If True, assign a cycle number and make a permanent record in the history.
         """
 
+        LOG.info('Fetching dataset attribute source data.')
+        self.attr_source_data = {}
+        for policy in self.policies:
+            for plugin in policy.attr_producers:
+                producer_type = type(plugin)
+                if producer_type not in self.attr_source_data and hasattr(plugin, 'fetch'):
+                    self.attr_source_data[producer_type] = plugin.fetch(inventory)
+
+        failed_partitions = []
+
+        for policy in self.policies:
+            self.policy = policy
+            try:
+                self._run_partition(inventory, comment, create_cycle)
+            except Exception:
+                if len(self.policies) == 1:
+                    raise
+
+                # do not let one partition stop the others
+                LOG.error('Detox cycle for %s failed.', policy.partition_name, exc_info = True)
+                failed_partitions.append(policy.partition_name)
+
+        self.attr_source_data = {}
+
+        if len(failed_partitions) != 0:
+            raise RuntimeError('Detox cycle failed for partitions %s' % ' '.join(failed_partitions))
+
+    def _run_partition(self, inventory, comment, create_cycle):
+        """
+        Execute self.policy and commit the decisions.
+        """
+
         if create_cycle:
             # fetch the deletion cycle number
             cycle_tag = self.history.new_deletion_run(self.policy.partition_name, self.policy.version, comment = comment)
@@ -45,23 +293,41 @@ class Detox(object):
             LOG.info('Detox snapshot cycle for %s starting', self.policy.partition_name)
 
         LOG.info('Building the object repository for the partition.')
-        # Create a full clone of the inventory limited to the partition of the policy
+        # Create a view of the inventory limited to the partition of the policy
         partition_repository = self._build_partition(inventory)
 
-        LOG.info('Loading dataset attributes.')
-        for plugin in self.policy.attr_producers:
-            plugin.load(partition_repository)
+        try:
+            # Attrs are computed per partition; producers see only the replicas in the partition at the target sites
+            LOG.info('Loading dataset attributes.')
+            for plugin in self.policy.attr_producers:
+                try:
+                    source_data = self.attr_source_data[type(plugin)]
+                except KeyError:
+                    plugin.load(partition_repository)
+                else:
+                    plugin.load(partition_repository, source_data)
 
-        LOG.info('Saving site and dataset names.')
-        self.history.save_sites(partition_repository.sites.values())
-        self.history.save_datasets(partition_repository.datasets.values())
+            LOG.info('Saving site and dataset names.')
+            self.history.save_sites(partition_repository.sites.values())
+            self.history.save_datasets(partition_repository.datasets.values())
 
-        LOG.info('Saving policy conditions.')
-        # Sets policy IDs for each lines from the history DB; need to run this before execute_policy
-        self.history.save_conditions(self.policy.policy_lines)
+            LOG.info('Saving policy conditions.')
+            # Sets policy IDs for each lines from the history DB; need to run this before execute_policy
+            self.history.save_conditions(self.policy.policy_lines)
+
+            LOG.info('Applying policy to replicas.')
+            # Derived policy variables are memoized while the policy is executed. _execute_policy
+            # invalidates the cached values of a dataset whenever it modifies its replicas.
+            value_cache.activate()
+            try:
+                deleted, kept, protected, reowned = self._execute_policy(partition_repository)
+            finally:
+                value_cache.deactivate()
 
-        LOG.info('Applying policy to replicas.')
-        deleted, kept, protected, reowned = self._execute_policy(partition_repository)
+        finally:
+            # Put the inventory objects back in order. Replicas in the decision lists remain valid as
+            # objects of the partition view.
+            partition_repository.restore()
 
         LOG.info('Saving deletion decisions.')
         self.history.save_deletion_decisions(cycle_tag, deleted, kept, protected)
@@ -83,15 +349,16 @@ class Detox(object):
         LOG.info('Detox cycle completed')
 
     def _build_partition(self, inventory):
-        """Create a mini-inventory consisting only of replicas in the partition."""
-
-        partition_repository = ObjectRepository()
+        """
+        Create a mini-inventory consisting only of replicas in the partition. The returned PartitionView
+        shares the objects with the inventory; call its restore() before using the inventory again.
+        """
 
         LOG.info('Identifying target sites.')
 
         partition = inventory.partitions[self.policy.partition_name]
 
-        partition.embed_tree(partition_repository)
+        partition_repository = PartitionView(inventory, partition)
 
         # Ask each site if deletion should be triggered.
         target_sites = set() # target sites of this detox cycle
@@ -127,67 +394,18 @@ class Detox(object):
 
                     # Add to the site partition
                     site.partitions[partition].replicas[replica] = None
+                    site.partitions[partition].add_occupancy(replica.block_replicas)
 
-        # Create a copy of the inventory, limiting to the current partition
-        # We will be stripping replicas off the image as we process the policy in iterations
-        LOG.info('Creating a partition image.')
-
-        for group in inventory.groups.itervalues():
-            group.embed_into(partition_repository)
-
-        # Now clone the sites, datasets, and replicas
-        # Basically a copy-paste of various embed_into() functions ommitting the checks
-
-        # make a map to avoid excessive lookups
-        block_to_clone = {}
-        for site in target_sites:
-            site_clone = site.embed_into(partition_repository)
-
-            site_partition = site.partitions[partition]
-            site_partition_clone = site_partition.embed_tree(partition_repository)
-
-            for dataset_replica, block_replica_set in site_partition.replicas.iteritems():
-                dataset = dataset_replica.dataset
-
-                try:
-                    dataset_clone = partition_repository.datasets[dataset.name]
-
-                except KeyError:
-                    dataset_clone = dataset.embed_into(partition_repository)
-
-                    for block in dataset.blocks:
-                        block_clone = Block(block.name, dataset_clone)
-                        block_clone.copy(block)
-                        dataset_clone.blocks.add(block_clone)
-
-                        block_to_clone[block] = block_clone
-
-                replica_clone = DatasetReplica(dataset_clone, site_clone)
-                dataset_clone.replicas.add(replica_clone)
-                site_clone.add_dataset_replica(replica_clone, add_block_replicas = False)
-
-                if block_replica_set is None:
-                    # all block reps in partition
-                    block_replica_set = dataset_replica.block_replicas
-                    full_replica = True
-                    site_partition_clone.replicas[replica_clone] = None
-                else:
-                    full_replica = False
-                    block_replica_clone_set = site_partition_clone.replicas[replica_clone] = set()
-
-                for block_replica in block_replica_set:
-                    block_clone = block_to_clone[block_replica.block]
-
-                    block_replica_clone = BlockReplica(block_clone, site_clone, block_replica.group)
-                    block_replica_clone.copy(block_replica)
-                    # group has to be reset to the clone
-                    block_replica_clone.group = partition_repository.groups[block_replica.group.name]
+        # Create a view of the inventory, limiting to the current partition
+        # We will be stripping replicas off the view as we process the policy in iterations
+        LOG.info('Creating a partition view.')
 
-                    replica_clone.block_replicas.add(block_replica_clone)
-                    block_clone.replicas.add(block_replica_clone)
-
-                    if not full_replica:
-                        block_replica_clone_set.add(block_replica_clone)
+        try:
+            for site in target_sites:
+                partition_repository.add_site(site)
+        except:
+            partition_repository.restore()
+            raise
 
         return partition_repository
 
@@ -242,6 +460,53 @@ class Detox(object):
                 s = replica_map[condition_id] = set()
                 return s
 
+        # Replicas whose dependency scopes are not modified in an iteration do not need to be evaluated again.
+        # All changes to the replicas during the execution must be notified through set_modified().
+        decisions = DecisionCache(self.policy.variable_scopes)
+
+        if self.num_evaluation_processes > 1 and len(all_replicas) != 0:
+            # Evaluate all replicas at once in parallel. Results invalidated by modifications during the first
+            # iteration are discarded by the decision cache and evaluated again in the main process.
+            LOG.info('Evaluating the policy in %d processes.', self.num_evaluation_processes)
+            evaluated = self.policy.evaluate_parallel(all_replicas, self.num_evaluation_processes)
+            for replica, actions in evaluated.iteritems():
+                decisions.set(replica, actions)
+
+        # Replicas modified since the last update of the candidate queues
+        modified_replicas = []
+
+        def set_modified(replica):
+            decisions.set_modified(replica)
+            modified_replicas.append(replica)
+
+        # Sites ordered by protected fraction, for iterative deletion
+        site_queue = SiteQueue(quotas)
+
+        def add_protected(replica, condition_id, block_replicas):
+            protected_list = get_list(protected, replica, condition_id)
+            volume = 0
+            for block_replica in block_replicas:
+                if block_replica not in protected_list:
+                    protected_list.add(block_replica)
+                    volume += block_replica.size
+
+            if volume != 0:
+                site_queue.add_volume(replica.site, volume)
+
+        # Delete candidates at each site ordered by the sort key, for iterative deletion
+        candidate_queues = {} # {site: CandidateQueue}
+
+        def add_delete_candidate(replica, condition_id, block_replicas):
+            get_list(delete_candidates, replica, condition_id).update(block_replicas)
+
+            if self.policy.iterative_deletion:
+                try:
+                    queue = candidate_queues[replica.site]
+                except KeyError:
+                    queue = candidate_queues[replica.site] = CandidateQueue(self.policy.candidate_sort_key)
+
+                queue.add(replica)
+
         iteration = 0
 
         # now iterate through deletions, updating site usage as we go
@@ -267,7 +532,11 @@ class Detox(object):
                 # there is only one element in the returned list.
                 # Block-level actions are triggered only if the condition does not apply to all blocks.
                 # Sort the evaluation results into the three candidate containers above.
-                actions = self.policy.evaluate(replica)
+                # Results of the previous iteration are reused if nothing they depend on has changed.
+                actions = decisions.get(replica)
+                if actions is None:
+                    actions = self.policy.evaluate(replica)
+                    decisions.set(replica, actions)
 
                 # Keep track of block replicas matching block-level conditions
                 block_replicas = set(replica.block_replicas)
@@ -283,11 +552,11 @@ class Detox(object):
                         condition_id = matched_line.condition_id
 
                     if isinstance(action, ProtectBlock):
-                        get_list(protected, replica, condition_id).update(action.block_replicas)
+                        add_protected(replica, condition_id, action.block_replicas)
                         block_replicas -= action.block_replicas
     
                     elif isinstance(action, DeleteBlock):
-                        unlinked_replicas, reowned_replicas = self._unlink_block_replicas(replica, partition, action.block_replicas)
+                        unlinked_replicas, reowned_replicas = self._unlink_block_replicas(repository, replica, partition, action.block_replicas)
                         if len(unlinked_replicas) != 0:
                             # deleted list contains blocks that should actually be deleted, instead of just kicked out
                             # from the repository
@@ -299,7 +568,14 @@ class Detox(object):
 
                             block_replicas -= set(unlinked_replicas)
 
+                        # replica content or ownership changed
+                        set_modified(replica)
+
                         if len(reowned_replicas) != 0:
+                            # block replicas handed over are replaced by private copies in the repository
+                            block_replicas -= action.block_replicas
+                            block_replicas.update(set(reowned_replicas) - set(unlinked_replicas))
+
                             if replica in reowned:
                                 reowned[replica].extend(reowned_replicas)
                             else:
@@ -307,7 +583,7 @@ class Detox(object):
 
                     elif isinstance(action, DismissBlock):
                         if replica.site in triggered_sites:
-                            get_list(delete_candidates, replica, condition_id).update(action.block_replicas)
+                            add_delete_candidate(replica, condition_id, action.block_replicas)
                         else:
                             get_list(keep_candidates, replica, condition_id).update(action.block_replicas)
 
@@ -317,17 +593,19 @@ class Detox(object):
                         ignored_replicas.add(replica)
 
                     elif isinstance(action, Protect):
-                        get_list(protected, replica, condition_id).update(block_replicas)
+                        add_protected(replica, condition_id, block_replicas)
                         ignored_replicas.add(replica)
     
                     elif isinstance(action, Delete):
-                        unlinked_replicas, reowned_replicas = self._unlink_block_replicas(replica, partition, block_replicas)
+                        unlinked_replicas, reowned_replicas = self._unlink_block_replicas(repository, replica, partition, block_replicas)
                         if len(unlinked_replicas) != 0:
                             get_list(deleted, replica, condition_id).update(set(unlinked_replicas) - set(reowned_replicas))
 
                             for block_replica in unlinked_replicas:
                                 block_replica.delete_from(repository)
 
+                        set_modified(replica)
+
                         if len(replica.block_replicas) == 0:
                             # if all blocks were deleted, take the replica off all_replicas for later iterations
                             # this is the only place where the replica can become empty
@@ -341,12 +619,13 @@ class Detox(object):
 
                     elif isinstance(action, Dismiss):
                         if replica.site in triggered_sites:
-                            get_list(delete_candidates, replica, condition_id).update(block_replicas)
+                            add_delete_candidate(replica, condition_id, block_replicas)
                         else:
                             get_list(keep_candidates, replica, condition_id).update(block_replicas)
 
             for replica in empty_replicas:
                 replica.delete_from(repository)
+                set_modified(replica)
 
             all_replicas -= empty_replicas
             all_replicas -= ignored_replicas
@@ -370,28 +649,16 @@ class Detox(object):
                     # all sites where delete candidates are
                     candidate_sites = set(r.site for r in delete_candidates.iterkeys())
 
-                    # fraction of protected data at each candidate site
-                    protected_fraction = dict((s, 0. if quotas[s] > 0. else 1.) for s in candidate_sites)
-
-                    for replica, matches in protected.iteritems():
-                        if replica.site not in protected_fraction:
-                            continue
-
-                        quota = quotas[replica.site]
-                        if quota <= 0.:
-                            continue
-
-                        for condition_id, block_replicas in matches.iteritems():
-                            protected_fraction[replica.site] += sum(r.size for r in block_replicas) / quota
+                    # find the site with the highest protected fraction
+                    selected_site = site_queue.select(candidate_sites)
 
-                    # find the site with the highest protected fraction                            
-                    selected_site = max(candidate_sites, key = lambda site: protected_fraction[site])
+                    # sort keys of the replicas modified since the last iteration may have changed
+                    self._update_candidate_queues(candidate_queues, modified_replicas)
+                    del modified_replicas[:]
 
-                    # all delete candidates at the site
-                    candidates_at_site = [r for r in delete_candidates.iterkeys() if r.site == selected_site]
-
-                    # sorted list of replicas to delete
-                    replicas_to_delete = sorted(candidates_at_site, key = self.policy.candidate_sort_key)
+                    # delete candidates at the site in the order of the sort key
+                    candidate_queue = candidate_queues[selected_site]
+                    replicas_to_delete = candidate_queue.iterate(delete_candidates)
 
                     deleted_volume = 0.
 
@@ -418,7 +685,7 @@ class Detox(object):
                     LOG.debug('Deleting replica: %s', str(replica))
 
                     for condition_id, matches in delete_candidates[replica].iteritems():
-                        unlinked_replicas, reowned_replicas = self._unlink_block_replicas(replica, partition, matches)
+                        unlinked_replicas, reowned_replicas = self._unlink_block_replicas(repository, replica, partition, matches)
                         if len(unlinked_replicas) != 0:
                             to_delete = set(unlinked_replicas) - set(reowned_replicas)
 
@@ -429,6 +696,8 @@ class Detox(object):
                             for block_replica in unlinked_replicas:
                                 block_replica.delete_from(repository)
 
+                        set_modified(replica)
+
                         if len(reowned_replicas) != 0:
                             if replica in reowned:
                                 reowned[replica].extend(reowned_replicas)
@@ -437,6 +706,7 @@ class Detox(object):
 
                     if len(replica.block_replicas) == 0:
                         replica.delete_from(repository)
+                        set_modified(replica)
                         all_replicas.remove(replica)
 
                     site_partition = site.partitions[partition]
@@ -447,6 +717,9 @@ class Detox(object):
                             triggered_sites.remove(site)
                             break
 
+                if self.policy.iterative_deletion:
+                    candidate_queue.restore()
+
         # done iterating
 
         LOG.info(' %d dataset replicas in delete list', len(deleted))
@@ -463,7 +736,45 @@ class Detox(object):
 
         return deleted, kept, protected, reowned
 
-    def _unlink_block_replicas(self, replica, partition, block_replicas = None):
+    def _update_candidate_queues(self, candidate_queues, modified_replicas):
+        """
+        Recompute the sort keys that can be affected by the modifications to the given replicas.
+        @param candidate_queues   {site: CandidateQueue}
+        @param modified_replicas  List of dataset replicas whose block replicas changed
+        """
+
+        scopes = self.policy.candidate_sort_key.scopes
+
+        if Attr.SCOPE_GLOBAL in scopes or Attr.SCOPE_SITE in scopes:
+            for queue in candidate_queues.itervalues():
+                queue.update_all()
+
+            return
+
+        if Attr.SCOPE_DATASET in scopes:
+            affected = set()
+            for dataset in set(r.dataset for r in modified_replicas):
+                affected.update(dataset.replicas)
+
+        elif Attr.SCOPE_REPLICA in scopes:
+            affected = set(modified_replicas)
+
+        else:
+            return
+
+        for replica in affected:
+            if len(replica.block_replicas) == 0:
+                # will be dropped from the queue
+                continue
+
+            try:
+                queue = candidate_queues[replica.site]
+            except KeyError:
+                continue
+
+            queue.update(replica)
+
+    def _unlink_block_replicas(self, repository, replica, partition, block_replicas = None):
         if block_replicas is None or len(block_replicas) == len(replica.block_replicas):
             blocks_to_unlink = list(replica.block_replicas)
             blocks_to_hand_over = []
@@ -495,6 +806,8 @@ class Detox(object):
                         blocks_to_hand_over.append(block_replica)
 
             LOG.debug('%d blocks to hand over to %s', len(blocks_to_hand_over), dr_owner.name)
+            # block replicas are shared with the inventory - change the owner of private copies
+            blocks_to_hand_over = map(repository.materialize, blocks_to_hand_over)
             for block_replica in blocks_to_hand_over:
                 block_replica.group = dr_owner
 
@@ -608,6 +921,9 @@ class Detox(object):
             # Unlike deletions, we don't need to block interruptions here because there is nothing to record.
             reassignment_mapping = self.copy_op.schedule_copies(flat_list, comments = comment)
 
+            # items in the mapping are inventory objects; the new owners are in the replicas of the partition view
+            view_replicas = dict((replica.dataset.name, replica) for replica, _ in site_reown_list)
+
             for copy_id, (approved, site, items) in reassignment_mapping.iteritems():
                 if not approved:
                     continue
@@ -618,7 +934,7 @@ class Detox(object):
                         replica = dataset.find_replica(site.name)
 
                         # replica in the partition_repository
-                        clone_replica = item.find_replica(site)
+                        clone_replica = view_replicas[item.name]
                         for clone_block_replica in clone_replica.block_replicas:
                             block_replica = replica.find_block_replica(clone_block_replica.block.name)
                             block_replica.group = inventory.groups[clone_block_replica.group.name]
@@ -629,7 +945,7 @@ class Detox(object):
                         block = dataset.find_block(item.name)
                         replica = block.find_replica(site.name)
 
-                        clone_replica = item.find_replica(site)
+                        clone_replica = view_replicas[item.dataset.name].find_block_replica(item)
                         replica.group = inventory.groups[clone_replica.group.name]
 
                         inventory.update(replica)
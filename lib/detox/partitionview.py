@@ -0,0 +1,158 @@
+import copy
+
+from dynamo.core.inventory import ObjectRepository
+from dynamo.dataformat import DatasetReplica, BlockReplica, SitePartition
+from dynamo.dataformat.indexedset import IndexedSet
+
+class PartitionView(ObjectRepository):
+    """
+    Object repository consisting of the replicas in a partition at a set of sites, overlaid on the
+    objects of the inventory. Groups, datasets, blocks, sites, partitions, and block replicas are shared
+    with the inventory. Their replica containers (dataset.replicas, block.replicas, the dataset
+    replica list and the site partitions of a site) and dataset.attr are replaced by private ones for
+    the lifetime of the view, so replicas can be deleted from the view without touching the inventory.
+    Dataset replicas are always private. Block replicas are copied when they are modified (materialize()).
+
+    The inventory objects are in an inconsistent state until restore() is called.
+    """
+
+    def __init__(self, inventory, partition):
+        """
+        @param inventory  The inventory
+        @param partition  Partition object in the inventory
+        """
+
+        ObjectRepository.__init__(self)
+
+        for group in inventory.groups.itervalues():
+            self.groups[group.name] = group
+
+        self._partition_tree = []
+        self._add_partition(partition)
+
+        # original containers
+        self._dataset_containers = [] # [(dataset, replicas, attr)]
+        self._block_containers = [] # [(block, replicas)]
+        self._site_containers = [] # [(site, dataset_replicas, partitions)]
+
+        # block replicas copied in materialize()
+        self._private_block_replicas = set()
+
+    def add_site(self, site):
+        """
+        Add the content of the partition at the site to the view.
+        @param site  Site object in the inventory
+        """
+
+        site_partitions = site.partitions
+
+        self._site_containers.append((site, site._dataset_replicas, site_partitions))
+        site._dataset_replicas = {}
+        site.partitions = {}
+        for partition in self._partition_tree:
+            site_partition = site.partitions[partition] = SitePartition(site, partition)
+            site_partition.copy(site_partitions[partition])
+
+        self.sites.add(site)
+
+        partition = self._partition_tree[0]
+        site_partition = site.partitions[partition]
+
+        for dataset_replica, block_replica_set in site_partitions[partition].replicas.iteritems():
+            dataset = dataset_replica.dataset
+
+            if dataset.name not in self.datasets:
+                self._add_dataset(dataset)
+
+            replica = DatasetReplica(dataset, site)
+            dataset.replicas.add(replica)
+            site.add_dataset_replica(replica, add_block_replicas = False)
+
+            if block_replica_set is None:
+                # all block reps in partition
+                block_replica_set = dataset_replica.block_replicas
+                site_partition.replicas[replica] = None
+            else:
+                block_replica_set = site_partition.replicas[replica] = set(block_replica_set)
+
+            for block_replica in block_replica_set:
+                replica.block_replicas.add(block_replica)
+                block_replica.block.replicas.add(block_replica)
+
+        # replicas were filled directly into the site partition
+        # (subpartitions are there only to provide the quota)
+        site_partition.recompute_occupancy()
+
+    def materialize(self, block_replica):
+        """
+        Replace a block replica shared with the inventory by a private copy in all containers of the view.
+        @param block_replica  Block replica in the view
+        @return  The private copy (block_replica itself if it is already private)
+        """
+
+        if block_replica in self._private_block_replicas:
+            return block_replica
+
+        block = block_replica.block
+        site = block_replica.site
+
+        clone = BlockReplica(block, site, block_replica.group)
+        clone.copy(block_replica)
+
+        dataset_replica = site.find_dataset_replica(block.dataset)
+        dataset_replica.block_replicas.remove(block_replica)
+        dataset_replica.block_replicas.add(clone)
+
+        block.replicas.remove(block_replica)
+        block.replicas.add(clone)
+
+        for site_partition in site.partitions.itervalues():
+            try:
+                block_replicas = site_partition.replicas[dataset_replica]
+            except KeyError:
+                continue
+
+            if block_replicas is not None and block_replica in block_replicas:
+                block_replicas.remove(block_replica)
+                block_replicas.add(clone)
+
+        self._private_block_replicas.add(clone)
+
+        return clone
+
+    def restore(self):
+        """Put the original containers back to the inventory objects."""
+
+        for dataset, replicas, attr in self._dataset_containers:
+            dataset.replicas = replicas
+            dataset.attr = attr
+
+        for block, replicas in self._block_containers:
+            block.replicas = replicas
+
+        for site, dataset_replicas, partitions in self._site_containers:
+            site._dataset_replicas = dataset_replicas
+            site.partitions = partitions
+
+        self._dataset_containers = []
+        self._block_containers = []
+        self._site_containers = []
+
+    def _add_partition(self, partition):
+        self.partitions.add(partition)
+        self._partition_tree.append(partition)
+
+        if partition.subpartitions is not None:
+            for subp in partition.subpartitions:
+                self._add_partition(subp)
+
+    def _add_dataset(self, dataset):
+        self._dataset_containers.append((dataset, dataset.replicas, dataset.attr))
+        dataset.replicas = IndexedSet('site.name')
+        dataset.attr = copy.deepcopy(dataset.attr)
+
+        for block in dataset.blocks:
+            self._block_containers.append((block, block.replicas))
+            block.replicas = IndexedSet('site.name')
+
+        self.datasets.add(dataset)
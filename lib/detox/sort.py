@@ -10,6 +10,8 @@ class SortKey(object):
         self.vars = []
         # Set of attr names used by variables used in sort
         self.required_attrs = set()
+        # Dependency scopes of the variables (see Attr.scope)
+        self.scopes = set()
 
         words = text.split()
         iw = 0
@@ -32,6 +34,7 @@ class SortKey(object):
                 raise ConfigurationError('Cannot use non-numeric type to sort: ' + varname)
 
             self.required_attrs.update(variable.required_attrs)
+            self.scopes.add(variable.scope)
 
             self.vars.append((variable, reverse))
 
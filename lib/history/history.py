@@ -1,3 +1,4 @@
+import time
 import logging
 
 from dynamo.dataformat import Configuration, HistoryRecord
@@ -7,18 +8,42 @@ LOG = logging.getLogger(__name__)
 class TransactionHistoryInterface(object):
     """
     Interface for transaction history. Has a locking mechanism similar to store.
+    Writes take an exclusive lock. Reads take a shared lock, so that concurrent readers do not block each other.
     """
 
+    class LockError(Exception):
+        pass
+
     def __init__(self, config):
         self._lock_depth = 0
+        self._lock_shared = False
         self.config = Configuration(config)
 
-    def acquire_lock(self, blocking = True):
+        # {'shared' or 'exclusive': [number of acquisitions, total wait time, maximum wait time]}
+        self.lock_wait_stats = {'shared': [0, 0., 0.], 'exclusive': [0, 0., 0.]}
+
+    def acquire_lock(self, blocking = True, shared = False):
+        """
+        Acquire the lock. A shared lock cannot be upgraded; an exclusive lock can be re-acquired as shared.
+        @param blocking  Wait for the lock if True.
+        @param shared    Take a reader lock.
+        @return  True if the lock was acquired.
+        """
+
         if self._lock_depth == 0:
-            locked = self._do_acquire_lock(blocking)
+            start = time.time()
+            locked = self._do_acquire_lock(blocking, shared)
+            wait_time = time.time() - start
+
             if not locked: # only happens when not blocking
                 return False
 
+            self._lock_shared = shared
+            self._record_lock_wait(shared, wait_time)
+
+        elif self._lock_shared and not shared:
+            raise TransactionHistoryInterface.LockError('Cannot upgrade a shared history lock to exclusive')
+
         self._lock_depth += 1
         return True
 
@@ -29,6 +54,23 @@ class TransactionHistoryInterface(object):
         if self._lock_depth > 0: # should always be the case if properly programmed
             self._lock_depth -= 1
 
+        if force:
+            self._lock_depth = 0
+
+    def _record_lock_wait(self, shared, wait_time):
+        if shared:
+            mode = 'shared'
+        else:
+            mode = 'exclusive'
+
+        stats = self.lock_wait_stats[mode]
+        stats[0] += 1
+        stats[1] += wait_time
+        stats[2] = max(stats[2], wait_time)
+
+        if wait_time > 1.:
+            LOG.info('Waited %.1f seconds for the %s history lock (total %.1f seconds in %d acquisitions).', wait_time, mode, stats[1], stats[0])
+
     def new_copy_run(self, partition, policy_version, comment = ''):
         """
         Set up a new copy/deletion run for the partition.
@@ -143,7 +185,7 @@ class TransactionHistoryInterface(object):
             else:
                 run_number = max(deletion_runs[0], copy_runs[0])
 
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             sites_info = self._do_get_sites(run_number)
         finally:
@@ -221,7 +263,7 @@ class TransactionHistoryInterface(object):
         Else return a massive dict {site: [(dataset, size, decision, reason)]}
         """
 
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             decisions = self._do_get_deletion_decisions(run_number, size_only)
         finally:
@@ -241,7 +283,7 @@ class TransactionHistoryInterface(object):
             self.release_lock()
 
     def get_incomplete_copies(self, partition):
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             # list of HistoryRecords
             copies = self._do_get_incomplete_copies(partition)
@@ -254,7 +296,7 @@ class TransactionHistoryInterface(object):
         """
         Get the list of (site name, dataset name) copied in the given run.
         """
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             # list of HistoryRecords
             copies = self._do_get_copied_replicas(run_number)
@@ -264,7 +306,7 @@ class TransactionHistoryInterface(object):
         return copies
 
     def get_site_name(self, operation_id):
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             site_name = self._do_get_site_name(operation_id)
         finally:
@@ -278,7 +320,7 @@ class TransactionHistoryInterface(object):
         If last == -1, select runs up to the latest.
         """
 
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             run_numbers = self._do_get_deletion_runs(partition, first, last)
         finally:
@@ -292,7 +334,7 @@ class TransactionHistoryInterface(object):
         If last == -1, select runs up to the latest.
         """
 
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             run_numbers = self._do_get_copy_runs(partition, before)
         finally:
@@ -301,7 +343,7 @@ class TransactionHistoryInterface(object):
         return run_number
 
     def get_run_timestamp(self, run_number):
-        self.acquire_lock()
+        self.acquire_lock(shared = True)
         try:
             timestamp = self._do_get_run_timestamp(run_number)
         finally:
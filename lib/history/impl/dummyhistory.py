@@ -14,7 +14,7 @@ class DummyHistory(TransactionHistoryInterface):
     def __init__(self, config):
         TransactionHistoryInterface.__init__(self, config)
 
-    def _do_acquire_lock(self, blocking): #override
+    def _do_acquire_lock(self, blocking, shared): #override
         return True
 
     def _do_release_lock(self, force): #override
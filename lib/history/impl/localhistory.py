@@ -82,7 +82,7 @@ class LocalHistory(TransactionHistoryInterface):
                                            self._site_id_map[d.site.name],
                                            d.dataset.size,replica_times[d],timenow), replica_list)
 
-    def _do_acquire_lock(self, blocking): #override
+    def _do_acquire_lock(self, blocking, shared): #override
         while True:
             # Use the system table to "software-lock" the database
             self._mysql.query('LOCK TABLES `lock` WRITE')
@@ -1,10 +1,13 @@
 import os
 import socket
 import logging
+import random
 import time
 import re
 import collections
 import sqlite3
+import struct
+import json
 import lzma
 
 from dynamo.history.history import TransactionHistoryInterface
@@ -13,6 +16,180 @@ from dynamo.dataformat import Site, HistoryRecord
 
 LOG = logging.getLogger(__name__)
 
+class SnapshotArchive(object):
+    """
+    Compressed archive of a snapshot SQLite3 DB, consisting of independently xz-compressed chunks of
+    tab-separated rows. There is one chunk for the sites table and one chunk per site for the replicas
+    table, so that the decisions at a single site can be read without decompressing the entire archive.
+    File layout:
+      MAGIC | chunks | JSON index | index offset (8 bytes, little endian)
+    """
+
+    MAGIC = 'DYNSNAP1'
+    READ_SIZE = 1024 * 1024
+
+    # column types of the chunks
+    SITE_TYPES = (int, int, float) # site_id, status_id, quota (TB)
+    REPLICA_TYPES = (int, int, int, int) # dataset_id, size, decision_id, condition
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, db_file_name):
+        """
+        Write the archive from the snapshot DB. Rows are compressed as they are read from the DB.
+        """
+
+        snapshot_db = sqlite3.connect(db_file_name)
+        snapshot_db.text_factory = str
+
+        index = {
+            'decisions': dict(snapshot_db.execute('SELECT `id`, `value` FROM `decisions`')),
+            'statuses': dict(snapshot_db.execute('SELECT `id`, `value` FROM `statuses`')),
+            'sites': None,
+            'replicas': {}
+        }
+
+        tmp_name = self.path + '.tmp'
+
+        with open(tmp_name, 'wb') as archive:
+            archive.write(SnapshotArchive.MAGIC)
+
+            rows = snapshot_db.execute('SELECT `site_id`, `status_id`, `quota` FROM `sites`')
+            index['sites'] = self._write_chunk(archive, rows)
+
+            cursor = snapshot_db.execute('SELECT `site_id`, `dataset_id`, `size`, `decision_id`, `condition` FROM `replicas` ORDER BY `site_id`')
+
+            def site_rows(first_row):
+                # generator of rows of the site of first_row; stops at the first row of the next site
+                yield first_row[1:]
+                while True:
+                    row = cursor.fetchone()
+                    if row is None or row[0] != first_row[0]:
+                        next_row[0] = row
+                        return
+
+                    yield row[1:]
+
+            next_row = [cursor.fetchone()]
+            while next_row[0] is not None:
+                row = next_row[0]
+                # keys of a JSON object are strings
+                index['replicas'][str(row[0])] = self._write_chunk(archive, site_rows(row))
+
+            index_offset = archive.tell()
+            archive.write(json.dumps(index))
+            archive.write(struct.pack('<Q', index_offset))
+
+        snapshot_db.close()
+
+        os.rename(tmp_name, self.path)
+
+    def read_index(self):
+        with open(self.path, 'rb') as archive:
+            if archive.read(len(SnapshotArchive.MAGIC)) != SnapshotArchive.MAGIC:
+                raise RuntimeError('%s is not a snapshot archive' % self.path)
+
+            archive.seek(-8, os.SEEK_END)
+            end = archive.tell()
+            index_offset = struct.unpack('<Q', archive.read(8))[0]
+            archive.seek(index_offset)
+            index = json.loads(archive.read(end - index_offset))
+
+        # JSON keys are strings
+        index['decisions'] = dict((int(k), str(v)) for k, v in index['decisions'].iteritems())
+        index['statuses'] = dict((int(k), str(v)) for k, v in index['statuses'].iteritems())
+        index['replicas'] = dict((int(k), v) for k, v in index['replicas'].iteritems())
+
+        return index
+
+    def read_sites(self, index):
+        """Generator of (site_id, status, quota)."""
+
+        statuses = index['statuses']
+        for site_id, status_id, quota in self._read_chunk(index['sites'], SnapshotArchive.SITE_TYPES):
+            yield (site_id, statuses[status_id], quota)
+
+    def read_replicas(self, index, site_id = None):
+        """Generator of (site_id, dataset_id, size, decision, condition) at one or all sites."""
+
+        decisions = index['decisions']
+
+        if site_id is None:
+            site_ids = sorted(index['replicas'].iterkeys())
+        elif site_id in index['replicas']:
+            site_ids = [site_id]
+        else:
+            site_ids = []
+
+        for sid in site_ids:
+            for dataset_id, size, decision_id, condition in self._read_chunk(index['replicas'][sid], SnapshotArchive.REPLICA_TYPES):
+                yield (sid, dataset_id, size, decisions[decision_id], condition)
+
+    @staticmethod
+    def decompress_legacy(xz_file_name, db_file_name):
+        """Decompress a snapshot_*.db.xz file of the old format in blocks."""
+
+        decompressor = lzma.LZMADecompressor()
+        with open(xz_file_name, 'rb') as xz_file:
+            with open(db_file_name, 'wb') as db_file:
+                while True:
+                    data = xz_file.read(SnapshotArchive.READ_SIZE)
+                    if not data:
+                        break
+
+                    db_file.write(decompressor.decompress(data))
+
+    def _write_chunk(self, archive, rows):
+        """
+        Compress rows (tuples of numbers) into the archive. Floats are written with repr to keep the precision.
+        @return [offset, length] of the chunk
+        """
+
+        offset = archive.tell()
+        compressor = lzma.LZMACompressor()
+
+        lines = []
+        for row in rows:
+            lines.append('\t'.join(repr(v) if type(v) is float else str(v) for v in row))
+            if len(lines) == 10000:
+                archive.write(compressor.compress('\n'.join(lines) + '\n'))
+                lines = []
+
+        if len(lines) != 0:
+            archive.write(compressor.compress('\n'.join(lines) + '\n'))
+
+        archive.write(compressor.flush())
+
+        return [offset, archive.tell() - offset]
+
+    def _read_chunk(self, chunk, types):
+        """
+        Generator of rows in a chunk, decompressed in blocks.
+        @param chunk  [offset, length] of the chunk
+        @param types  Tuple of column types
+        """
+
+        offset, length = chunk
+        decompressor = lzma.LZMADecompressor()
+        remainder = ''
+
+        with open(self.path, 'rb') as archive:
+            archive.seek(offset)
+            while length > 0:
+                data = archive.read(min(length, SnapshotArchive.READ_SIZE))
+                if not data:
+                    break
+
+                length -= len(data)
+
+                lines = (remainder + decompressor.decompress(data)).split('\n')
+                remainder = lines.pop()
+
+                for line in lines:
+                    yield tuple(t(v) for t, v in zip(types, line.split('\t')))
+
+
 class MySQLHistory(TransactionHistoryInterface):
     """
     Transaction history interface implementation using MySQL as the backend.
@@ -22,47 +199,104 @@ class MySQLHistory(TransactionHistoryInterface):
         TransactionHistoryInterface.__init__(self, config)
 
         self._mysql = MySQL(config.db_params)
-        self._cache_db = MySQL(config.cache_db_params)
+
+        # cache tables are filled with load_many
+        cache_db_params = config.cache_db_params.clone()
+        cache_db_params.local_infile = True
+        self._cache_db = MySQL(cache_db_params)
+
+        # Named locks belong to the connection; a dedicated connection is kept open
+        lock_db_params = config.db_params.clone()
+        lock_db_params.reuse_connection = True
+        self._lock_db = MySQL(lock_db_params)
+
+        self._num_reader_slots = config.get('num_reader_slots', 16)
+        self._lock_wait_interval = config.get('lock_wait_interval', 30)
+        self._lock_timeout = config.get('lock_timeout', 0)
+        self._reader_slot = None
 
         self._site_id_map = {}
         self._dataset_id_map = {}
 
-    def _do_acquire_lock(self, blocking): #override
-        while True:
-            # Use the system table to "software-lock" the database
-            self._mysql.query('LOCK TABLES `lock` WRITE')
-            self._mysql.query('UPDATE `lock` SET `lock_host` = %s, `lock_process` = %s WHERE `lock_host` LIKE \'\' AND `lock_process` = 0', socket.gethostname(), os.getpid())
-
-            # Did the update go through?
-            host, pid = self._mysql.query('SELECT `lock_host`, `lock_process` FROM `lock`')[0]
-            self._mysql.query('UNLOCK TABLES')
-
-            if host == socket.gethostname() and pid == os.getpid():
-                # The database is locked.
-                break
-            
-            if blocking:
-                LOG.warning('Failed to lock database. Waiting 30 seconds..')
-                time.sleep(30)
+    def _do_acquire_lock(self, blocking, shared): #override
+        """
+        Reader-writer lock built from MySQL named locks (GET_LOCK). The gate lock is held by the writer for
+        the duration of the write and by readers only while they take one of the reader slots. A writer
+        takes the gate and then waits until all reader slots are free.
+        """
+
+        if not self._get_named_lock('gate', blocking):
+            return False
+
+        # The gate must not stay held when the slot waits fail (e.g. LockError on timeout);
+        # the lock connection is persistent and would block every other process on the host.
+        try:
+            if shared:
+                slots = range(self._num_reader_slots)
+                for islot in slots:
+                    if self._get_named_lock('reader%d' % islot, False):
+                        break
+                else:
+                    # all slots taken - wait for one of them
+                    islot = random.choice(slots)
+                    if not blocking or not self._get_named_lock('reader%d' % islot, True):
+                        self._release_named_lock('gate')
+                        return False
+
+                self._reader_slot = islot
+                self._release_named_lock('gate')
+
             else:
-                LOG.warning('Failed to lock database.')
-                return False
+                for islot in range(self._num_reader_slots):
+                    if not self._get_named_lock('reader%d' % islot, blocking):
+                        self._release_named_lock('gate')
+                        return False
+
+                    self._release_named_lock('reader%d' % islot)
+
+                self._reader_slot = None
+
+        except:
+            self._release_named_lock('gate')
+            raise
 
         return True
 
     def _do_release_lock(self, force): #override
-        self._mysql.query('LOCK TABLES `lock` WRITE')
         if force:
-            self._mysql.query('UPDATE `lock` SET `lock_host` = \'\', `lock_process` = 0')
+            self._lock_db.query('SELECT RELEASE_ALL_LOCKS()')
+        elif self._reader_slot is not None:
+            self._release_named_lock('reader%d' % self._reader_slot)
         else:
-            self._mysql.query('UPDATE `lock` SET `lock_host` = \'\', `lock_process` = 0 WHERE `lock_host` LIKE %s AND `lock_process` = %s', socket.gethostname(), os.getpid())
+            self._release_named_lock('gate')
+
+        self._reader_slot = None
+
+    def _get_named_lock(self, name, blocking):
+        """
+        Acquire a named lock. A blocking call waits until config.lock_timeout seconds have passed (indefinitely if 0)
+        and then raises LockError.
+        @return True if the lock is acquired.
+        """
+
+        lock_name = '%s.%s' % (self._mysql.db_name(), name)
+
+        if not blocking:
+            return self._lock_db.query('SELECT GET_LOCK(%s, 0)', lock_name)[0] == 1
+
+        waited = 0
+        while True:
+            if self._lock_db.query('SELECT GET_LOCK(%s, %s)', lock_name, self._lock_wait_interval)[0] == 1:
+                return True
 
-        # Did the update go through?
-        host, pid = self._mysql.query('SELECT `lock_host`, `lock_process` FROM `lock`')[0]
-        self._mysql.query('UNLOCK TABLES')
+            waited += self._lock_wait_interval
+            if self._lock_timeout > 0 and waited >= self._lock_timeout:
+                raise TransactionHistoryInterface.LockError('Timed out waiting for lock %s' % lock_name)
 
-        if host != '' or pid != 0:
-            raise RuntimeError('Failed to release lock from ' + socket.gethostname() + ':' + str(os.getpid()))
+            LOG.warning('Waiting for lock %s (%d seconds)..', lock_name, waited)
+
+    def _release_named_lock(self, name):
+        self._lock_db.query('SELECT RELEASE_LOCK(%s)', '%s.%s' % (self._mysql.db_name(), name))
 
     def _do_new_run(self, operation, partition, policy_version, comment): #override
         part_ids = self._mysql.query('SELECT `id` FROM `partitions` WHERE `name` LIKE %s', partition)
@@ -299,18 +533,14 @@ class MySQLHistory(TransactionHistoryInterface):
             # Archive the sqlite3 file
             # Relying on the fact save_quotas is called after save_deletion_decisions
     
-            srun = '%09d' % run_number
-            archive_dir_name = '%s/%s/%s' % (self.config.snapshots_archive_dir, srun[:3], srun[3:6])
-            xz_file_name = '%s/snapshot_%09d.db.xz' % (archive_dir_name, run_number)
+            archive_file_name = self._archive_file_name(run_number)
     
             try:
-                os.makedirs(archive_dir_name)
+                os.makedirs(os.path.dirname(archive_file_name))
             except OSError:
                 pass
-    
-            with open(db_file_name, 'rb') as db_file:
-                with open(xz_file_name, 'wb') as xz_file:
-                    xz_file.write(lzma.compress(db_file.read()))
+
+            SnapshotArchive(archive_file_name).write(db_file_name)
 
     def _do_get_deletion_decisions(self, run_number, size_only): #override
         self._fill_snapshot_cache('replicas', run_number)
@@ -499,67 +729,87 @@ class MySQLHistory(TransactionHistoryInterface):
         # run_number is either a cycle number or a partition name. %s works for both
         table_name = '%s_%s' % (template, run_number)
 
-        sql = 'SELECT COUNT(*) FROM `information_schema`.`TABLES` WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = %s'
-        table_exists = (self._mysql.query(sql, self._cache_db.db_name(), table_name)[0] != 0)
+        # readers can run concurrently; only one of them fills the table
+        self._get_named_lock('cache.' + table_name, True)
+        try:
+            table_exists = self._cache_table_exists(table_name)
 
-        if overwrite or not table_exists:
-            # fill from sqlite
-            if table_exists:
-                self._cache_db.query('TRUNCATE TABLE `%s`' % table_name)
-            else:
-                self._cache_db.query('CREATE TABLE `%s` LIKE `%s`' % (table_name, template))
+            if overwrite or not table_exists:
+                # fill from sqlite or the archive
+                if table_exists:
+                    self._cache_db.query('TRUNCATE TABLE `%s`' % table_name)
+                else:
+                    self._cache_db.query('CREATE TABLE `%s` LIKE `%s`' % (table_name, template))
 
-            if type(run_number) is int:
-                db_file_name = '%s/snapshot_%09d.db' % (self.config.snapshots_spool_dir, run_number)
+                archive = None
 
-                if not os.path.exists(db_file_name):
-                    srun = '%09d' % run_number
-                    xz_file_name = '%s/%s/%s/snapshot_%09d.db.xz' % (self.config.snapshots_archive_dir, srun[:3], srun[3:6], run_number)
-                    if not os.path.exists(xz_file_name):
-                        raise RuntimeError('Snapshot DB ' + db_file_name + ' does not exist')
-    
-                    with open(xz_file_name, 'rb') as xz_file:
-                        with open(db_file_name, 'wb') as db_file:
-                            db_file.write(lzma.decompress(xz_file.read()))
+                if type(run_number) is int:
+                    db_file_name = '%s/snapshot_%09d.db' % (self.config.snapshots_spool_dir, run_number)
 
-            else:
-                db_file_name = '%s/snapshot_%s.db' % (self.config.snapshots_spool_dir, run_number)
+                    if not os.path.exists(db_file_name):
+                        archive_file_name = self._archive_file_name(run_number)
+                        srun = '%09d' % run_number
+                        xz_file_name = '%s/%s/%s/snapshot_%09d.db.xz' % (self.config.snapshots_archive_dir, srun[:3], srun[3:6], run_number)
+
+                        if os.path.exists(archive_file_name):
+                            archive = SnapshotArchive(archive_file_name)
+                        elif os.path.exists(xz_file_name):
+                            # archive of the old format
+                            SnapshotArchive.decompress_legacy(xz_file_name, db_file_name)
+                        else:
+                            raise RuntimeError('Snapshot DB ' + db_file_name + ' does not exist')
 
-                if not os.path.exists(db_file_name):
-                    return
+                else:
+                    db_file_name = '%s/snapshot_%s.db' % (self.config.snapshots_spool_dir, run_number)
 
-            snapshot_db = sqlite3.connect(db_file_name)
-            snapshot_db.text_factory = str # otherwise we'll get unicode and MySQLdb cannot convert that
-            snapshot_cursor = snapshot_db.cursor()
+                    if not os.path.exists(db_file_name):
+                        return
 
-            def make_snapshot_reader():
                 if template == 'replicas':
-                    sql = 'SELECT r.`site_id`, r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r'
-                    sql += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
+                    fields = ('site_id', 'dataset_id', 'size', 'decision', 'condition')
                 elif template == 'sites':
-                    sql = 'SELECT s.`site_id`, t.`value`, s.`quota` FROM `sites` AS s'
-                    sql += ' INNER JOIN `statuses` AS t ON t.`id` = s.`status_id`'
+                    fields = ('site_id', 'status', 'quota')
+
+                if archive is not None:
+                    # chunks are decompressed as the rows are inserted
+                    index = archive.read_index()
+                    if template == 'replicas':
+                        snapshot_reader = archive.read_replicas(index)
+                    elif template == 'sites':
+                        snapshot_reader = archive.read_sites(index)
+
+                    self._cache_db.load_many(table_name, fields, None, snapshot_reader, do_update = False)
+
+                else:
+                    snapshot_db = sqlite3.connect(db_file_name)
+                    snapshot_db.text_factory = str # otherwise we'll get unicode and MySQLdb cannot convert that
+                    snapshot_cursor = snapshot_db.cursor()
+    
+                    def make_snapshot_reader():
+                        if template == 'replicas':
+                            sql = 'SELECT r.`site_id`, r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r'
+                            sql += ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`'
+                        elif template == 'sites':
+                            sql = 'SELECT s.`site_id`, t.`value`, s.`quota` FROM `sites` AS s'
+                            sql += ' INNER JOIN `statuses` AS t ON t.`id` = s.`status_id`'
+                        
+                        snapshot_cursor.execute(sql)
                     
-                snapshot_cursor.execute(sql)
-                
-                while True:
-                    row = snapshot_cursor.fetchone()
-                    if row is None:
-                        return
-
-                    yield row
-
-            snapshot_reader = make_snapshot_reader()
-
-            if template == 'replicas':
-                fields = ('site_id', 'dataset_id', 'size', 'decision', 'condition')
-            elif template == 'sites':
-                fields = ('site_id', 'status', 'quota')
-                
-            self._cache_db.insert_many(table_name, fields, None, snapshot_reader, do_update = False)
-
-            snapshot_cursor.close()
-            snapshot_db.close()
+                        while True:
+                            row = snapshot_cursor.fetchone()
+                            if row is None:
+                                return
+    
+                            yield row
+    
+                    snapshot_reader = make_snapshot_reader()
+    
+                    self._cache_db.load_many(table_name, fields, None, snapshot_reader, do_update = False)
+    
+                    snapshot_cursor.close()
+                    snapshot_db.close()
+        finally:
+            self._release_named_lock('cache.' + table_name)
 
         if type(run_number) is int:
             self._cache_db.query('INSERT INTO `{template}_snapshot_usage` VALUES (%s, NOW())'.format(template = template), run_number)
@@ -572,6 +822,14 @@ class MySQLHistory(TransactionHistoryInterface):
 
         self._clean_old_cache()
 
+    def _cache_table_exists(self, table_name):
+        sql = 'SELECT COUNT(*) FROM `information_schema`.`TABLES` WHERE `TABLE_SCHEMA` = %s AND `TABLE_NAME` = %s'
+        return self._mysql.query(sql, self._cache_db.db_name(), table_name)[0] != 0
+
+    def _archive_file_name(self, run_number):
+        srun = '%09d' % run_number
+        return '%s/%s/%s/snapshot_%09d.xzs' % (self.config.snapshots_archive_dir, srun[:3], srun[3:6], run_number)
+
     def _clean_old_cache(self):
         sql = 'SELECT `run_id` FROM (SELECT `run_id`, MAX(`timestamp`) AS m FROM `replicas_snapshot_usage` GROUP BY `run_id`) AS t WHERE m < DATE_SUB(NOW(), INTERVAL 1 WEEK)'
         old_replica_runs = self._cache_db.query(sql)
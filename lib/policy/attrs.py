@@ -7,6 +7,46 @@ from dynamo.dataformat import DatasetReplica, BlockReplica
 class InvalidExpression(Exception):
     pass
 
+class AttrCache(object):
+    """
+    Memoization of derived attribute values within a scope where the caller keeps track of changes
+    to the objects (e.g. a Detox cycle). Values are grouped by dataset, so that everything depending
+    on the replicas of a dataset can be invalidated at once. Inactive (no caching) by default.
+    """
+
+    def __init__(self):
+        self.active = False
+        self._values = {} # {dataset: {(attr, obj): value}}
+
+    def activate(self):
+        self.active = True
+        self._values = {}
+
+    def deactivate(self):
+        self.active = False
+        self._values = {}
+
+    def invalidate(self, dataset):
+        """Drop all cached values of the dataset and its replicas."""
+
+        self._values.pop(dataset, None)
+
+    def get(self, attr, obj, dataset):
+        try:
+            dataset_values = self._values[dataset]
+        except KeyError:
+            dataset_values = self._values[dataset] = {}
+
+        key = (attr, obj)
+        try:
+            return dataset_values[key]
+        except KeyError:
+            value = dataset_values[key] = attr._get(obj)
+            return value
+
+# Cache used by cacheable Attrs
+value_cache = AttrCache()
+
 class Attr(object):
     """
     Base class representing an extended attribute of an object.
@@ -16,6 +56,19 @@ class Attr(object):
 
     BOOL_TYPE, NUMERIC_TYPE, TEXT_TYPE, TIME_TYPE = range(4)
 
+    # Derived attributes that are expensive to compute set this to True to have their values
+    # memoized in value_cache while it is active.
+    cacheable = False
+
+    # Dependency scope of the attribute value, i.e. which changes to the inventory can alter the value.
+    #  STATIC: none (attributes of the dataset or site objects themselves)
+    #  REPLICA: the block replicas of the same dataset replica
+    #  DATASET: any replica of the same dataset
+    #  SITE: any replica at the same site
+    #  GLOBAL: unknown
+    SCOPE_STATIC, SCOPE_REPLICA, SCOPE_DATASET, SCOPE_SITE, SCOPE_GLOBAL = range(5)
+    scope = SCOPE_GLOBAL
+
     def __init__(self, vtype, attr = '', args = None):
         self.vtype = vtype
         self.attr = attr
@@ -63,6 +116,8 @@ class Attr(object):
 class DatasetAttr(Attr):
     """Extract an attribute from the dataset regardless of the type of replica passed __call__"""
 
+    scope = Attr.SCOPE_STATIC
+
     def __init__(self, vtype, attr = None, args = None, dict_attr = None, dict_default = 0):
         Attr.__init__(self, vtype, attr = attr, args = args)
 
@@ -81,6 +136,8 @@ class DatasetAttr(Attr):
                 return dataset.attr[self.required_attrs[0]]
             except KeyError:
                 return self.dict_default
+        elif self.cacheable and value_cache.active:
+            return value_cache.get(self, dataset, dataset)
         else:
             return self._get(dataset)
 
@@ -88,20 +145,28 @@ class DatasetAttr(Attr):
 class DatasetReplicaAttr(Attr):
     """Extract an attribute from a dataset replica. If a block replica is passed, return the attribute of the owning dataset replica."""
 
+    scope = Attr.SCOPE_REPLICA
+
     def __init__(self, vtype, attr = None, args = None):
         Attr.__init__(self, vtype, attr = attr, args = args)
 
     def get(self, replica):
         if type(replica) is BlockReplica:
             dataset_replica = replica.block.dataset.find_replica(replica.site)
-            return self._get(dataset_replica)
         else:
-            return self._get(replica)
+            dataset_replica = replica
+
+        if self.cacheable and value_cache.active:
+            return value_cache.get(self, dataset_replica, dataset_replica.dataset)
+        else:
+            return self._get(dataset_replica)
 
 
 class BlockReplicaAttr(Attr):
     """Extract an attribute from a block replica. If a dataset replica is passed, return a list of values."""
 
+    scope = Attr.SCOPE_REPLICA
+
     def __init__(self, vtype, attr = None, args = None):
         Attr.__init__(self, vtype, attr = attr, args = args)
 
@@ -115,6 +180,8 @@ class BlockReplicaAttr(Attr):
 class ReplicaSiteAttr(Attr):
     """Extract an attribute from the site of a replica."""
 
+    scope = Attr.SCOPE_STATIC
+
     def __init__(self, vtype, attr = None, args = None):
         Attr.__init__(self, vtype, attr = attr, args = args)
 
@@ -125,6 +192,8 @@ class ReplicaSiteAttr(Attr):
 class SiteAttr(Attr):
     """Extract an attribute from a SitePartition object (*not* Site object)."""
 
+    scope = Attr.SCOPE_SITE
+
     def __init__(self, vtype, attr = None, args = None):
         Attr.__init__(self, vtype, attr = attr, args = args)
 
@@ -1,5 +1,9 @@
+import logging
+
 from dynamo.policy.predicates import Predicate
 
+LOG = logging.getLogger(__name__)
+
 class Condition(object):
     """AND-chained Predicates."""
 
@@ -48,6 +52,42 @@ class Condition(object):
 
         return True
 
+    def compile(self, check = False):
+        """
+        Compile the predicates into a single function with the variable accessors and comparisons
+        inlined, and use it as the match method of this instance. Predicates are evaluated in the
+        declared order with short-circuiting, as in the interpreted match.
+        @param check  If True, evaluate the interpreted predicates in addition at each call and
+                      log any discrepancy. The interpreted result is returned in such a case.
+        """
+
+        namespace = {}
+        body = []
+        for predicate in self.predicates:
+            body.extend(predicate.compile('obj', namespace))
+
+        # bind the names as default arguments so they are looked up as locals
+        args = ''.join(', %s = %s' % (name, name) for name in sorted(namespace.iterkeys()))
+
+        source = 'def match(obj%s):\n' % args
+        source += ''.join('    %s\n' % line for line in body)
+        source += '    return True\n'
+
+        exec source in namespace
+        compiled = namespace['match']
+
+        if check:
+            def match(obj):
+                result = Condition.match(self, obj)
+                if bool(compiled(obj)) != bool(result):
+                    LOG.error('Compiled %s disagrees with the interpreted result %s for %s', str(self), result, str(obj))
+
+                return result
+
+            self.match = match
+        else:
+            self.match = compiled
+
     def get_variable(self, expr, variables):
         """Return an Attr object using the expr from the given variables dictionary."""
 
@@ -5,6 +5,13 @@ import dynamo.policy.attrs as attrs
 class InvalidOperator(Exception):
     pass
 
+def _bind(namespace, value):
+    """Register value in the namespace of a compiled function and return its name."""
+
+    name = '_c%d' % len(namespace)
+    namespace[name] = value
+    return name
+
 ##################
 ## Base classes ##
 ##################
@@ -61,6 +68,41 @@ class Predicate(object):
 
         return self._eval(lhs)
 
+    def compile(self, obj, namespace):
+        """
+        Return the source lines of a code block that evaluates this predicate on obj and
+        returns False if it does not hold. Semantics of __call__ are preserved: the only
+        container LHS is the list of values returned by a BlockReplicaAttr for a dataset replica.
+        @param obj        Name of the object variable in the compiled function
+        @param namespace  Dict of names to be bound in the compiled function
+        """
+
+        source = ['lhs = %s(%s)' % (_bind(namespace, self.variable.get), obj)]
+
+        if isinstance(self.variable, attrs.BlockReplicaAttr):
+            source += [
+                'if type(lhs) is list:',
+                '    for elem in lhs:',
+                '        if %s:' % self._compile_eval('elem', namespace),
+                '            break',
+                '    else:',
+                '        return False',
+                'elif not (%s):' % self._compile_eval('lhs', namespace),
+                '    return False'
+            ]
+        else:
+            source += [
+                'if not (%s):' % self._compile_eval('lhs', namespace),
+                '    return False'
+            ]
+
+        return source
+
+    def _compile_eval(self, lhs, namespace):
+        """Return a Python expression equivalent to _eval(lhs)."""
+
+        return '%s(%s)' % (_bind(namespace, self._eval), lhs)
+
 class UnaryExpr(Predicate):
     operators = ['', 'not']
 
@@ -121,6 +163,35 @@ class SetElementExpr(Predicate):
 
         self.rhs = map(self.variable.rhs_map, elem_exprs)
 
+    def _contains(self, lhs):
+        if self.variable.vtype == attrs.Attr.NUMERIC_TYPE:
+            return lhs in self.rhs
+        else:
+            for elem in self.rhs:
+                if type(elem) is re._pattern_type:
+                    if elem.match(lhs):
+                        return True
+                else:
+                    if elem == lhs:
+                        return True
+
+            return False
+
+    def _compile_contains(self, lhs, namespace):
+        if self.variable.vtype == attrs.Attr.NUMERIC_TYPE:
+            return '%s in %s' % (lhs, _bind(namespace, self.rhs))
+        elif len(self.rhs) == 0:
+            return 'False'
+        else:
+            exprs = []
+            for elem in self.rhs:
+                if type(elem) is re._pattern_type:
+                    exprs.append('%s.match(%s) is not None' % (_bind(namespace, elem), lhs))
+                else:
+                    exprs.append('%s == %s' % (_bind(namespace, elem), lhs))
+
+            return '(%s)' % ' or '.join(exprs)
+
 
 #################################
 ## Unary (boolean) expressions ##
@@ -130,10 +201,16 @@ class Assert(UnaryExpr):
     def _eval(self, boolexpr):
         return boolexpr
 
+    def _compile_eval(self, lhs, namespace):
+        return lhs
+
 class Negate(UnaryExpr):
     def _eval(self, boolexpr):
         return not boolexpr
 
+    def _compile_eval(self, lhs, namespace):
+        return 'not %s' % lhs
+
 #####################################
 ## Binary (comparison) expressions ##
 #####################################
@@ -150,6 +227,12 @@ class Eq(BinaryExpr):
     def _eval(self, lhs):
         return self._call(lhs)
 
+    def _compile_eval(self, lhs, namespace):
+        if type(self.rhs) is re._pattern_type:
+            return '%s.match(%s) is not None' % (_bind(namespace, self.rhs), lhs)
+        else:
+            return '%s == %s' % (lhs, _bind(namespace, self.rhs))
+
 class Neq(BinaryExpr):
     def __init__(self, variable, rhs_expr):
         BinaryExpr.__init__(self, variable, rhs_expr)
@@ -162,33 +245,40 @@ class Neq(BinaryExpr):
     def _eval(self, lhs):
         return self._call(lhs)
 
+    def _compile_eval(self, lhs, namespace):
+        if type(self.rhs) is re._pattern_type:
+            return '%s.match(%s) is None' % (_bind(namespace, self.rhs), lhs)
+        else:
+            return '%s != %s' % (lhs, _bind(namespace, self.rhs))
+
 class Lt(BinaryExpr):
     def _eval(self, lhs):
         return lhs < self.rhs
 
+    def _compile_eval(self, lhs, namespace):
+        return '%s < %s' % (lhs, _bind(namespace, self.rhs))
+
 class Gt(BinaryExpr):
     def _eval(self, lhs):
         return lhs > self.rhs
 
+    def _compile_eval(self, lhs, namespace):
+        return '%s > %s' % (lhs, _bind(namespace, self.rhs))
+
 #########################################
 ## Set-element (inclusion) expressions ##
 #########################################
 
 class In(SetElementExpr):
     def _eval(self, lhs):
-        if self.variable.vtype == attrs.Attr.NUMERIC_TYPE:
-            return lhs in self.rhs
-        else:
-            for elem in self.rhs:
-                if type(elem) is re._pattern_type:
-                    if elem.match(lhs):
-                        return True
-                else:
-                    if elem == lhs:
-                        return True
+        return self._contains(lhs)
 
-            return False
+    def _compile_eval(self, lhs, namespace):
+        return self._compile_contains(lhs, namespace)
 
 class Notin(SetElementExpr):
     def _eval(self, elem):
-        return not In._eval(self, elem)
+        return not self._contains(elem)
+
+    def _compile_eval(self, lhs, namespace):
+        return 'not %s' % self._compile_contains(lhs, namespace)
@@ -24,18 +24,111 @@ class CRABAccessHistory(object):
 
     produces = ['global_usage_rank', 'local_usage']
 
+    # Monthly sums of dataset_accesses, refreshed in update()
+    ROLLUP_TABLE = 'dataset_accesses_monthly'
+    ROLLUP_TABLE_DEFINITION = '(' \
+        '`dataset_id` int(10) unsigned NOT NULL,' \
+        '`site_id` int(10) unsigned NOT NULL,' \
+        '`month` date NOT NULL DEFAULT \'0000-00-00\',' \
+        '`num_accesses` int(11) NOT NULL DEFAULT \'0\',' \
+        '`cputime` double NOT NULL DEFAULT \'0\',' \
+        '`last_access` date NOT NULL DEFAULT \'0000-00-00\',' \
+        'PRIMARY KEY (`dataset_id`,`site_id`,`month`),' \
+        'KEY `sites` (`site_id`),' \
+        'KEY `months` (`month`)' \
+        ') ENGINE=MyISAM DEFAULT CHARSET=latin1'
+
     def __init__(self, config):
         self._store = MySQL(config.store.db_params)
 
-    def load(self, inventory):
-        records = self._get_stored_records(inventory)
+    def load(self, inventory, records = None):
+        """
+        @param inventory  DynamoInventory or a view of it
+        @param records    Return value of fetch(). If None, fetch(inventory) is called.
+        """
+
+        if records is None:
+            records = self.fetch(inventory)
+
         self._compute(inventory, records)
 
+    def fetch(self, inventory):
+        """
+        Read the access summaries from the DB. The summaries do not depend on which replicas are
+        in the inventory passed to load(), so one fetch can serve several loads on views of the inventory.
+        @param inventory  DynamoInventory
+        @return  {(site name, dataset name): (number of access, total cpu time, last access date)}
+        """
+
+        if CRABAccessHistory._rollups_available(self._store):
+            return self._get_rollup_records(inventory)
+        else:
+            LOG.info('Access rollups are not available. Reading the daily access records.')
+            return self._summarize(self._get_stored_records(inventory))
+
+    def _get_rollup_records(self, inventory):
+        """
+        Get the replica access summaries from the monthly rollups. The month at the lower edge of the
+        two-year window is read from the daily records.
+        @param inventory  DynamoInventory
+        @return  {(site name, dataset name): (number of access, total cpu time, last access date)}
+        """
+
+        # single statement so that NOW() is common to both parts
+        sql = 'SELECT s.`name`, d.`name`, SUM(a.`num_accesses`), SUM(a.`cputime`), MAX(a.`last_access`) FROM ('
+        sql += 'SELECT `dataset_id`, `site_id`, `num_accesses`, `cputime`, `last_access` FROM `%s`' % CRABAccessHistory.ROLLUP_TABLE
+        sql += ' WHERE `month` > DATE_SUB(NOW(), INTERVAL 2 YEAR)'
+        sql += ' UNION ALL '
+        sql += 'SELECT `dataset_id`, `site_id`, `num_accesses`, `cputime`, `date` FROM `dataset_accesses`'
+        sql += ' WHERE `date` > DATE_SUB(NOW(), INTERVAL 2 YEAR) AND `date` < DATE_ADD(LAST_DAY(DATE_SUB(NOW(), INTERVAL 2 YEAR)), INTERVAL 1 DAY)'
+        sql += ') AS a'
+        sql += ' INNER JOIN `sites` AS s ON s.`id` = a.`site_id`'
+        sql += ' INNER JOIN `datasets` AS d ON d.`id` = a.`dataset_id`'
+        sql += ' GROUP BY a.`site_id`, a.`dataset_id`'
+
+        all_accesses = {}
+        num_records = 0
+
+        for site_name, dataset_name, num_accesses, cputime, last_access in self._store.xquery(sql):
+            num_records += 1
+
+            try:
+                site = inventory.sites[site_name]
+                dataset = inventory.datasets[dataset_name]
+            except KeyError:
+                continue
+
+            if site.find_dataset_replica(dataset) is None:
+                continue
+
+            all_accesses[(site_name, dataset_name)] = (int(num_accesses), float(cputime), last_access)
+
+        last_update = self._store.query('SELECT UNIX_TIMESTAMP(`dataset_accesses_last_update`) FROM `system`')[0]
+
+        LOG.info('Loaded %d replica access summaries. Last update on %s UTC', num_records, time.strftime('%Y-%m-%d', time.gmtime(last_update)))
+
+        return all_accesses
+
+    @staticmethod
+    def _summarize(all_accesses):
+        """
+        @param all_accesses  {(site name, dataset name): {date: (number of access, cpu time)}}
+        @return  {(site name, dataset name): (number of access, total cpu time, last access date)}
+        """
+
+        summaries = {}
+        for key, accesses in all_accesses.iteritems():
+            num_access = sum(e[0] for e in accesses.itervalues())
+            tot_cpu = sum(e[1] for e in accesses.itervalues())
+            summaries[key] = (num_access, tot_cpu, max(accesses.iterkeys()))
+
+        return summaries
+
     def _get_stored_records(self, inventory):
         """
         Get the replica access data from DB.
         @param inventory  DynamoInventory
-        @return  {replica: {date: (number of access, total cpu time)}}
+        @return  {(site name, dataset name): {date: (number of access, total cpu time)}}
         """
 
         # pick up all accesses that are less than 2 years old
@@ -91,7 +184,7 @@ class CRABAccessHistory(object):
 
                 replica = site.find_dataset_replica(dataset)
                 if replica is not None:
-                    accesses = all_accesses[replica] = {}
+                    accesses = all_accesses[(site_name, dataset_name)] = {}
 
             if replica is None:
                 continue
@@ -105,15 +198,15 @@ class CRABAccessHistory(object):
 
         return all_accesses
 
-    def _compute(self, inventory, all_accesses):
+    def _compute(self, inventory, access_summaries):
         """
         Set the dataset usage rank based on access list.
         Following the IntelROCCS implementation for local rank:
         datasetRank = (1-used)*(now-creationDate)/(60*60*24) + \
             used*( (now-lastAccessed)/(60*60*24)-nAccessed) - size/1000
         nAccessed is NACC normalized by size (in GB).
-        @param inventory   DynamoInventory
-        @param all_accesses {replica: {date: (number of access, cpu time)}}
+        @param inventory         DynamoInventory
+        @param access_summaries  {(site name, dataset name): (number of access, total cpu time, last access date)}
         """
 
         now = time.time()
@@ -131,18 +224,14 @@ class CRABAccessHistory(object):
                 size = replica.size(physical = False) * 1.e-9
 
                 try:
-                    accesses = all_accesses[replica]
+                    num_access, tot_cpu, last_access = access_summaries[(replica.site.name, dataset.name)]
                 except KeyError:
-                    accesses = {}
                     last_used = 0
                     num_access = 0
                     tot_cpu = 0.
                 else:
-                    last_access = max(accesses.iterkeys())
                     # mktime returns expects the local time but the timetuple we pass is for UTC. subtracting time.timezone
                     last_used = time.mktime(last_access.timetuple()) - time.timezone
-                    num_access = sum(e[0] for e in accesses.itervalues())
-                    tot_cpu = sum(e[1] for e in accesses.itervalues())
 
                 if num_access == 0:
                     local_rank = (now - replica.last_block_created()) / (24. * 3600.)
@@ -165,7 +254,11 @@ class CRABAccessHistory(object):
     @staticmethod
     def update(config, inventory):
         popdb = PopDB(config.popdb.config)
-        store = MySQL(config.store.db_params)
+
+        # dataset_accesses is written with load_many
+        db_params = config.store.db_params.clone()
+        db_params.local_infile = True
+        store = MySQL(db_params)
 
         last_update = store.query('SELECT UNIX_TIMESTAMP(`dataset_accesses_last_update`) FROM `system`')[0]
         try:
@@ -189,8 +282,49 @@ class CRABAccessHistory(object):
             CRABAccessHistory._save_records(source_records, store)
             # remove old entries
             store.query('DELETE FROM `dataset_accesses` WHERE `date` < DATE_SUB(NOW(), INTERVAL 2 YEAR)')
+            CRABAccessHistory._update_rollups(store, start_date)
             store.query('UPDATE `system` SET `dataset_accesses_last_update` = NOW()')
 
+    @staticmethod
+    def _rollups_available(store):
+        if not store.table_exists(CRABAccessHistory.ROLLUP_TABLE):
+            return False
+
+        return len(store.query('SELECT 1 FROM `%s` LIMIT 1' % CRABAccessHistory.ROLLUP_TABLE)) != 0
+
+    @staticmethod
+    def _update_rollups(store, start_date):
+        """
+        Recompute the monthly rollups from the month of start_date. If the rollups do not exist, create
+        them from all daily records.
+        @param store       Write-allowed MySQL interface
+        @param start_date  First date of the newly saved records (datetime.date)
+        """
+
+        table = CRABAccessHistory.ROLLUP_TABLE
+
+        if not store.table_exists(table):
+            LOG.info('Creating table %s.', table)
+            store.query('CREATE TABLE `%s` %s' % (table, CRABAccessHistory.ROLLUP_TABLE_DEFINITION))
+
+        if CRABAccessHistory._rollups_available(store):
+            start_month = start_date.replace(day = 1).strftime('%Y-%m-%d')
+        else:
+            LOG.info('Building the access rollups from all daily records.')
+            start_month = '1970-01-01'
+
+        # daily records are only added or overwritten from start_date, so every recomputed month has a row
+        # to replace the existing one
+        sql = 'INSERT INTO `%s` (`dataset_id`, `site_id`, `month`, `num_accesses`, `cputime`, `last_access`)' % table
+        sql += ' SELECT `dataset_id`, `site_id`, DATE_FORMAT(`date`, \'%%Y-%%m-01\') AS m, SUM(`num_accesses`), SUM(`cputime`), MAX(`date`)'
+        sql += ' FROM `dataset_accesses` WHERE `date` >= %s'
+        sql += ' GROUP BY `dataset_id`, `site_id`, m'
+        sql += ' ON DUPLICATE KEY UPDATE `num_accesses` = VALUES(`num_accesses`), `cputime` = VALUES(`cputime`), `last_access` = VALUES(`last_access`)'
+        store.query(sql, start_month)
+
+        # remove months that are entirely out of the two-year window
+        store.query('DELETE FROM `%s` WHERE `last_access` <= DATE_SUB(NOW(), INTERVAL 2 YEAR)' % table)
+
     @staticmethod
     def _get_source_records(popdb, inventory, included_sites, excluded_sites, start_date):
         """
@@ -311,4 +445,4 @@ class CRABAccessHistory(object):
             for date, (num_accesses, cputime) in entries.iteritems():
                 data.append((dataset_id, site_id, date.strftime('%Y-%m-%d'), 'local', num_accesses, cputime))
 
-        store.insert_many('dataset_accesses', fields, None, data, do_update = True)
+        store.load_many('dataset_accesses', fields, None, data, do_update = True)
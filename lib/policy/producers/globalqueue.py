@@ -19,21 +19,89 @@ class GlobalQueueRequestHistory(object):
 
     produces = ['request_weight']
 
+    # Decayed request weight per dataset, maintained in update()
+    WEIGHT_TABLE = 'dataset_request_weights'
+    WEIGHT_TABLE_DEFINITION = '(' \
+        '`dataset_id` int(10) unsigned NOT NULL,' \
+        '`halflife` double NOT NULL DEFAULT \'0\',' \
+        '`weight` double NOT NULL DEFAULT \'0\',' \
+        '`timestamp` datetime NOT NULL DEFAULT \'0000-00-00 00:00:00\',' \
+        'PRIMARY KEY (`dataset_id`)' \
+        ') ENGINE=MyISAM DEFAULT CHARSET=latin1'
+
     def __init__(self, config):
         self._store = MySQL(config.store.db_params)
 
         # Weight computation halflife constant (given in days in config)
         self.weight_halflife = config.weight_halflife * 3600. * 24.
 
-    def load(self, inventory):
-        records = self._get_stored_records(inventory)
-        self._compute(inventory, records)
+    def load(self, inventory, weights = None):
+        """
+        @param inventory  DynamoInventory or a view of it
+        @param weights    Return value of fetch(). If None, fetch(inventory) is called.
+        """
+
+        if weights is None:
+            weights = self.fetch(inventory)
+
+        for dataset in inventory.datasets.itervalues():
+            try:
+                dataset.attr['request_weight'] = weights[dataset.name]
+            except KeyError:
+                dataset.attr['request_weight'] = 0.
+
+    def fetch(self, inventory):
+        """
+        Read the request weights from the DB. Weights are per dataset and therefore do not depend on which
+        replicas are in the inventory passed to load().
+        @param inventory  DynamoInventory
+        @return  {dataset name: weight}
+        """
+
+        weights = self._get_stored_weights(inventory)
+
+        if weights is None:
+            LOG.info('Stored request weights are not available. Computing from the request records.')
+            records = self._get_stored_records(inventory)
+            weights = self._compute(records)
+
+        return weights
+
+    def _get_stored_weights(self, inventory):
+        """
+        Get the request weights from the accumulator table, decayed to the current time.
+        @param inventory  DynamoInventory
+        @return  {dataset name: weight}, or None if the table does not have weights for the halflife.
+        """
+
+        table = GlobalQueueRequestHistory.WEIGHT_TABLE
+        halflife_days = self.weight_halflife / (3600. * 24.)
+
+        if not GlobalQueueRequestHistory._weights_available(self._store, halflife_days):
+            return None
+
+        now = time.time()
+        decay_constant = self.weight_halflife / math.log(2.)
+
+        sql = 'SELECT d.`name`, w.`weight`, UNIX_TIMESTAMP(w.`timestamp`) FROM `%s` AS w' % table
+        sql += ' INNER JOIN `datasets` AS d ON d.`id` = w.`dataset_id`'
+
+        weights = {}
+        for dataset_name, weight, timestamp in self._store.xquery(sql):
+            if dataset_name not in inventory.datasets:
+                continue
+
+            weights[dataset_name] = weight * math.exp((timestamp - now) / decay_constant)
+
+        LOG.info('Loaded %d dataset request weights.', len(weights))
+
+        return weights
 
     def _get_stored_records(self, inventory):
         """
         Get the dataset request data from DB.
         @param inventory  DynamoInventory
-        @return  {dataset: {jobid: GlobalQueueJob}}
+        @return  {dataset name: {jobid: GlobalQueueJob}}
         """
 
         # pick up requests that are less than 1 year old
@@ -58,15 +126,13 @@ class GlobalQueueRequestHistory(object):
             else:
                 current_dataset_name = dataset_name
 
-                try:
-                    dataset = inventory.datasets[dataset_name]
-                except KeyError:
+                if dataset_name not in inventory.datasets:
                     dataset_exists = False
                     continue
                 else:
                     dataset_exists = True
 
-                requests = all_requests[dataset] = {}
+                requests = all_requests[dataset_name] = {}
 
             requests[job_id] = GlobalQueueJob(queue_time, completion_time, nodes_total, nodes_done, nodes_failed, nodes_queued)
 
@@ -76,36 +142,38 @@ class GlobalQueueRequestHistory(object):
 
         return all_requests
 
-    def _compute(self, inventory, all_requests):
+    def _compute(self, all_requests):
         """
-        Set the dataset request weight based on request list. Formula:
+        Compute the dataset request weight based on request list. Formula:
           w = Sum(exp(-t_i/T))
         where t_i is the time distance of the ith request from now. T is defined in the configuration.
-        @param inventory     DynamoInventory
-        @param all_requests  {dataset: {jobid: GlobalQueueJob}}
+        @param all_requests  {dataset name: {jobid: GlobalQueueJob}}
+        @return  {dataset name: weight}
         """
 
         now = time.time()
         decay_constant = self.weight_halflife / math.log(2.)
 
-        for dataset in inventory.datasets.itervalues():
-            try:
-                requests = all_requests[dataset]
-            except KeyError:
-                dataset.attr['request_weight'] = 0.
-                continue
+        weights = {}
 
+        for dataset_name, requests in all_requests.iteritems():
             weight = 0.
             for job in requests.itervalues():
                 # first element of reqdata tuple is the queue time
                 weight += math.exp((job.queue_time - now) / decay_constant)
-            
-            dataset.attr['request_weight'] = weight
+
+            weights[dataset_name] = weight
+
+        return weights
 
     @staticmethod
     def update(config, inventory):
         htcondor = HTCondor(config.htcondor.config)
-        store = MySQL(config.store.db_params)
+
+        # dataset_requests and the weights are written with load_many
+        db_params = config.store.db_params.clone()
+        db_params.local_infile = True
+        store = MySQL(db_params)
 
         last_update = store.query('SELECT UNIX_TIMESTAMP(`dataset_requests_last_update`) FROM `system`')[0]
         try:
@@ -119,11 +187,125 @@ class GlobalQueueRequestHistory(object):
         source_records = GlobalQueueRequestHistory._get_source_records(htcondor, inventory, last_update)
 
         if not read_only:
+            # Request weights are accumulated if the halflife is configured
+            halflife_days = config.get('weight_halflife', 0.)
+
+            if halflife_days > 0.:
+                # must be called before the records are saved
+                new_requests = GlobalQueueRequestHistory._get_new_requests(source_records, store)
+
             GlobalQueueRequestHistory._save_records(source_records, store)
+
+            if halflife_days > 0.:
+                sql = 'SELECT `dataset_id`, UNIX_TIMESTAMP(`queue_time`) FROM `dataset_requests`'
+                sql += ' WHERE `queue_time` < DATE_SUB(NOW(), INTERVAL 1 YEAR)'
+                expired_requests = store.query(sql)
+
             # remove old entries
             store.query('DELETE FROM `dataset_requests` WHERE `queue_time` < DATE_SUB(NOW(), INTERVAL 1 YEAR)')
+
+            if halflife_days > 0.:
+                GlobalQueueRequestHistory._update_weights(store, halflife_days, new_requests, expired_requests)
+
             store.query('UPDATE `system` SET `dataset_requests_last_update` = NOW()')
 
+    @staticmethod
+    def _weights_available(store, halflife_days):
+        table = GlobalQueueRequestHistory.WEIGHT_TABLE
+
+        if not store.table_exists(table):
+            return False
+
+        result = store.query('SELECT MIN(`halflife`), MAX(`halflife`) FROM `%s`' % table)
+        if len(result) == 0 or result[0][0] is None:
+            # empty table
+            return False
+
+        # all weights must be computed with the given halflife
+        return abs(result[0][0] - halflife_days) < 1.e-6 and abs(result[0][1] - halflife_days) < 1.e-6
+
+    @staticmethod
+    def _get_new_requests(records, store):
+        """
+        Pick the requests in the source records that are not saved in the store yet.
+        @param records  {dataset: {jobid: GlobalQueueJob}}
+        @param store    MySQL interface
+        @return  [(dataset, queue_time)]
+        """
+
+        queue_times = [job.queue_time for requests in records.itervalues() for job in requests.itervalues()]
+        if len(queue_times) == 0:
+            return []
+
+        sql = 'SELECT `id` FROM `dataset_requests` WHERE `queue_time` >= FROM_UNIXTIME(%s)'
+        known_ids = set(store.query(sql, min(queue_times)))
+
+        new_requests = []
+        for dataset, requests in records.iteritems():
+            for job_id, job in requests.iteritems():
+                if job_id not in known_ids:
+                    new_requests.append((dataset, job.queue_time))
+
+        return new_requests
+
+    @staticmethod
+    def _update_weights(store, halflife_days, new_requests, expired_requests):
+        """
+        Update the decayed request weights. Each stored weight w(t0) evolves as
+          w(t) = w(t0) * exp(-(t - t0)/T) + Sum_{new}(exp(-(t - t_i)/T)) - Sum_{expired}(exp(-(t - t_i)/T))
+        so only the datasets with new or expired requests need to be updated. If there are no weights with
+        the given halflife, they are computed from all request records.
+        @param store             Write-allowed MySQL interface
+        @param halflife_days     Weight halflife in days
+        @param new_requests      [(dataset, queue_time)]
+        @param expired_requests  [(dataset_id, queue_time)]
+        """
+
+        table = GlobalQueueRequestHistory.WEIGHT_TABLE
+
+        now = int(time.time())
+        decay_constant = halflife_days * 3600. * 24. / math.log(2.)
+
+        if not store.table_exists(table):
+            LOG.info('Creating table %s.', table)
+            store.query('CREATE TABLE `%s` %s' % (table, GlobalQueueRequestHistory.WEIGHT_TABLE_DEFINITION))
+
+        if not GlobalQueueRequestHistory._weights_available(store, halflife_days):
+            LOG.info('Computing the request weights from all request records.')
+
+            store.query('DELETE FROM `%s`' % table)
+
+            sql = 'INSERT INTO `%s` (`dataset_id`, `halflife`, `weight`, `timestamp`)' % table
+            sql += ' SELECT `dataset_id`, %s, SUM(EXP((UNIX_TIMESTAMP(`queue_time`) - %s) / %s)), FROM_UNIXTIME(%s)'
+            sql += ' FROM `dataset_requests` WHERE `queue_time` > DATE_SUB(NOW(), INTERVAL 1 YEAR) GROUP BY `dataset_id`'
+            store.query(sql, halflife_days, now, decay_constant, now)
+
+            return
+
+        dataset_id_map = {}
+        store.make_map('datasets', set(d for d, _ in new_requests), dataset_id_map, None)
+
+        increments = collections.defaultdict(float) # {dataset_id: weight increment at now}
+        for dataset, queue_time in new_requests:
+            increments[dataset_id_map[dataset]] += math.exp((queue_time - now) / decay_constant)
+        for dataset_id, queue_time in expired_requests:
+            increments[dataset_id] -= math.exp((queue_time - now) / decay_constant)
+
+        if len(increments) == 0:
+            return
+
+        fields = ('dataset_id', 'weight', 'UNIX_TIMESTAMP(`timestamp`)')
+        for dataset_id, weight, timestamp in store.select_many(table, fields, 'dataset_id', increments.keys()):
+            increments[dataset_id] += weight * math.exp((timestamp - now) / decay_constant)
+
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+        # subtraction of expired requests can leave small negative values from rounding
+        data = [(dataset_id, halflife_days, max(weight, 0.), timestamp) for dataset_id, weight in increments.iteritems()]
+
+        store.load_many(table, ('dataset_id', 'halflife', 'weight', 'timestamp'), None, data, do_update = True)
+
+        LOG.info('Updated request weights of %d datasets.', len(data))
+
     @staticmethod
     def _get_source_records(htcondor, inventory, last_update):
         """
@@ -206,5 +388,5 @@ class GlobalQueueRequestHistory(object):
                     nodes_queued
                 ))
 
-        store.insert_many('dataset_requests', fields, None, data, do_update = True)
+        store.load_many('dataset_requests', fields, None, data, do_update = True)
 
@@ -7,6 +7,59 @@ from dynamo.dataformat import Block
 
 LOG = logging.getLogger(__name__)
 
+class PatternMatcher(object):
+    """
+    Matches names against a set of fnmatch patterns in one pass. Patterns are stored in a trie keyed by their
+    literal prefixes (part before the first wildcard character). A name is checked against the full pattern
+    only if it starts with the prefix.
+    """
+
+    def __init__(self, patterns):
+        # node = (children {char: node}, [(pattern, regex)])
+        self._root = ({}, [])
+
+        for pattern in set(patterns):
+            prefix = re.match('[^*?[]*', pattern).group(0)
+
+            node = self._root
+            for char in prefix:
+                try:
+                    node = node[0][char]
+                except KeyError:
+                    child = ({}, [])
+                    node[0][char] = child
+                    node = child
+
+            node[1].append((pattern, re.compile(fnmatch.translate(pattern))))
+
+    def match(self, name):
+        """
+        @param name  Name to match
+        @return  List of patterns matching the name.
+        """
+
+        matched = []
+
+        node = self._root
+        ichar = 0
+        while True:
+            for pattern, regex in node[1]:
+                if regex.match(name):
+                    matched.append(pattern)
+
+            if ichar == len(name):
+                break
+
+            try:
+                node = node[0][name[ichar]]
+            except KeyError:
+                break
+
+            ichar += 1
+
+        return matched
+
+
 class MySQLReplicaLock(object):
     """
     Dataset lock read from local DB.
@@ -23,15 +76,16 @@ class MySQLReplicaLock(object):
         for user, service in config.users:
             self.users.append((uesr, service))
 
-    def load(self, inventory):
-        query = 'SELECT `item`, `sites`, `groups` FROM `detox_locks` WHERE `unlock_date` IS NULL'
-        if len(self.users) != 0:
-            query += ' AND (`user_id`, `service_id`) IN ('
-            query += 'SELECT u.`id`, s.`id` FROM `users` AS u, `services` AS s WHERE '
-            query += ' OR '.join('(u.`name` LIKE "%s" AND s.`name` LIKE "%s")' % us for us in self.users)
-            query += ')'
+    def load(self, inventory, locks = None):
+        """
+        @param inventory  DynamoInventory or a view of it
+        @param locks      Return value of fetch(). If None, fetch(inventory) is called.
+        """
 
-        entries = self._mysql.query(query)
+        if locks is None:
+            locks = self.fetch(inventory)
+
+        entries, pattern_datasets = locks
 
         for item_name, sites_pattern, groups_pattern in entries:
             if '#' in item_name:
@@ -41,13 +95,8 @@ class MySQLReplicaLock(object):
                 block_pattern = None
 
             if '*' in dataset_pattern:
-                pat_exp = re.compile(fnmatch.translate(dataset_pattern))
-                
-                datasets = []
-                for dataset in inventory.datasets.values():
-                    # this is highly inefficient but I can't think of a better way
-                    if pat_exp.match(dataset.name):
-                        datasets.append(dataset)
+                # patterns were matched against the full inventory; inventory can be a view
+                datasets = [d for d in pattern_datasets[dataset_pattern] if d.name in inventory.datasets]
             else:
                 try:
                     dataset = inventory.datasets[dataset_pattern]
@@ -140,3 +189,36 @@ class MySQLReplicaLock(object):
                             locked_blocks[replica.site].add(block_replica.block)
 
         LOG.info('Locked %d items.', len(entries))
+
+    def fetch(self, inventory):
+        """
+        Read the active locks from the DB and match the wildcard dataset patterns against the inventory.
+        The result does not depend on which replicas are in the inventory passed to load(), so one fetch
+        can serve several loads on views of the inventory.
+        @param inventory  DynamoInventory
+        @return  ([(item, sites, groups)], {pattern: [datasets]})
+        """
+
+        query = 'SELECT `item`, `sites`, `groups` FROM `detox_locks` WHERE `unlock_date` IS NULL'
+        if len(self.users) != 0:
+            query += ' AND (`user_id`, `service_id`) IN ('
+            query += 'SELECT u.`id`, s.`id` FROM `users` AS u, `services` AS s WHERE '
+            query += ' OR '.join('(u.`name` LIKE "%s" AND s.`name` LIKE "%s")' % us for us in self.users)
+            query += ')'
+
+        entries = self._mysql.query(query)
+
+        # Match all wildcard dataset patterns against the inventory in a single pass
+        pattern_datasets = {} # {pattern: [datasets]}
+        for item_name, _, _ in entries:
+            dataset_pattern = item_name.partition('#')[0]
+            if '*' in dataset_pattern:
+                pattern_datasets[dataset_pattern] = []
+
+        if len(pattern_datasets) != 0:
+            matcher = PatternMatcher(pattern_datasets.iterkeys())
+            for dataset in inventory.datasets.itervalues():
+                for pattern in matcher.match(dataset.name):
+                    pattern_datasets[pattern].append(dataset)
+
+        return entries, pattern_datasets
@@ -9,6 +9,9 @@ from dynamo.dataformat import Dataset, Site
 from dynamo.policy.attrs import Attr, DatasetAttr, DatasetReplicaAttr, BlockReplicaAttr, ReplicaSiteAttr, SiteAttr, InvalidExpression
 
 class DatasetHasIncompleteReplica(DatasetAttr):
+    cacheable = True
+    scope = Attr.SCOPE_DATASET
+
     def __init__(self):
         DatasetAttr.__init__(self, Attr.BOOL_TYPE)
 
@@ -40,6 +43,9 @@ class DatasetStatus(DatasetAttr):
         return getattr(Dataset, 'STAT_' + expr)
 
 class DatasetOnTape(DatasetAttr):
+    cacheable = True
+    scope = Attr.SCOPE_DATASET
+
     def __init__(self):
         DatasetAttr.__init__(self, Attr.NUMERIC_TYPE)
 
@@ -75,6 +81,9 @@ class DatasetRelease(DatasetAttr):
             return '%d_%d_%d_%s' % version
 
 class DatasetNumFullDiskCopy(DatasetAttr):
+    cacheable = True
+    scope = Attr.SCOPE_DATASET
+
     def __init__(self):
         DatasetAttr.__init__(self, Attr.NUMERIC_TYPE)
 
@@ -87,6 +96,9 @@ class DatasetNumFullDiskCopy(DatasetAttr):
         return num
 
 class DatasetNumFullCopy(DatasetAttr):
+    cacheable = True
+    scope = Attr.SCOPE_DATASET
+
     def __init__(self):
         DatasetAttr.__init__(self, Attr.NUMERIC_TYPE)
 
@@ -99,6 +111,8 @@ class DatasetNumFullCopy(DatasetAttr):
         return num
 
 class ReplicaSize(DatasetReplicaAttr):
+    cacheable = True
+
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.NUMERIC_TYPE)
 
@@ -106,6 +120,8 @@ class ReplicaSize(DatasetReplicaAttr):
         return replica.size()
 
 class ReplicaIncomplete(DatasetReplicaAttr):
+    cacheable = True
+
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.BOOL_TYPE)
 
@@ -142,6 +158,9 @@ class ReplicaNumAccess(DatasetReplicaAttr):
             return 0
 
 class ReplicaNumFullDiskCopyCommonOwner(DatasetReplicaAttr):
+    cacheable = True
+    scope = Attr.SCOPE_DATASET
+
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.NUMERIC_TYPE)
 
@@ -160,6 +179,9 @@ class ReplicaNumFullDiskCopyCommonOwner(DatasetReplicaAttr):
 class ReplicaIsLastSource(DatasetReplicaAttr):
     """True if this replica is the last full disk copy and there is an ongoing transfer."""
 
+    cacheable = True
+    scope = Attr.SCOPE_DATASET
+
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.BOOL_TYPE)
 
@@ -178,6 +200,8 @@ class ReplicaIsLastSource(DatasetReplicaAttr):
         return nfull == 1 and nincomplete != 0
 
 class ReplicaFirstBlockCreated(DatasetReplicaAttr):
+    cacheable = True
+
     def __init__(self):
         DatasetReplicaAttr.__init__(self, Attr.TIME_TYPE)
 
@@ -45,6 +45,15 @@ class DatasetInfoSource(object):
         """
         raise NotImplementedError('get_dataset')
 
+    def get_dataset_summaries(self, names):
+        """
+        Get Datasets with Blocks but without Files, for a quick check of changes. Dataset attributes that
+        require additional queries (status, data type, software version) are not set.
+        @param names  List of dataset names
+        @return  List of datasets. Unknown datasets are not included.
+        """
+        raise NotImplementedError('get_dataset_summaries')
+
     def get_block(self, name, dataset = None, with_files = False):
         """
         Get a linked set of Blocks-Files with full information.
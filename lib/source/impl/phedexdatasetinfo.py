@@ -19,6 +19,9 @@ class PhEDExDatasetInfoSource(DatasetInfoSource):
         self._phedex = PhEDEx(config.phedex)
         self._dbs = RESTService(config.dbs)
 
+        # number of datasets per PhEDEx query in get_dataset_summaries
+        self.summary_chunk_size = config.get('summary_chunk_size', 20)
+
     def get_dataset_names(self, include = ['*'], exclude = []):
         dataset_names = []
 
@@ -88,23 +91,35 @@ class PhEDExDatasetInfoSource(DatasetInfoSource):
         dataset = self._create_dataset(dataset_entry)
 
         ## Fill block and file data
-        if 'block' in dataset_entry:
-            for block_entry in dataset_entry['block']:
-                block = self._create_block(block_entry, dataset)
-                dataset.blocks.add(block)
-
-                # size and num_files are left 0 in _create_dataset (PhEDEx does not tell)
-                dataset.size += block.size
-                dataset.num_files += block.num_files
-
-                if with_files and 'file' in block_entry:
-                    # See comments in get_block
-                    block._files = set()
-                    for file_entry in block_entry['file']:
-                        block._files.add(self._create_file(file_entry, block))
+        self._fill_blocks(dataset, dataset_entry, with_files)
         
         return dataset
 
+    def get_dataset_summaries(self, names): #override
+        ## Get the dataset-block data of multiple datasets per PhEDEx call, without querying DBS
+
+        names = list(names)
+        args = []
+        for istart in range(0, len(names), self.summary_chunk_size):
+            options = ['dataset=' + name for name in names[istart:istart + self.summary_chunk_size]]
+            options.append('level=block')
+            args.append(('data', options))
+
+        datasets = []
+
+        for result in Map().execute(self._phedex.make_request, args):
+            try:
+                dataset_entries = result[0]['dataset']
+            except:
+                continue
+
+            for dataset_entry in dataset_entries:
+                dataset = self._create_dataset(dataset_entry, with_details = False)
+                self._fill_blocks(dataset, dataset_entry, False)
+                datasets.append(dataset)
+
+        return datasets
+
     def get_block(self, name, dataset = None, with_files = False): #override
         ## Get the full block-file data from PhEDEx
 
@@ -226,9 +241,10 @@ class PhEDExDatasetInfoSource(DatasetInfoSource):
 
         return files
 
-    def _create_dataset(self, dataset_entry):
+    def _create_dataset(self, dataset_entry, with_details = True):
         """
         Create a dataset object with blocks and files from a PhEDEx dataset entry
+        @param with_details  Query DBS for status, data type, and software version
         """
 
         dataset = Dataset(
@@ -242,10 +258,29 @@ class PhEDExDatasetInfoSource(DatasetInfoSource):
             dataset.last_update = int(dataset_entry['time_create'])
 
         ## Get other details of the dataset from DBS
-        self._fill_dataset_details(dataset)
+        if with_details:
+            self._fill_dataset_details(dataset)
 
         return dataset
 
+    def _fill_blocks(self, dataset, dataset_entry, with_files):
+        if 'block' not in dataset_entry:
+            return
+
+        for block_entry in dataset_entry['block']:
+            block = self._create_block(block_entry, dataset)
+            dataset.blocks.add(block)
+
+            # size and num_files are left 0 in _create_dataset (PhEDEx does not tell)
+            dataset.size += block.size
+            dataset.num_files += block.num_files
+
+            if with_files and 'file' in block_entry:
+                # See comments in get_block
+                block._files = set()
+                for file_entry in block_entry['file']:
+                    block._files.add(self._create_file(file_entry, block))
+
     def _create_block(self, block_entry, dataset):
         """
         Create a block object with files from a PhEDEx block entry
@@ -3,6 +3,7 @@ import sys
 import logging
 import time
 import re
+import tempfile
 
 import MySQLdb
 import MySQLdb.converters
@@ -47,6 +48,14 @@ class MySQL(object):
         # default 1M characters
         self.max_query_len = config.get('max_query_len', 1000000)
 
+        # LOAD DATA LOCAL INFILE must be allowed by both the client and the server
+        # Opt-in: with local_infile, the server can request any file readable by the client
+        if config.get('local_infile', False):
+            self._connection_parameters['local_infile'] = 1
+            self._local_infile_available = None # unknown until the server is asked
+        else:
+            self._local_infile_available = False
+
     def db_name(self):
         return self._connection_parameters['db']
 
@@ -324,6 +333,108 @@ class MySQL(object):
 
             self.query(sqlbase % values)
 
+    def load_many(self, table, fields, mapping, objects, do_update = True):
+        """
+        Bulk version of insert_many. Rows are written to a temporary file and loaded with a single
+        LOAD DATA LOCAL INFILE statement. With do_update, the rows are loaded into a temporary table first
+        and merged into the target with INSERT ... SELECT ... ON DUPLICATE KEY UPDATE, which requires
+        reuse_connection. Falls back to insert_many if the bulk load is not possible (e.g. the connection
+        is not configured with local_infile).
+        Arguments are the same as insert_many.
+        """
+
+        if not self._check_local_infile() or (do_update and not self.reuse_connection):
+            self.insert_many(table, fields, mapping, objects, do_update = do_update)
+            return
+
+        fields_str = ','.join(['`%s`' % f for f in fields])
+
+        with tempfile.NamedTemporaryFile(prefix = 'dynamo_load_', suffix = '.tsv') as load_file:
+            num_rows = 0
+            for obj in objects:
+                if mapping is None:
+                    row = obj
+                else:
+                    row = mapping(obj)
+
+                load_file.write('\t'.join(MySQL._to_infile_value(v) for v in row) + '\n')
+                num_rows += 1
+
+            if num_rows == 0:
+                return
+
+            load_file.flush()
+
+            try:
+                if do_update:
+                    # table may be given as db`.`table
+                    tmp_table = '%s_load' % table.replace('`.`', '_')
+
+                    self.query('CREATE TEMPORARY TABLE `%s` LIKE `%s`' % (tmp_table, table), retries = 0, silent = True)
+                    try:
+                        self._load_file(load_file.name, tmp_table, fields_str)
+
+                        sql = 'INSERT INTO `{table}` ({fields}) SELECT {fields} FROM `{tmp}`'.format(table = table, fields = fields_str, tmp = tmp_table)
+                        sql += ' ON DUPLICATE KEY UPDATE ' + ','.join(['`{f}`=VALUES(`{f}`)'.format(f = f) for f in fields])
+                        self.query(sql)
+                    finally:
+                        self.query('DROP TEMPORARY TABLE IF EXISTS `%s`' % tmp_table)
+
+                else:
+                    self._load_file(load_file.name, table, fields_str)
+
+            except MySQLdb.Error as err:
+                LOG.warning('Bulk load into %s failed (%s). Falling back to INSERT statements.', table, str(err))
+                self._local_infile_available = False
+
+                load_file.seek(0)
+                self.insert_many(table, fields, None, MySQL._read_infile(load_file), do_update = do_update)
+
+    def _check_local_infile(self):
+        if self._local_infile_available is None:
+            result = self.query('SHOW GLOBAL VARIABLES LIKE \'local_infile\'')
+            self._local_infile_available = (len(result) != 0 and result[0][1] == 'ON')
+            if not self._local_infile_available:
+                LOG.info('LOAD DATA LOCAL INFILE is disabled on the server. Bulk loads will use INSERT statements.')
+
+        return self._local_infile_available
+
+    def _load_file(self, file_name, table, fields_str):
+        sql = 'LOAD DATA LOCAL INFILE %s INTO TABLE `{table}` ({fields})'.format(table = table, fields = fields_str)
+        # errors are handled by the caller
+        self.query(sql, file_name, retries = 0, silent = True)
+
+    @staticmethod
+    def _to_infile_value(value):
+        # LOAD DATA default format: tab-separated, backslash-escaped, \N for NULL
+        if value is None:
+            return '\\N'
+        elif type(value) is bool:
+            return str(int(value))
+        elif type(value) is float:
+            return repr(value)
+        elif type(value) is unicode:
+            value = value.encode('utf-8')
+        elif type(value) is not str:
+            return str(value)
+
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\0', '\\0')
+
+    @staticmethod
+    def _read_infile(load_file):
+        # inverse of _to_infile_value; values other than NULL are returned as strings
+        unescape = {'\\': '\\', 't': '\t', 'n': '\n', '0': '\0'}
+
+        for line in load_file:
+            row = []
+            for value in line[:-1].split('\t'):
+                if value == '\\N':
+                    row.append(None)
+                else:
+                    row.append(re.sub(r'\\(.)', lambda m: unescape[m.group(1)], value))
+
+            yield tuple(row)
+
     def make_snapshot(self, tag):
         snapshot_db = self.db_name() + '_' + tag
 
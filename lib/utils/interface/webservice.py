@@ -3,11 +3,15 @@ import os
 import urllib
 import urllib2
 import httplib
+import socket
+import select
 import ssl
 import time
 import json
 import re
 import logging
+import threading
+from cStringIO import StringIO
 
 from dynamo.dataformat import Configuration, ConfigurationError
 from dynamo.utils.transform import unicode2str
@@ -24,7 +28,167 @@ except AttributeError:
     # If the switch does not exist, hope urllib2 doesn't verify the server by default
     pass
 
-class HTTPSCertKeyHandler(urllib2.HTTPSHandler):
+class ConnectionPool(object):
+    """
+    Idle persistent HTTP(S) connections, keyed by host and authentication. Connections are taken out of
+    the pool while in use, so the pool can be shared by multiple threads.
+    """
+
+    def __init__(self, max_idle = 8, idle_timeout = 60.):
+        # maximum number of idle connections per key
+        self.max_idle = max_idle
+        # idle connections older than this are discarded (servers close them anyway)
+        self.idle_timeout = idle_timeout
+
+        self._idle = {} # {key: [(connection, time of last use)]}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, key):
+        """Return an idle connection for the key or None."""
+
+        with self._lock:
+            self._check_fork()
+
+            try:
+                connections = self._idle[key]
+            except KeyError:
+                return None
+
+            now = time.time()
+            while len(connections) != 0:
+                connection, last_use = connections.pop()
+                if now - last_use < self.idle_timeout and not ConnectionPool._is_dropped(connection):
+                    return connection
+
+                connection.close()
+
+            return None
+
+    def put(self, key, connection):
+        with self._lock:
+            self._check_fork()
+
+            try:
+                connections = self._idle[key]
+            except KeyError:
+                connections = self._idle[key] = []
+
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.time()))
+                connection = None
+
+        if connection is not None:
+            connection.close()
+
+    @staticmethod
+    def _is_dropped(connection):
+        # An idle connection has nothing to read unless the server closed it
+        if connection.sock is None:
+            return True
+
+        try:
+            return len(select.select([connection.sock], [], [], 0)[0]) != 0
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _check_fork(self):
+        # Connections inherited from the parent process must not be used
+        if os.getpid() != self._pid:
+            self._idle = {}
+            self._pid = os.getpid()
+
+
+class KeepAliveHandlerMixin:
+    # Old-style class, like the urllib2 handlers it is mixed into
+    """
+    Replacement of urllib2.AbstractHTTPHandler.do_open that reuses connections from the ConnectionPool.
+    The response body is read in full so the connection can be returned to the pool immediately.
+    A request on a reused connection that the server has closed in the meantime is retried on a new
+    connection if it could not be sent, or if its method is idempotent. Other requests (e.g. POST) may
+    have been processed by the server before the connection dropped, and are not resent.
+    """
+
+    connection_pool = ConnectionPool()
+
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+    def connection_key(self, req):
+        """Connections are shared among handler objects with identical key."""
+
+        return (req.get_type(), req.get_host())
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        key = self.connection_key(req)
+
+        response = None
+
+        connection = KeepAliveHandlerMixin.connection_pool.get(key)
+        if connection is not None:
+            sent = False
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                sent = True
+                response, body = self._receive(connection)
+            except (socket.error, httplib.HTTPException) as err:
+                # stale connection
+                connection.close()
+
+                if sent and req.get_method() not in KeepAliveHandlerMixin.idempotent_methods:
+                    # the server may have processed the request
+                    raise urllib2.URLError(err)
+
+        if response is None:
+            connection = http_class(host, timeout = req.timeout, **http_conn_args)
+            connection.set_debuglevel(self._debuglevel)
+
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                response, body = self._receive(connection)
+            except socket.error as err:
+                connection.close()
+                raise urllib2.URLError(err)
+            except:
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            KeepAliveHandlerMixin.connection_pool.put(key, connection)
+
+        resp = urllib.addinfourl(StringIO(body), response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+
+        return resp
+
+    def _receive(self, connection):
+        response = connection.getresponse(buffering = True)
+        body = response.read()
+
+        return response, body
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+    """HTTP handler with persistent connections."""
+    pass
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+    """HTTPS handler with persistent connections and no client authentication."""
+    pass
+
+
+class HTTPSCertKeyHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
     """
     HTTPS handler authenticating by x509 user key and certificate.
     """
@@ -54,38 +218,31 @@ class HTTPSCertKeyHandler(urllib2.HTTPSHandler):
     def create_connection(self, host, timeout = 300):
         return httplib.HTTPSConnection(host, key_file = self.key, cert_file = self.cert)
 
+    def connection_key(self, req):
+        # connections are authenticated with the certificate
+        return (req.get_type(), req.get_host(), self.key, self.cert)
+
 
-class CERNSSOCookieAuthHandler(urllib2.HTTPSHandler):
+class CERNSSOCookieAuthHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
     """
     HTTPS handler for CERN single sign-on service. Requires a cookie file
-    generated by cern-get-sso-cookie.
+    generated by cern-get-sso-cookie. The file is read again when it is renewed.
     """
 
     def __init__(self, config):
         urllib2.HTTPSHandler.__init__(self)
 
+        self.cookie_file = config.cookie_file
         self.cookies = {}
 
-        with open(config.cookie_file) as cookie_file:
-            # skip the header
-            while cookie_file.readline().strip():
-                pass
+        self._cookie_mtime = None
+        self._cookie_lock = threading.Lock()
 
-            for line in cookie_file:
-                domain, dom_specified, path, secure, expires, name, value = line.split()
-
-                # for some reason important entries are commented out
-                if domain.startswith('#'):
-                    domain = domain[1:]
-
-                domain = domain.replace('HttpOnly_', '')
-
-                if domain not in self.cookies:
-                    self.cookies[domain] = [(name, value)]
-                else:
-                    self.cookies[domain].append((name, value))
+        self._load_cookies()
 
     def https_request(self, request):
+        self._load_cookies()
+
         try:
             cookies = self.cookies[request.get_host()]
             # concatenate all cookies for the domain with '; '
@@ -95,6 +252,41 @@ class CERNSSOCookieAuthHandler(urllib2.HTTPSHandler):
 
         return urllib2.HTTPSHandler.https_request(self, request)
 
+    def _load_cookies(self):
+        """Read the cookie file if it was modified since the last read."""
+
+        with self._cookie_lock:
+            mtime = os.stat(self.cookie_file).st_mtime
+            if mtime == self._cookie_mtime:
+                return
+
+            cookies = {}
+
+            with open(self.cookie_file) as cookie_file:
+                # skip the header
+                while cookie_file.readline().strip():
+                    pass
+
+                for line in cookie_file:
+                    domain, dom_specified, path, secure, expires, name, value = line.split()
+
+                    # for some reason important entries are commented out
+                    if domain.startswith('#'):
+                        domain = domain[1:]
+
+                    domain = domain.replace('HttpOnly_', '')
+
+                    if domain not in cookies:
+                        cookies[domain] = [(name, value)]
+                    else:
+                        cookies[domain].append((name, value))
+
+            if self._cookie_mtime is not None:
+                LOG.info('Reloaded SSO cookies from %s.', self.cookie_file)
+
+            self.cookies = cookies
+            self._cookie_mtime = mtime
+
 
 class RESTService(object):
     """
@@ -130,6 +322,10 @@ class RESTService(object):
         self.last_errorcode = 0
         self.last_exception = None
 
+        # The opener is created at the first request and reused. Connections are pooled in the handlers.
+        self._opener = None
+        self._opener_lock = threading.Lock()
+
     def make_request(self, resource = '', options = [], method = GET, format = 'url', retry_on_error = True):
         """
         @param resource       What comes after url_base
@@ -198,22 +394,7 @@ class RESTService(object):
         last_except = None
         while len(exceptions) != self.num_attempts:
             try:
-                if self.auth_handler:
-                    opener = urllib2.build_opener(self.auth_handler(self.auth_handler_conf))
-                else:
-                    opener = urllib2.build_opener()
-
-                if 'Accept' not in self.headers:
-                    opener.addheaders.append(('Accept', self.accept))
-
-                opener.addheaders.extend(self.headers)
-
-                response = opener.open(request)
-
-                # clean up - break reference cycle so python can free the memory up
-                for handler in opener.handlers:
-                    handler.parent = None
-                del opener
+                response = self._get_opener().open(request)
 
                 content = response.read()
                 del response
@@ -253,3 +434,22 @@ class RESTService(object):
         LOG.error('%s' % ' '.join(map(str, exceptions)))
 
         raise RuntimeError('webservice too many attempts')
+
+    def _get_opener(self):
+        with self._opener_lock:
+            if self._opener is None:
+                if self.auth_handler:
+                    https_handler = self.auth_handler(self.auth_handler_conf)
+                else:
+                    https_handler = KeepAliveHTTPSHandler()
+
+                opener = urllib2.build_opener(KeepAliveHTTPHandler(), https_handler)
+
+                if 'Accept' not in self.headers:
+                    opener.addheaders.append(('Accept', self.accept))
+
+                opener.addheaders.extend(self.headers)
+
+                self._opener = opener
+
+            return self._opener
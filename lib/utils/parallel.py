@@ -1,38 +1,140 @@
+import os
 import time
+import atexit
 import multiprocessing
 import threading
+import Queue
 
 from dynamo.dataformat import Configuration
 
-class FunctionWrapper(object):
-    def __init__(self, function, start_sem, done_sem):
+class ThreadTimeout(RuntimeError):
+    pass
+
+
+class WorkerPool(object):
+    """
+    A set of long-lived daemon threads executing tasks from a queue. Pools are created on demand
+    and shared among all ThreadControllers of the process (see WorkerPool.get).
+    """
+
+    _pools = {} # {(num_threads, depth): pool}
+    _pools_lock = threading.Lock()
+
+    @staticmethod
+    def get(num_threads):
+        """
+        Return the shared pool with num_threads workers. Tasks submitted from a worker thread go to a
+        separate pool, so that nested Map calls cannot exhaust the workers of the outer call.
+        """
+
+        depth = getattr(threading.current_thread(), 'pool_depth', 0)
+
+        with WorkerPool._pools_lock:
+            try:
+                pool = WorkerPool._pools[(num_threads, depth)]
+            except KeyError:
+                pool = None
+
+            if pool is None or pool.pid != os.getpid():
+                # threads do not survive a fork - create a new pool in a child process
+                pool = WorkerPool._pools[(num_threads, depth)] = WorkerPool(num_threads, depth + 1)
+
+        return pool
+
+    @staticmethod
+    def clear_all():
+        """Drop queued tasks of all pools so that idle workers stay blocked during interpreter shutdown."""
+
+        with WorkerPool._pools_lock:
+            for pool in WorkerPool._pools.itervalues():
+                with pool._tasks.mutex:
+                    pool._tasks.queue.clear()
+
+    def __init__(self, num_threads, depth):
+        self.pid = os.getpid()
+        self.depth = depth
+
+        self._tasks = Queue.Queue()
+
+        for _ in range(num_threads):
+            self._add_worker()
+
+    def submit(self, task):
+        self._tasks.put(task)
+
+    def replace(self, thread):
+        """Retire a worker thread stuck in a timed-out task and start a new one in its place."""
+
+        thread.retired = True
+        self._add_worker()
+
+    def _add_worker(self):
+        thread = threading.Thread(target = self._work)
+        thread.daemon = True
+        thread.pool_depth = self.depth
+        thread.retired = False
+        thread.start()
+
+    def _work(self):
+        thread = threading.current_thread()
+
+        while not thread.retired:
+            task = self._tasks.get()
+            task.run(thread)
+
+atexit.register(WorkerPool.clear_all)
+
+
+class WorkerTask(object):
+    """A slice of inputs executed by a worker. Result is delivered to the results queue of the controller."""
+
+    def __init__(self, function, inputs, name, results):
         self.function = function
-        self._start_sem = start_sem
-        self._done_sem = done_sem
+        self.inputs = inputs
+        self.name = name
+        self.results = results
 
-    def __call__(self, inputs, outputs, exception):
-        try:
-            for args in inputs:
-                output = self.function(*args)
-                outputs.append(output)
+        self.thread = None
+        self.start_time = 0
+        self.done = False
+        self.cancelled = False
 
-        except Exception as ex:
-            exception.set(ex)
+    def run(self, thread):
+        if self.cancelled:
+            return
 
-        self._start_sem.release()
-        self._done_sem.release()
+        self.thread = thread
+        self.start_time = time.time()
 
+        thread_name = thread.name
+        if self.name:
+            thread.name = self.name
 
-class ExceptionHolder(object):
-    def __init__(self):
-        self.exception = None
+        outputs = []
+        exception = None
 
-    def set(self, exc):
-        self.exception = exc
+        try:
+            for args in self.inputs:
+                output = self.function(*args)
+                outputs.append(output)
 
+        except BaseException as ex:
+            # SystemExit etc. are also passed to the controller, which would otherwise wait forever
+            exception = ex
 
-class ThreadTimeout(RuntimeError):
-    pass
+        finally:
+            thread.name = thread_name
+
+            self.done = True
+            self.results.put((self, outputs, exception))
+
+    def thread_name(self):
+        if self.name:
+            return self.name
+        elif self.thread is not None:
+            return self.thread.name
+        else:
+            return ''
 
 
 class ThreadController(object):
@@ -47,9 +149,11 @@ class ThreadController(object):
         self._start_time = 0
         self._ndone = 0
         self._watermark = 0
+        # last time running tasks were checked for timeout
+        self._last_check = 0
 
-        self._start_sem = threading.Semaphore(num_threads)
-        self._done_sem = threading.Semaphore(0)
+        self._pool = WorkerPool.get(num_threads)
+        self._results = Queue.Queue()
         self._target_function = function
 
         self._inputs = []
@@ -68,135 +172,117 @@ class ThreadController(object):
         """Run all threads and return the full list of outputs."""
 
         all_outputs = []
-        thread_defs = []
-
-        for arguments, name in self._inputs:
-            self._start_one(arguments, name, thread_defs)
-            self._collect_threads(thread_defs, all_outputs)
 
-        while len(thread_defs) != 0:
-            self._collect_threads(thread_defs, all_outputs, blocking = True)
-
-        self._start_time = 0
-        self._ndone = 0
-        self._watermark = 0
-        self._inputs = []
+        for outputs in self._run():
+            all_outputs.extend(outputs)
 
         return all_outputs
 
     def iterate(self):
         """Run threads and yield the outputs as they become available."""
 
-        all_outputs = []
-        thread_defs = []
+        for outputs in self._run():
+            for output in outputs:
+                yield output
 
-        while True:
-            while len(self._inputs) != 0:
-                arguments, name = self._inputs[-1]
-                if self._start_one(arguments, name, thread_defs, blocking = False):
-                    self._inputs.pop()
-                else:
-                    break
+    def _run(self):
+        """
+        Submit all inputs to the pool and yield the output lists of the tasks as they complete.
+        Tasks that have not started are cancelled when the iteration is abandoned or an exception is raised.
+        """
 
-            if len(all_outputs) == 0:
-                if len(self._inputs) == 0 and len(thread_defs) == 0:
-                    # we are done
-                    return
+        tasks = set()
+        for arguments, name in self._inputs:
+            task = WorkerTask(self._target_function, arguments, name, self._results)
+            tasks.add(task)
+            self._pool.submit(task)
 
-                # otherwise block until there is a thread completed
-                self._collect_threads(thread_defs, all_outputs, blocking = True)
+        self._inputs = []
+        self._start_time = time.time()
 
-            else:
-                yield all_outputs.pop()
+        try:
+            while len(tasks) != 0:
+                task, outputs, exception = self._wait(tasks)
+                tasks.remove(task)
 
-    def _start_one(self, arguments, name, thread_defs, blocking = True):
-        # If blocking = True, return False immediately unless there is a free slot
+                self._collect_one(task, exception)
 
-        if not blocking:
-            if not self._start_sem.acquire(False):
-                return False
+                yield outputs
 
-            self._start_sem.release()
+        finally:
+            for task in tasks:
+                task.cancelled = True
 
-        exception = ExceptionHolder()
-        outputs = []
+            self._start_time = 0
+            self._ndone = 0
+            self._watermark = 0
 
-        target = FunctionWrapper(self._target_function, self._start_sem, self._done_sem)
-        thread = threading.Thread(target = target, args = (arguments, outputs, exception))
-        thread.daemon = True
-        if name:
-            thread.name = name
+    def _wait(self, tasks):
+        """
+        Block until a task is completed and return (task, outputs, exception).
+        Raise ThreadTimeout if a running task exceeds the timeout.
+        """
 
-        # Blocks here until there is a free slot
-        self._start_sem.acquire()
-        thread.start()
-        if self._start_time == 0:
-            self._start_time = time.time()
-
-        thread_defs.append((thread, time.time(), arguments, exception, outputs))
-
-        return True
-
-    def _collect_threads(self, thread_defs, all_outputs, blocking = False):
-        if blocking:
-            # Block until there is a completed thread
-            self._done_sem.acquire()
-            # Increment the semaphore count by one (to be reduced below)
-            self._done_sem.release()
-
-        ith = 0
-        while ith != len(thread_defs):
-            thread, start_time, arguments, exception, outputs = thread_defs[ith]
-            if self._collect_one(thread, start_time, arguments, exception):
-                thread_defs.pop(ith)
-                all_outputs.extend(outputs)
-                # Reduce the semaphore count by one
-                self._done_sem.acquire()
-            else:
-                ith += 1
-
-    def _collect_one(self, thread, time_started, inputs, exception):
-        if thread.is_alive():
-            if self.timeout > 0 and time.time() - time_started > self.timeout:
-                if self.logger:
-                    self.logger.error('Thread ' + thread.name + ' timed out.')
-                    self.logger.error('Inputs: ' + str([str(i) for i in inputs]))
+        if self.timeout <= 0:
+            return self._results.get()
 
-                raise ThreadTimeout(thread.name)
+        check_interval = min(self.timeout, 1.)
 
-            return False
+        while True:
+            try:
+                result = self._results.get(timeout = check_interval)
+            except Queue.Empty:
+                result = None
+
+            now = time.time()
+            if result is None or now - self._last_check > check_interval:
+                self._last_check = now
+                for task in tasks:
+                    if task.start_time != 0 and not task.done and now - task.start_time > self.timeout:
+                        self._timeout(task)
+
+            if result is not None:
+                return result
+
+    def _timeout(self, task):
+        if self.logger:
+            self.logger.error('Thread ' + task.thread_name() + ' timed out.')
+            self.logger.error('Inputs: ' + str([str(i) for i in task.inputs]))
 
-        thread.join()
+        # the thread cannot be stopped; let it finish in the background and replace it in the pool
+        self._pool.replace(task.thread)
 
-        if exception.exception is not None:
+        raise ThreadTimeout(task.thread_name())
+
+    def _collect_one(self, task, exception):
+        if exception is not None:
             if self.logger:
-                self.logger.error('Exception in thread ' + thread.name)
-                self.logger.error('Inputs: ' + str([str(i) for i in inputs]))
+                self.logger.error('Exception in thread ' + task.thread_name())
+                self.logger.error('Inputs: ' + str([str(i) for i in task.inputs]))
 
             if self.repeat_on_exception:
                 if self.logger:
                     self.logger.error('Repeating execution')
 
-                for args in inputs:
-                    self.target.function(*args) # no catch
+                for args in task.inputs:
+                    self._target_function(*args) # no catch
 
                 if self.logger:
                     self.logger.error('No exception was thrown during the repeat.')
 
-            raise exception.exception
+            raise exception
 
         if self.ntotal != 0 and self.logger: # progress report requested
-            self._ndone += len(inputs)
+            self._ndone += len(task.inputs)
             if self._ndone == self.ntotal or self._ndone > self._watermark:
                 self.logger.info('Processed %.1f%% of input (%ds elapsed).', 100. * self._ndone / self.ntotal, int(time.time() - self._start_time))
-                self.watermark += max(1, self._ntotal / 20)
-
-        return True
+                self._watermark += max(1, self.ntotal / 20)
 
 class Map(object):
     """
     Similar to multiprocessing.Pool.map but with threads. At each execute() call, instantiate a ThreadController
-    object to do the real work. Output list can be out of order.
+    object to do the real work. Threads are taken from a WorkerPool that persists across calls. Output list can
+    be out of order.
     """
 
     def __init__(self, config = Configuration()):
@@ -224,7 +310,7 @@ class Map(object):
             return []
 
         controller = ThreadController(function, self.num_threads)
-       
+
         controller.print_progress = self.print_progress
         controller.timeout = self.timeout
         controller.repeat_on_exception = self.repeat_on_exception
@@ -243,7 +329,7 @@ class Map(object):
             if len(inputs) == self.task_per_thread:
                 controller.add_inputs(inputs)
                 inputs = []
-    
+
         if len(inputs) != 0:
             controller.add_inputs(inputs)
 
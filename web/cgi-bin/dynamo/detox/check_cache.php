@@ -27,72 +27,83 @@ function check_cache($history_db, $cycle, $partition_id, $snapshot_spool_path, $
 
   if ($num_replica_table == 0 || $num_site_table == 0) {
     $sqlite_file_name = sprintf('%s/snapshot_%09d.db', $snapshot_spool_path, $cycle);
+    $srun = sprintf('%09d', $cycle);
+    $archive_file_name = sprintf('%s/%s/%s/snapshot_%09d.xzs', $snapshot_archive_path, substr($srun, 0, 3), substr($srun, 3, 3), $cycle);
 
-    if (!file_exists($sqlite_file_name)) {
-      $srun = sprintf('%09d', $cycle);
-      $xz_file_name = sprintf('%s/%s/%s/snapshot_%09d.db.xz', $snapshot_archive_path, substr($srun, 0, 3), substr($srun, 3, 3), $cycle);
-      if (!file_exists($xz_file_name))
-        return false;
+    if (!file_exists($sqlite_file_name) && file_exists($archive_file_name)) {
+      // chunked archive (SnapshotArchive in lib/history/impl/mysqlhistory.py)
+      $replica_table = ($num_replica_table == 0) ? $replica_cache_table_name : '';
+      $site_table = ($num_site_table == 0) ? $site_cache_table_name : '';
 
-      exec('which unxz > /dev/null 2>&1', $stdout, $rc);
-      if ($rc != 0)
+      if (!fill_cache_from_archive($history_db, $archive_file_name, $cache_db_name, $replica_table, $site_table))
         return false;
-      
-      exec(sprintf('unxz -k -c %s > %s', $xz_file_name, $sqlite_file_name));
-      chmod($sqlite_file_name, 0666);
     }
+    else {
+      if (!file_exists($sqlite_file_name)) {
+        $xz_file_name = sprintf('%s/%s/%s/snapshot_%09d.db.xz', $snapshot_archive_path, substr($srun, 0, 3), substr($srun, 3, 3), $cycle);
+        if (!file_exists($xz_file_name))
+          return false;
+
+        exec('which unxz > /dev/null 2>&1', $stdout, $rc);
+        if ($rc != 0)
+          return false;
+      
+        exec(sprintf('unxz -k -c %s > %s', $xz_file_name, $sqlite_file_name));
+        chmod($sqlite_file_name, 0666);
+      }
 
-    $snapshot_db = new SQLite3($sqlite_file_name);
+      $snapshot_db = new SQLite3($sqlite_file_name);
 
-    if ($num_replica_table == 0) {
-      $sql = 'SELECT r.`site_id`, r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r';
-      $sql .= ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`';
-      $in_stmt = $snapshot_db->prepare($sql);
-      $result = $in_stmt->execute();
+      if ($num_replica_table == 0) {
+        $sql = 'SELECT r.`site_id`, r.`dataset_id`, r.`size`, d.`value`, r.`condition` FROM `replicas` AS r';
+        $sql .= ' INNER JOIN `decisions` AS d ON d.`id` = r.`decision_id`';
+        $in_stmt = $snapshot_db->prepare($sql);
+        $result = $in_stmt->execute();
 
-      $history_db->query(sprintf('CREATE TABLE `%s`.`%s` LIKE `%s`.`replicas`', $cache_db_name, $replica_cache_table_name, $cache_db_name));
+        $history_db->query(sprintf('CREATE TABLE `%s`.`%s` LIKE `%s`.`replicas`', $cache_db_name, $replica_cache_table_name, $cache_db_name));
 
-      $stmt = $history_db->prepare(sprintf('INSERT INTO `%s`.`%s` VALUES (?, ?, ?, ?, ?)', $cache_db_name, $replica_cache_table_name));
-      $stmt->bind_param('iiisi', $site_id, $dataset_id, $size, $decision, $condition);
+        $stmt = $history_db->prepare(sprintf('INSERT INTO `%s`.`%s` VALUES (?, ?, ?, ?, ?)', $cache_db_name, $replica_cache_table_name));
+        $stmt->bind_param('iiisi', $site_id, $dataset_id, $size, $decision, $condition);
 
-      while (($arr = $result->fetchArray(SQLITE3_NUM))) {
-        $site_id = $arr[0];
-        $dataset_id = $arr[1];
-        $size = $arr[2];
-        $decision = $arr[3];
-        $condition = $arr[4];
+        while (($arr = $result->fetchArray(SQLITE3_NUM))) {
+          $site_id = $arr[0];
+          $dataset_id = $arr[1];
+          $size = $arr[2];
+          $decision = $arr[3];
+          $condition = $arr[4];
 
-        $stmt->execute();
+          $stmt->execute();
+        }
+
+        $in_stmt->close();
+        $stmt->close();
       }
 
-      $in_stmt->close();
-      $stmt->close();
-    }
+      if ($num_site_table == 0) {
+        $sql = 'SELECT n.`site_id`, s.`value`, n.`quota` FROM `sites` AS n';
+        $sql .= ' INNER JOIN `statuses` AS s ON s.`id` = n.`status_id`';
+        $in_stmt = $snapshot_db->prepare($sql);
+        $result = $in_stmt->execute();
 
-    if ($num_site_table == 0) {
-      $sql = 'SELECT n.`site_id`, s.`value`, n.`quota` FROM `sites` AS n';
-      $sql .= ' INNER JOIN `statuses` AS s ON s.`id` = n.`status_id`';
-      $in_stmt = $snapshot_db->prepare($sql);
-      $result = $in_stmt->execute();
+        $history_db->query(sprintf('CREATE TABLE `%s`.`%s` LIKE `%s`.`sites`', $cache_db_name, $site_cache_table_name, $cache_db_name));
 
-      $history_db->query(sprintf('CREATE TABLE `%s`.`%s` LIKE `%s`.`sites`', $cache_db_name, $site_cache_table_name, $cache_db_name));
+        $stmt = $history_db->prepare(sprintf('INSERT INTO `%s`.`%s` VALUES (?, ?, ?)', $cache_db_name, $site_cache_table_name));
+        $stmt->bind_param('isi', $site_id, $status, $quota);
 
-      $stmt = $history_db->prepare(sprintf('INSERT INTO `%s`.`%s` VALUES (?, ?, ?)', $cache_db_name, $site_cache_table_name));
-      $stmt->bind_param('isi', $site_id, $status, $quota);
+        while (($arr = $result->fetchArray(SQLITE3_NUM))) {
+          $site_id = $arr[0];
+          $status = $arr[1];
+          $quota = $arr[2];
 
-      while (($arr = $result->fetchArray(SQLITE3_NUM))) {
-        $site_id = $arr[0];
-        $status = $arr[1];
-        $quota = $arr[2];
+          $stmt->execute();
+        }
 
-        $stmt->execute();
+        $in_stmt->close();
+        $stmt->close();
       }
 
-      $in_stmt->close();
-      $stmt->close();
+      $snapshot_db->close();
     }
-
-    $snapshot_db->close();
   }
 
   $stmt = $history_db->prepare('INSERT INTO `' . $cache_db_name . '`.`replicas_snapshot_usage` VALUES (?, NOW())');
@@ -108,4 +119,107 @@ function check_cache($history_db, $cycle, $partition_id, $snapshot_spool_path, $
   return true;
 }
 
+function read_archive_index($archive_file_name)
+{
+  // layout: MAGIC | chunks | JSON index | index offset (8 bytes, little endian)
+  $archive = fopen($archive_file_name, 'rb');
+  if ($archive === false)
+    return false;
+
+  if (fread($archive, 8) != 'DYNSNAP1') {
+    fclose($archive);
+    return false;
+  }
+
+  fseek($archive, -8, SEEK_END);
+  $end = ftell($archive);
+  $words = unpack('V2', fread($archive, 8));
+  $index_offset = $words[1] + $words[2] * 4294967296;
+
+  fseek($archive, $index_offset);
+  $index = json_decode(fread($archive, $end - $index_offset), true);
+
+  fclose($archive);
+
+  return $index;
+}
+
+function read_archive_chunk($archive_file_name, $chunk)
+{
+  // Each chunk is an independent xz stream of tab-separated rows
+  $tmp_name = tempnam(sys_get_temp_dir(), 'dynamo_snapshot');
+
+  $archive = fopen($archive_file_name, 'rb');
+  $tmp = fopen($tmp_name, 'wb');
+  fseek($archive, $chunk[0]);
+  stream_copy_to_stream($archive, $tmp, $chunk[1]);
+  fclose($archive);
+  fclose($tmp);
+
+  $rows = array();
+
+  $pipe = popen(sprintf('unxz -c < %s', escapeshellarg($tmp_name)), 'r');
+  while (($line = fgets($pipe)) !== false) {
+    $line = rtrim($line, "\n");
+    if ($line != '')
+      $rows[] = explode("\t", $line);
+  }
+  pclose($pipe);
+
+  unlink($tmp_name);
+
+  return $rows;
+}
+
+function fill_cache_from_archive($history_db, $archive_file_name, $cache_db_name, $replica_cache_table_name, $site_cache_table_name)
+{
+  exec('which unxz > /dev/null 2>&1', $stdout, $rc);
+  if ($rc != 0)
+    return false;
+
+  $index = read_archive_index($archive_file_name);
+  if (!$index)
+    return false;
+
+  if ($replica_cache_table_name != '') {
+    $history_db->query(sprintf('CREATE TABLE `%s`.`%s` LIKE `%s`.`replicas`', $cache_db_name, $replica_cache_table_name, $cache_db_name));
+
+    $stmt = $history_db->prepare(sprintf('INSERT INTO `%s`.`%s` VALUES (?, ?, ?, ?, ?)', $cache_db_name, $replica_cache_table_name));
+    $stmt->bind_param('iiisi', $site_id, $dataset_id, $size, $decision, $condition);
+
+    // one chunk per site
+    foreach ($index['replicas'] as $site_id => $chunk) {
+      foreach (read_archive_chunk($archive_file_name, $chunk) as $row) {
+        $dataset_id = $row[0];
+        $size = $row[1];
+        $decision = $index['decisions'][$row[2]];
+        $condition = $row[3];
+
+        $stmt->execute();
+      }
+    }
+
+    $stmt->close();
+  }
+
+  if ($site_cache_table_name != '') {
+    $history_db->query(sprintf('CREATE TABLE `%s`.`%s` LIKE `%s`.`sites`', $cache_db_name, $site_cache_table_name, $cache_db_name));
+
+    $stmt = $history_db->prepare(sprintf('INSERT INTO `%s`.`%s` VALUES (?, ?, ?)', $cache_db_name, $site_cache_table_name));
+    $stmt->bind_param('isd', $site_id, $status, $quota);
+
+    foreach (read_archive_chunk($archive_file_name, $index['sites']) as $row) {
+      $site_id = $row[0];
+      $status = $index['statuses'][$row[1]];
+      $quota = $row[2];
+
+      $stmt->execute();
+    }
+
+    $stmt->close();
+  }
+
+  return true;
+}
+
 ?>
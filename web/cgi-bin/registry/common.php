@@ -86,6 +86,23 @@ function get_user($db, $cert_dn, $issuer_dn, $service, $as_user, &$uid, &$uname,
   }
 }
 
+function notify_server()
+{
+  // wake up the dynamo server main loop; the server polls the registry periodically if this fails
+  global $server_socket_path;
+
+  if (!isset($server_socket_path) || !file_exists($server_socket_path))
+    return;
+
+  $sock = socket_create(AF_UNIX, SOCK_DGRAM, 0);
+  if ($sock === false)
+    return;
+
+  socket_set_nonblock($sock);
+  @socket_sendto($sock, 'n', 1, 0, $server_socket_path);
+  socket_close($sock);
+}
+
 function send_response($code, $result, $message, $data = NULL, $format = 'json')
 {
   header($_SERVER['SERVER_PROTOCOL'] . ' ' . $code, true, $code);
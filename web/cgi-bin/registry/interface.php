@@ -93,6 +93,8 @@ if ($filedata != '') {
   $task_id = $stmt->insert_id;
   $stmt->close();
 
+  notify_server();
+
   $data = array('taskid' => $task_id, 'title' => $title, 'args' => $args, 'write_request' => $write_request, 'email' => $email, 'status' => 'new');
 
   if ($local)
@@ -137,6 +139,8 @@ else if (isset($_REQUEST['taskid'])) {
 
         $data['status'] = 'killed';
         $message = 'Task aborted.';
+
+        notify_server();
       }
       else {
         if ($exit_code === NULL)